@@ -1,6 +1,18 @@
+# -*- coding: UTF-8 -*-
+
+from django.conf.urls import url
 from django.contrib import admin
+from django.http.response import JsonResponse
+from django.shortcuts import get_object_or_404
+from django.template.response import TemplateResponse
+from django.utils.encoding import force_text
+from django.utils.html import format_html, format_html_join
+from django.utils.safestring import mark_safe
+
+from .models import CourseMember, GroupMember, CourseKVStore, GroupKVStore, SyncLease, SyncRun, SyncState
 
-from .models import CourseMember, GroupMember, CourseKVStore, GroupKVStore
+SPARKS = u'▁▂▃▄▅▆▇█'
+TREND_LENGTH = 20
 
 
 class CourseMemberAdmin(admin.ModelAdmin):
@@ -26,7 +38,100 @@ class GroupKVStoreAdmin(admin.ModelAdmin):
     search_fields = ('vle_course_id', 'vle_group_id', 'name',)
 
 
+class SyncStateAdmin(admin.ModelAdmin):
+    list_display = ('name', 'value', 'modified',)
+    readonly_fields = ('modified',)
+
+
+class SyncRunAdmin(admin.ModelAdmin):
+    list_display = (
+        'started', 'kind', 'dry_run', 'status', 'seconds', 'payload_bytes', 'queries', 'peak_rss', 'progress', 'trends',
+    )
+    list_filter = ('kind', 'dry_run', 'status',)
+    list_per_page = 50
+    readonly_fields = (
+        'kind', 'dry_run', 'started', 'finished', 'status', 'seconds', 'payload_bytes', 'rows_table', 'summary', 'queries',
+        'peak_rss', 'progress', 'phase', 'processed', 'expected', 'snapshot', 'checkpoints', 'resumed_from', 'error',
+    )
+    exclude = ('total', 'rows',)
+
+    def seconds(self, obj):
+        duration = obj.duration
+        return '' if duration is None else '%.1f' % duration
+
+    def progress(self, obj):
+        return '%d/%d' % (len(obj.get_checkpoints()), obj.total)
+
+    def rows_table(self, obj):
+        return format_html_join(
+            mark_safe('<br>'),
+            '{}: {} created, {} updated, {} deleted, {} skipped',
+            ((key, c['created'], c['updated'], c['deleted'], c['skipped']) for key, c in obj.get_rows().items())
+        )
+    rows_table.short_description = 'rows'
+
+    def trends(self, obj):
+        """
+        sparklines of the duration, queries and peak RSS of the last successful runs (dry or not, as this one is)
+        of the same kind up to this one
+        """
+        runs = SyncRun.objects.filter(kind=obj.kind, dry_run=obj.dry_run, status=SyncRun.SUCCEEDED, started__lte=obj.started)
+        runs = list(reversed(runs.order_by('-started').values_list('started', 'finished', 'queries', 'peak_rss')[:TREND_LENGTH]))
+        return format_html(
+            'time {}<br>queries {}<br>rss {}',
+            _sparkline([(finished - started).total_seconds() for started, finished, queries, peak_rss in runs]),
+            _sparkline([queries for started, finished, queries, peak_rss in runs]),
+            _sparkline([peak_rss for started, finished, queries, peak_rss in runs]),
+        )
+
+    def has_add_permission(self, request):
+        return False
+
+    def get_urls(self):
+        return [
+            url(r'^(?P<pk>\d+)/progress/$', self.admin_site.admin_view(self.progress_view), name='vle_syncrun_progress'),
+            url(r'^(?P<pk>\d+)/status/$', self.admin_site.admin_view(self.status_view), name='vle_syncrun_status'),
+        ] + super(SyncRunAdmin, self).get_urls()
+
+    def progress_view(self, request, pk):
+        """
+        a page that polls the run's status until it has finished
+        """
+        run = get_object_or_404(SyncRun, pk=pk)
+        context = dict(self.admin_site.each_context(request), opts=self.model._meta, run=run, title=force_text(run))
+        return TemplateResponse(request, 'admin/vle/syncrun/progress.html', context)
+
+    def status_view(self, request, pk):
+        """
+        returns the run's status and progress as JSON
+        """
+        return JsonResponse(get_object_or_404(SyncRun, pk=pk).get_status())
+
+
+def _sparkline(values):
+    """
+    returns a string of block characters whose heights follow the given values (ignoring any that are unknown)
+    """
+    values = [v for v in values if v is not None]
+    if not values:
+        return ''
+    lo, hi = min(values), max(values)
+    span = (hi - lo) or 1
+    return u''.join(SPARKS[int((v - lo) * (len(SPARKS) - 1) / span)] for v in values)
+
+
+class SyncLeaseAdmin(admin.ModelAdmin):
+    list_display = ('name', 'holder', 'acquired', 'expires', 'run',)
+    readonly_fields = ('name', 'holder', 'acquired', 'expires', 'run',)
+
+    def has_add_permission(self, request):
+        return False
+
+
 admin.site.register(CourseMember, CourseMemberAdmin)
 admin.site.register(GroupMember, GroupMemberAdmin)
 admin.site.register(CourseKVStore, CourseKVStoreAdmin)
 admin.site.register(GroupKVStore, GroupKVStoreAdmin)
+admin.site.register(SyncLease, SyncLeaseAdmin)
+admin.site.register(SyncRun, SyncRunAdmin)
+admin.site.register(SyncState, SyncStateAdmin)
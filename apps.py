@@ -0,0 +1,19 @@
+from django.apps import AppConfig
+from django.contrib.auth import get_user_model
+from django.db.models.signals import post_delete, post_save, pre_save
+
+
+class VleConfig(AppConfig):
+    name = 'vle'
+    verbose_name = 'VLE'
+
+    def ready(self):
+        from .models import CourseMember, GroupMember
+        from .signals import member_changed, member_saving, user_changed
+        post_save.connect(user_changed, sender=get_user_model(), dispatch_uid='vle.user_saved')
+        post_delete.connect(user_changed, sender=get_user_model(), dispatch_uid='vle.user_deleted')
+        for model in (CourseMember, GroupMember):
+            name = model._meta.model_name
+            pre_save.connect(member_saving, sender=model, dispatch_uid='vle.%s_saving' % name)
+            post_save.connect(member_changed, sender=model, dispatch_uid='vle.%s_saved' % name)
+            post_delete.connect(member_changed, sender=model, dispatch_uid='vle.%s_deleted' % name)
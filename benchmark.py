@@ -0,0 +1,255 @@
+"""
+a synthetic-scale benchmark of syncing, the webhook views and recipient expansion
+data is generated deterministically from a seed: courses of members (drawn from a pool of users, some of them tutors),
+each course with groups that each member belongs to one of
+it is served gzipped by a stand-in for Moodle's endpoint on the loopback interface, so that syncing it goes through
+the client, decompression and streaming as it would in production, but no network is needed
+"""
+import base64
+import gzip
+import io
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+from django.utils.encoding import force_text
+from django.utils.six.moves import BaseHTTPServer, socketserver
+
+try:
+    import tracemalloc
+except ImportError:  # on Python 2
+    tracemalloc = None
+
+from .models import CourseKVStore, expand_user_group_course_ids_to_user_ids
+from .report import SyncReport
+from .snapshot import iter_snapshot_json, write_snapshot
+from .sync import full_sync
+from .utils import chunks, get_batch_size
+from .views import add_course_members, delete_course
+
+SCALES = (10000, 100000, 1000000,)
+METRICS = ('seconds', 'queries', 'peak_memory',)
+
+# how many courses and groups recipients are expanded from
+EXPANDED = 10
+
+
+def get_username(i):
+    return 'benchmark.%07d' % i
+
+
+def get_course_id(i):
+    return 'B%07d' % i
+
+
+def _get_course(seed, i, groups, members, tutor_ratio, users):
+    """
+    returns a list of (user, is_tutor, group) triples for the members of the i-th course
+    """
+    rng = random.Random(seed * 1000003 + i)
+    return [
+        (user, rng.random() < tutor_ratio, rng.randrange(groups) if groups else None)
+        for user in rng.sample(range(users), members)
+    ]
+
+
+def generate(courses, groups=5, members=100, tutor_ratio=0.05, users=None, seed=0):
+    """
+    returns a dict of section key to generator of snapshot rows for the given numbers of courses,
+    groups per course and members per course, drawn from a pool of users (by default, ten courses' worth)
+    the same arguments always generate the same data
+    """
+    users = max(users or members * 10, members)
+
+    def course_kv_store():
+        for i in range(courses):
+            yield get_course_id(i), 'Course %d' % i
+
+    def group_kv_store():
+        for i in range(courses):
+            for j in range(groups):
+                yield get_course_id(i), 'G%d' % j, 'Group %d of course %d' % (j, i)
+
+    def course_member():
+        for i in range(courses):
+            for user, is_tutor, group in _get_course(seed, i, groups, members, tutor_ratio, users):
+                yield get_username(user), get_course_id(i), is_tutor
+
+    def group_member():
+        for i in range(courses):
+            for user, is_tutor, group in _get_course(seed, i, groups, members, tutor_ratio, users):
+                if group is not None:
+                    yield get_username(user), get_course_id(i), 'G%d' % group
+
+    return OrderedDict((
+        ('course_kv_store', course_kv_store()),
+        ('group_kv_store', group_kv_store()),
+        ('course_member', course_member()),
+        ('group_member', group_member()),
+    ))
+
+
+def create_users(users, batch_size=None):
+    """
+    creates the given number of users for generated members to resolve to
+    """
+    model = get_user_model()
+    for chunk in chunks(range(users), batch_size or get_batch_size()):
+        model.objects.bulk_create([model(username=get_username(i), password='!') for i in chunk])
+
+
+def _measure(f):
+    """
+    returns the wall time, queries and peak memory allocated by Python (in kilobytes, or None on Python 2)
+    of calling f with a report recording queries
+    """
+    report = SyncReport()
+    tracing = tracemalloc is not None and tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.clear_traces()
+    elif tracemalloc is not None:
+        tracemalloc.start()
+    try:
+        started = time.time()
+        with report.recording(), report.phase('apply'):
+            f(report)
+        seconds = time.time() - started
+        peak_memory = tracemalloc.get_traced_memory()[1] // 1024 if tracemalloc is not None else None
+    finally:
+        if tracemalloc is not None and not tracing:
+            tracemalloc.stop()
+    return OrderedDict((
+        ('seconds', seconds),
+        ('queries', sum(report.queries.values())),
+        ('peak_memory', peak_memory),
+    ))
+
+
+class _MoodleHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    answers every request with the server's gzipped payload, as Moodle's endpoint would
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(os.path.getsize(self.server.path)))
+        self.end_headers()
+        with io.open(self.server.path, 'rb') as f:
+            shutil.copyfileobj(f, self.wfile)
+
+    def log_message(self, *args):
+        pass
+
+
+class _MoodleServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, path):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), _MoodleHandler)
+        self.path = path
+
+
+def _write_payload(path, sections, chunk_size=65536):
+    """
+    writes the given sections to the given path as a gzipped JSON payload, by way of a snapshot
+    """
+    snapshot = path + '.snapshot'
+    write_snapshot(snapshot, sections)
+    with gzip.open(path, 'wb') as f:
+        for chunk in iter_snapshot_json(snapshot, chunk_size):
+            f.write(chunk)
+    os.remove(snapshot)
+
+
+def _post(view, data):
+    """
+    calls the given webhook view as Moodle would
+    """
+    auth = base64.b64encode(('%s:%s' % settings.VLE_SYNC_BASIC_AUTH).encode('utf-8'))
+    request = RequestFactory().post(
+        '/', data=json.dumps(data), content_type='application/json', HTTP_AUTHORIZATION='Basic %s' % force_text(auth)
+    )
+    response = view(request)
+    if response.status_code != 200:
+        raise AssertionError(force_text(response.content))
+
+
+def run_benchmark(memberships, groups=5, members=100, tutor_ratio=0.05, users=None, seed=0, batch_size=None):
+    """
+    generates course memberships numbering (about) the given scale into the (empty) database and returns a dict
+    of step to the wall time, queries and peak memory of:
+    streaming them all from a stand-in for Moodle and syncing them, doing so again unchanged,
+    expanding recipients from some of the courses and groups, adding a course's worth of members to a new course,
+    and deleting a course
+    """
+    courses = max(1, memberships // members)
+    users = max(users or members * 10, members)
+    create_users(users, batch_size)
+    path = tempfile.mkdtemp()
+    server = None
+    try:
+        payload = os.path.join(path, 'payload.json.gz')
+        _write_payload(payload, generate(courses, groups, members, tutor_ratio, users, seed))
+        server = _MoodleServer(payload)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        results = OrderedDict()
+        with override_settings(MOODLEWWWROOT='http://127.0.0.1:%d' % server.server_address[1]):
+            results['full_sync'] = _measure(lambda report: full_sync(stream=True, batch_size=batch_size, report=report))
+            results['full_sync_unchanged'] = _measure(
+                lambda report: full_sync(stream=True, batch_size=batch_size, report=report)
+            )
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+        shutil.rmtree(path)
+
+    course_ids = [get_course_id(i) for i in range(min(courses, EXPANDED))]
+    group_ids = ['%s|G%d' % (course_id, i % groups) for i, course_id in enumerate(course_ids)] if groups else []
+    results['expand_user_group_course_ids_to_user_ids'] = _measure(
+        lambda report: expand_user_group_course_ids_to_user_ids('|', [], group_ids, course_ids)
+    )
+
+    CourseKVStore.objects.create(vle_course_id='benchmark', name='Benchmark')
+    usernames = [get_username(i) for i in range(members)]
+    results['add_course_members'] = _measure(
+        lambda report: _post(add_course_members, {'vle_course_id': 'benchmark', 'usernames': usernames})
+    )
+    results['delete_course'] = _measure(lambda report: _post(delete_course, {'vle_course_id': get_course_id(0)}))
+    return results
+
+
+def compare(results, baseline, tolerance=0.1):
+    """
+    returns a list of (line, regressed) pairs comparing each metric of the given results with those of a baseline
+    (both dicts of scale to step to metrics), where a metric has regressed if it is more than tolerance worse
+    """
+    lines = []
+    for scale, steps in results.items():
+        for step, metrics in steps.items():
+            for metric in METRICS:
+                old, new = baseline.get(scale, {}).get(step, {}).get(metric), metrics.get(metric)
+                if old is None or new is None:
+                    continue
+                change = (new - old) / float(old) if old else 0.0
+                line = '%s %s %s: %s -> %s (%+.1f%%)' % (scale, step, metric, _format(old), _format(new), change * 100)
+                lines.append((line, change > tolerance))
+    return lines
+
+
+def _format(value):
+    return '%.3f' % value if isinstance(value, float) else '%d' % value
@@ -1,6 +1,6 @@
 from django_cron import CronJobBase, Schedule
 
-from .sync import full_sync
+from .sync import delta_sync, full_sync
 
 
 class FullSync(CronJobBase):
@@ -12,3 +12,14 @@ class FullSync(CronJobBase):
     def do(self):
         result = full_sync()
         return result
+
+
+class DeltaSync(CronJobBase):
+    RUN_EVERY_MINS = 15
+
+    schedule = Schedule(run_every_mins=RUN_EVERY_MINS)
+    code = 'vle.delta_sync'
+
+    def do(self):
+        result = delta_sync()
+        return result
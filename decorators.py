@@ -1,8 +1,11 @@
 import base64
+import json
 
 from django.http import HttpResponseForbidden
 from django.utils.encoding import force_str
 
+from .recipients import recipient_cache
+
 
 def basic_auth(t):
     """
@@ -31,3 +34,21 @@ def basic_auth(t):
             return some_view(request, *args, **kwargs)
         return _wrapped_view
     return decorator
+
+
+def invalidates_recipients(some_view):
+    """
+    forgets the cached recipients of the course(s) named by the request once the view has run (or failed)
+    """
+    def _wrapped_view(request, *args, **kwargs):
+        try:
+            return some_view(request, *args, **kwargs)
+        finally:
+            try:
+                data = dict(json.loads(force_str(request.body)))
+            except (TypeError, ValueError):
+                data = {}
+            course_ids = [data[k] for k in ('old_vle_course_id', 'vle_course_id',) if data.get(k)]
+            if course_ids:
+                recipient_cache.invalidate(course_ids)
+    return _wrapped_view
@@ -0,0 +1,189 @@
+import sys
+from array import array
+from bisect import bisect_left
+from itertools import groupby
+
+from django.core.exceptions import ImproperlyConfigured
+
+from .models import CourseMember, GroupMember
+from .recipients import recipient_cache
+from .utils import merge
+
+
+class _Course(object):
+    """
+    the sorted user ids of a course's members, of its tutors, and of each of its groups' members, as of the given versions
+    """
+
+    def __init__(self, versions, members, tutors, groups):
+        self.versions = versions
+        self.members = members
+        self.tutors = tutors
+        self.groups = groups
+
+    def get_members(self, is_tutor=None):
+        """
+        returns the members of the course, or only its tutors (or students)
+        """
+        if is_tutor is None:
+            return self.members
+        if is_tutor:
+            return self.tutors
+        return self.filter(self.members, False)
+
+    def get_group(self, vle_group_id, is_tutor=None):
+        """
+        returns the members of the given group, or only those who are tutors (or students) in the course
+        """
+        members = self.groups.get(vle_group_id, ())
+        return members if is_tutor is None else self.filter(members, is_tutor)
+
+    def filter(self, members, is_tutor):
+        if is_tutor:
+            return [user_id for user_id in members if _contains(self.tutors, user_id)]
+        return [user_id for user_id in members if _contains(self.members, user_id) and not _contains(self.tutors, user_id)]
+
+
+class MembershipIndex(object):
+    """
+    a process-resident index of the members (and tutors) of each course and group as sorted arrays of user ids,
+    so that recipients can be expanded by merging arrays instead of querying the database
+    each course is loaded the first time it's expanded (or all at once by build), and reloaded once its version,
+    or that of everything, has been bumped (see recipients.py), so every write (by a view, a signal or a sync) patches
+    the index across processes, a course at a time, which needs versioning (i.e. VLE_RECIPIENTS_CACHE) to be on
+    """
+
+    def __init__(self, cache=None):
+        self.cache = cache or recipient_cache
+        self.courses = {}
+
+    def expand(self, user_ids, pairs, course_ids, is_tutor=None, exclude_user_ids=()):
+        """
+        returns the sorted ids of the given users, the members of the given (vle_course_id, vle_group_id) pairs
+        and the members of the given courses, or None if the index can't be relied on (e.g. while a sync is writing)
+        members are only tutors (or students) if is_tutor is given, and the excluded users are left out
+        """
+        ids = self.iterate(user_ids, pairs, course_ids, is_tutor, exclude_user_ids)
+        return None if ids is None else list(ids)
+
+    def iterate(self, user_ids, pairs, course_ids, is_tutor=None, exclude_user_ids=()):
+        """
+        returns an iterator over the same ids as expand, merged as they're iterated over, or None
+        """
+        arrays = self._get_arrays(user_ids, pairs, course_ids, is_tutor)
+        if arrays is None:
+            return None
+        exclude = set(exclude_user_ids)
+        return (user_id for user_id in merge(arrays) if user_id not in exclude)
+
+    def count(self, user_ids, pairs, course_ids, is_tutor=None, exclude_user_ids=()):
+        """
+        returns how many ids expand would return, or None
+        """
+        ids = self.iterate(user_ids, pairs, course_ids, is_tutor, exclude_user_ids)
+        return None if ids is None else sum(1 for user_id in ids)
+
+    def contains(self, user_id, pairs, course_ids, is_tutor=None, exclude_user_ids=()):
+        """
+        returns whether expand would return the given id (without any users given explicitly),
+        by bisecting each array rather than merging them, or None
+        """
+        arrays = self._get_arrays([], pairs, course_ids, is_tutor)
+        if arrays is None:
+            return None
+        return user_id not in exclude_user_ids and any(_contains(a, user_id) for a in arrays)
+
+    def _get_arrays(self, user_ids, pairs, course_ids, is_tutor=None):
+        self._check()
+        affected = sorted(set(course_ids).union(c for c, g in pairs))
+        versions = self.cache.get_versions(affected)
+        if versions is None:
+            return None
+        everything, course_versions = versions[0], dict(zip(affected, versions[1:]))
+        arrays = [self._get_course(c, (everything, course_versions[c])).get_members(is_tutor) for c in course_ids]
+        for c, g in pairs:
+            arrays.append(self._get_course(c, (everything, course_versions[c])).get_group(g, is_tutor))
+        arrays.append(sorted(set(user_ids)))
+        return arrays
+
+    def build(self):
+        """
+        loads every course at once, raising RuntimeError if a sync is writing
+        """
+        self._check()
+        # the versions are read before the rows, so that a write in between leaves the course stale rather than wrong
+        course_ids = set(CourseMember.objects.values_list('vle_course_id', flat=True).distinct())
+        course_ids.update(GroupMember.objects.values_list('vle_course_id', flat=True).distinct())
+        course_ids = sorted(course_ids)
+        versions = self.cache.get_versions(course_ids)
+        if versions is None:
+            raise RuntimeError('The membership index can\'t be built while a sync is writing')
+        courses = dict(
+            (c, _Course((versions[0], version), array('i'), array('i'), {})) for c, version in zip(course_ids, versions[1:])
+        )
+        members = CourseMember.objects.order_by('vle_course_id', 'user').values_list('vle_course_id', 'user_id', 'is_tutor')
+        for c, rows in groupby(members.iterator(), lambda t: t[0]):
+            if c in courses:
+                courses[c].members, courses[c].tutors = _split_tutors(rows)
+        groups = GroupMember.objects.order_by('vle_course_id', 'vle_group_id', 'user').values_list('vle_course_id', 'vle_group_id', 'user_id')
+        for (c, g), rows in groupby(groups.iterator(), lambda t: t[:2]):
+            if c in courses:
+                courses[c].groups[g] = array('i', (user_id for c, g, user_id in rows))
+        self.courses.update(courses)
+
+    def get_stats(self):
+        """
+        returns a dict of how many courses, groups and memberships are loaded, and about how many bytes they take
+        """
+        stats = {'courses': len(self.courses), 'groups': 0, 'members': 0, 'group_members': 0, 'bytes': sys.getsizeof(self.courses)}
+        for course in list(self.courses.values()):
+            stats['groups'] += len(course.groups)
+            stats['members'] += len(course.members)
+            stats['bytes'] += sum(sys.getsizeof(o) for o in (course, course.members, course.tutors, course.groups))
+            for g, members in course.groups.items():
+                stats['group_members'] += len(members)
+                stats['bytes'] += sys.getsizeof(g) + sys.getsizeof(members)
+        return stats
+
+    def clear(self):
+        self.courses = {}
+
+    def _check(self):
+        # without versions, the index could never tell that a course had been written to
+        if not self.cache.versioned:
+            raise ImproperlyConfigured('VLE_RECIPIENTS_INDEX needs VLE_RECIPIENTS_CACHE to be set, for writes to be versioned')
+
+    def _get_course(self, vle_course_id, versions):
+        course = self.courses.get(vle_course_id)
+        if course is None or course.versions != versions:
+            members = CourseMember.objects.filter(vle_course_id=vle_course_id).order_by('user').values_list('vle_course_id', 'user_id', 'is_tutor')
+            groups = GroupMember.objects.filter(vle_course_id=vle_course_id).order_by('vle_group_id', 'user').values_list('vle_group_id', 'user_id')
+            members, tutors = _split_tutors(members)
+            course = _Course(
+                versions,
+                members,
+                tutors,
+                dict((g, array('i', (user_id for g, user_id in rows))) for g, rows in groupby(groups, lambda t: t[0])),
+            )
+            self.courses[vle_course_id] = course
+        return course
+
+
+def _split_tutors(rows):
+    """
+    returns arrays of all the user ids, and of those who are tutors, of the given (vle_course_id, user_id, is_tutor) rows
+    """
+    members, tutors = array('i'), array('i')
+    for c, user_id, is_tutor in rows:
+        members.append(user_id)
+        if is_tutor:
+            tutors.append(user_id)
+    return members, tutors
+
+
+def _contains(a, value):
+    i = bisect_left(a, value)
+    return i < len(a) and a[i] == value
+
+
+membership_index = MembershipIndex()
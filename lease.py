@@ -0,0 +1,100 @@
+import os
+import socket
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.utils import timezone
+
+from .models import SyncLease, SyncRun
+
+SYNC = 'sync'
+
+
+class Lease(object):
+    """
+    a database-backed lock with a time to live (defaulting to the VLE_SYNC_LEASE_TTL setting, in seconds),
+    so that if its holder dies without releasing it, it expires and can be taken over
+    """
+
+    def __init__(self, name=SYNC, ttl=None):
+        self.name = name
+        self.ttl = ttl or getattr(settings, 'VLE_SYNC_LEASE_TTL', 3600)
+        self.holder = '%s:%d:%s' % (socket.gethostname(), os.getpid(), uuid.uuid4().hex)
+
+    def acquire(self):
+        """
+        takes the lease if it's free (or has expired), returning whether it was taken
+        """
+        now = timezone.now()
+        expires = now + timedelta(seconds=self.ttl)
+        if SyncLease.objects.filter(name=self.name, expires__lte=now).update(
+                holder=self.holder, acquired=now, expires=expires, run=None):
+            return True
+        try:
+            with transaction.atomic():
+                SyncLease.objects.create(name=self.name, holder=self.holder, acquired=now, expires=expires)
+        except IntegrityError:
+            return False
+        return True
+
+    def renew(self):
+        """
+        extends the lease by its time to live, returning whether it is still held
+        """
+        expires = timezone.now() + timedelta(seconds=self.ttl)
+        return bool(SyncLease.objects.filter(name=self.name, holder=self.holder).update(expires=expires))
+
+    def release(self):
+        SyncLease.objects.filter(name=self.name, holder=self.holder).delete()
+
+    def set_run(self, run):
+        """
+        records which SyncRun the lease is held for, so that others can attach to its result
+        """
+        SyncLease.objects.filter(name=self.name, holder=self.holder).update(run=run)
+
+    @contextmanager
+    def kept_alive(self):
+        """
+        renews the lease from a background thread every third of its time to live until the block exits,
+        then releases it
+        """
+        stopped = threading.Event()
+
+        def heartbeat():
+            try:
+                while not stopped.wait(self.ttl / 3.0):
+                    self.renew()
+            finally:
+                connection.close()
+
+        thread = threading.Thread(target=heartbeat, name='vle-sync-lease')
+        thread.daemon = True
+        thread.start()
+        try:
+            yield self
+        finally:
+            stopped.set()
+            thread.join()
+            self.release()
+
+    def wait(self, poll=None):
+        """
+        waits until the lease is free (or has expired), returning the SyncRun it was last held for, if known
+        """
+        poll = poll or getattr(settings, 'VLE_SYNC_LEASE_POLL', 1)
+        run_id = None
+        while True:
+            lease = SyncLease.objects.filter(name=self.name, expires__gt=timezone.now()).first()
+            if lease is None:
+                break
+            run_id = lease.run_id or run_id
+            time.sleep(poll)
+        if run_id is None:
+            return None
+        return SyncRun.objects.filter(pk=run_id).first()
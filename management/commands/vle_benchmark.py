@@ -0,0 +1,81 @@
+import io
+import json
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from ...benchmark import SCALES, compare, run_benchmark
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmarks syncing, the webhook views and recipient expansion against generated data at each scale, '
+        'in a throwaway SQLite database'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--scale', type=int, action='append', dest='scales', default=[], metavar='MEMBERSHIPS',
+            help='The number of course memberships to generate (may be given more than once, defaults to %s)' % ', '.join(map(str, SCALES))
+        )
+        parser.add_argument('--groups', type=int, default=5, help='The number of groups per course')
+        parser.add_argument('--members', type=int, default=100, help='The number of members per course')
+        parser.add_argument('--tutor-ratio', type=float, dest='tutor_ratio', default=0.05, help='The proportion of members who are tutors')
+        parser.add_argument('--users', type=int, default=None, help='The number of users members are drawn from (defaults to ten courses\' worth)')
+        parser.add_argument('--seed', type=int, default=0, help='The seed data is generated from')
+        parser.add_argument(
+            '--batch-size', type=int, dest='batch_size', default=None,
+            help='The number of items to diff and write at a time (defaults to the VLE_SYNC_BATCH_SIZE setting)'
+        )
+        parser.add_argument('--output', default=None, metavar='PATH', help='Write the results to the given JSON file, as a baseline')
+        parser.add_argument('--baseline', default=None, metavar='PATH', help='Compare the results with those in the given JSON file')
+        parser.add_argument(
+            '--tolerance', type=float, default=0.1,
+            help='How much worse than the baseline a metric can be before it counts as a regression (defaults to 0.1, i.e. 10%%)'
+        )
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'sqlite':
+            raise CommandError('The benchmark runs against SQLite, but the default database is %s' % connection.vendor)
+        params = OrderedDict((key, options[key]) for key in ('groups', 'members', 'tutor_ratio', 'users', 'seed', 'batch_size',))
+        results = OrderedDict()
+
+        for scale in sorted(options['scales'] or SCALES):
+            results[str(scale)] = self._run(scale, params)
+            for step, metrics in results[str(scale)].items():
+                self.stdout.write('%d %s: %.3fs, %d queries, peak memory %s KB' % (scale, step, metrics['seconds'], metrics['queries'], metrics['peak_memory']))
+
+        if options['output']:
+            with io.open(options['output'], 'w') as f:
+                f.write(json.dumps({'params': params, 'results': results}, indent=2) + u'\n')
+        if options['baseline']:
+            with io.open(options['baseline']) as f:
+                baseline = json.load(f)
+            if baseline['params'] != params:
+                self.stderr.write('The baseline was generated with different parameters: %s' % json.dumps(baseline['params']))
+            regressions = 0
+            for line, regressed in compare(results, baseline['results'], options['tolerance']):
+                self.stdout.write(('REGRESSION ' if regressed else '') + line)
+                regressions += regressed
+            if regressions:
+                raise CommandError('%d metrics regressed' % regressions)
+
+    def _run(self, scale, params):
+        """
+        runs the benchmark at the given scale in a new test database, in a file so that worker processes can share it
+        """
+        path = tempfile.mkdtemp()
+        test_settings = connection.settings_dict.setdefault('TEST', {})
+        test_name = test_settings.get('NAME')
+        test_settings['NAME'] = os.path.join(path, 'benchmark.sqlite3')
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            return run_benchmark(scale, **params)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            test_settings['NAME'] = test_name
+            shutil.rmtree(path)
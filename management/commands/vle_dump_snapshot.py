@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from ...snapshot import dump_snapshot
+
+
+class Command(BaseCommand):
+    help = 'Writes a snapshot of course, course membership, group and group membership data to a file'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='The file to write the (gzipped) snapshot to')
+
+    def handle(self, *args, **options):
+        dump_snapshot(options['path'])
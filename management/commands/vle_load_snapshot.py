@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from ...snapshot import load_snapshot
+
+
+class Command(BaseCommand):
+    help = 'Replaces course, course membership, group and group membership data with a snapshot written by vle_dump_snapshot'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='The snapshot to load')
+        parser.add_argument(
+            '--batch-size', type=int, dest='batch_size', default=None,
+            help='The number of items to create at a time (defaults to the VLE_SYNC_BATCH_SIZE setting)'
+        )
+
+    def handle(self, *args, **options):
+        report = load_snapshot(options['path'], batch_size=options['batch_size'])
+        for line in report.lines():
+            self.stdout.write(line)
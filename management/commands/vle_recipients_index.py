@@ -0,0 +1,22 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...index import membership_index
+
+
+class Command(BaseCommand):
+    help = 'Builds the membership index of every course and reports how big it is, to size the processes that hold it'
+
+    def handle(self, *args, **options):
+        started = time.time()
+        try:
+            membership_index.build()
+        except RuntimeError as e:
+            raise CommandError(e)
+        stats = membership_index.get_stats()
+        stats['seconds'] = time.time() - started
+        self.stdout.write(
+            '%(courses)d courses, %(groups)d groups, %(members)d course members, %(group_members)d group members '
+            'in about %(bytes)d bytes, built in %(seconds).3fs' % stats
+        )
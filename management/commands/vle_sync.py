@@ -0,0 +1,74 @@
+import datetime
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...report import SyncReport
+from ...sync import IncompatibleModes, full_sync
+
+
+class _Progress(object):
+    """
+    writes how many items have been diffed, how many per second and (if the size of the payload is known) the ETA
+    to the given stream, at most once per interval
+    """
+
+    def __init__(self, stream, interval=1.0):
+        self.stream = stream
+        self.interval = interval
+        self.last = 0
+
+    def __call__(self, report):
+        now, processed = time.time(), report.processed
+        if not processed or now - self.last < self.interval:
+            return
+        self.last = now
+        elapsed = now - report.started
+        rate = processed / elapsed if elapsed > 0 else 0
+        line = '%d rows, %.0f rows/s' % (processed, rate)
+        if report.expected and rate:
+            line += ', ETA %s' % datetime.timedelta(seconds=int(max(0, report.expected - processed) / rate))
+        self.stream.write(line)
+
+
+class Command(BaseCommand):
+    help = 'Synchronizes course, course membership, group and group membership data from the VLE'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run', action='store_true', dest='dry_run', default=False,
+            help='Compute what would be created, updated and deleted without writing anything'
+        )
+        parser.add_argument(
+            '--batch-size', type=int, dest='batch_size', default=None,
+            help='The number of items to diff and write at a time (defaults to the VLE_SYNC_BATCH_SIZE setting)'
+        )
+        parser.add_argument(
+            '--workers', type=int, dest='workers', default=None,
+            help='The number of processes to reconcile memberships with (defaults to the VLE_SYNC_PARTITIONS setting)'
+        )
+        parser.add_argument(
+            '--course', action='append', dest='course_ids', default=[], metavar='VLE_COURSE_ID',
+            help='Only sync the given course (may be given more than once)'
+        )
+        parser.add_argument(
+            '--source', dest='source', default=None, metavar='PATH',
+            help='Sync the payload in the given file instead of requesting it from Moodle'
+        )
+
+    def handle(self, *args, **options):
+        report = SyncReport(progress=_Progress(self.stderr) if options['verbosity'] > 0 else None)
+        try:
+            message = full_sync(
+                partitions=options['workers'],
+                course_ids=options['course_ids'],
+                source=options['source'],
+                batch_size=options['batch_size'],
+                dry_run=options['dry_run'],
+                report=report
+            )
+        except IncompatibleModes as e:
+            raise CommandError(e)
+        self.stdout.write(message)
+        for line in report.lines():
+            self.stdout.write(line)
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vle', '0002_syncstate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StagedCourseKVStore',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('vle_course_id', models.CharField(unique=True, max_length=100)),
+                ('name', models.CharField(max_length=255)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='StagedCourseMember',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('user_id', models.IntegerField()),
+                ('vle_course_id', models.CharField(max_length=100)),
+                ('is_tutor', models.BooleanField(default=False)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='StagedGroupKVStore',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('vle_course_id', models.CharField(max_length=100)),
+                ('vle_group_id', models.CharField(max_length=100)),
+                ('name', models.CharField(max_length=255)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='StagedGroupMember',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('user_id', models.IntegerField()),
+                ('vle_course_id', models.CharField(max_length=100)),
+                ('vle_group_id', models.CharField(max_length=100)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='stagedgroupmember',
+            unique_together=set([('user_id', 'vle_course_id', 'vle_group_id')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='stagedgroupkvstore',
+            unique_together=set([('vle_course_id', 'vle_group_id')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='stagedcoursemember',
+            unique_together=set([('user_id', 'vle_course_id')]),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vle', '0003_staging'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='coursekvstore',
+            name='digest',
+            field=models.CharField(default='', max_length=40, blank=True),
+            preserve_default=True,
+        ),
+    ]
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vle', '0004_coursekvstore_digest'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SyncRun',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('started', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('finished', models.DateTimeField(null=True, blank=True)),
+                ('status', models.CharField(default='running', max_length=10, choices=[('running', 'Running'), ('succeeded', 'Succeeded'), ('failed', 'Failed')])),
+                ('snapshot', models.CharField(default='', max_length=64, blank=True)),
+                ('checkpoints', models.TextField(default='', blank=True)),
+                ('total', models.PositiveIntegerField(default=0)),
+                ('resumed_from', models.ForeignKey(blank=True, to='vle.SyncRun', null=True)),
+                ('error', models.TextField(default='', blank=True)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+    ]
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vle', '0005_syncrun'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='syncrun',
+            name='kind',
+            field=models.CharField(default='full', max_length=10, choices=[('full', 'Full'), ('delta', 'Delta')]),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='syncrun',
+            name='payload_bytes',
+            field=models.BigIntegerField(default=0),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='syncrun',
+            name='rows',
+            field=models.TextField(default='', blank=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='syncrun',
+            name='queries',
+            field=models.PositiveIntegerField(default=0),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='syncrun',
+            name='peak_rss',
+            field=models.PositiveIntegerField(help_text='In kilobytes', null=True, blank=True),
+            preserve_default=True,
+        ),
+    ]
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vle', '0006_syncrun_metrics'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SyncLease',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('name', models.CharField(unique=True, max_length=100)),
+                ('holder', models.CharField(max_length=255)),
+                ('acquired', models.DateTimeField()),
+                ('expires', models.DateTimeField()),
+                ('run', models.ForeignKey(on_delete=django.db.models.deletion.SET_NULL, blank=True, to='vle.SyncRun', null=True)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vle', '0007_synclease'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='syncrun',
+            name='phase',
+            field=models.CharField(default='', max_length=10, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='syncrun',
+            name='processed',
+            field=models.PositiveIntegerField(default=0),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='syncrun',
+            name='expected',
+            field=models.PositiveIntegerField(null=True, blank=True),
+            preserve_default=True,
+        ),
+    ]
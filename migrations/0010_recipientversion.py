@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vle', '0009_member_generation'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RecipientVersion',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('name', models.CharField(unique=True, max_length=110)),
+                ('version', models.CharField(max_length=32)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vle', '0010_recipientversion'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='syncrun',
+            name='dry_run',
+            field=models.BooleanField(default=False),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='syncrun',
+            name='summary',
+            field=models.TextField(default='', blank=True),
+            preserve_default=True,
+        ),
+    ]
@@ -1,14 +1,23 @@
+import json
+from collections import OrderedDict
+
 from django.conf import settings
-from django.db import models
+from django.db import connection, models, transaction
 from django.db.models import Q
+from django.utils import timezone
+from django.utils.encoding import force_text
 from django.utils.six import moves, python_2_unicode_compatible
 
+from .recipients import recipient_cache
+from .utils import chunks, get_batch_size, get_peak_rss, merge
+
 
 @python_2_unicode_compatible
 class CourseMember(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL)
     vle_course_id = models.CharField(max_length=100, db_index=True)
     is_tutor = models.BooleanField(default=False, db_index=True)
+    generation = models.PositiveIntegerField(default=0, editable=False)
 
     def __str__(self):
         t = (
@@ -27,6 +36,7 @@ class GroupMember(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL)
     vle_course_id = models.CharField(max_length=100, db_index=True)
     vle_group_id = models.CharField(max_length=100, db_index=True)
+    generation = models.PositiveIntegerField(default=0, editable=False)
 
     def __str__(self):
         t = (
@@ -52,6 +62,7 @@ class GroupMember(models.Model):
 class CourseKVStore(models.Model):
     vle_course_id = models.CharField(max_length=100, db_index=True, unique=True)
     name = models.CharField(max_length=255)
+    digest = models.CharField(max_length=40, blank=True, default='')
 
     def __str__(self):
         t = (
@@ -79,23 +90,524 @@ class GroupKVStore(models.Model):
         unique_together = ('vle_course_id', 'vle_group_id',)
 
 
-def expand_user_group_course_ids_to_user_ids(delimiter, user_ids, group_ids, course_ids):
+class StagedCourseKVStore(models.Model):
+    """
+    staging tables hold a snapshot of Moodle's data during a staged full sync, before being swapped in
+    """
+    vle_course_id = models.CharField(max_length=100, unique=True)
+    name = models.CharField(max_length=255)
+
+
+class StagedGroupKVStore(models.Model):
+    vle_course_id = models.CharField(max_length=100)
+    vle_group_id = models.CharField(max_length=100)
+    name = models.CharField(max_length=255)
+
+    class Meta:
+        unique_together = ('vle_course_id', 'vle_group_id',)
+
+
+class StagedCourseMember(models.Model):
+    user_id = models.IntegerField()
+    vle_course_id = models.CharField(max_length=100)
+    is_tutor = models.BooleanField(default=False)
+
+    class Meta:
+        unique_together = ('user_id', 'vle_course_id',)
+
+
+class StagedGroupMember(models.Model):
+    user_id = models.IntegerField()
+    vle_course_id = models.CharField(max_length=100)
+    vle_group_id = models.CharField(max_length=100)
+
+    class Meta:
+        unique_together = ('user_id', 'vle_course_id', 'vle_group_id',)
+
+
+@python_2_unicode_compatible
+class SyncState(models.Model):
+    name = models.CharField(max_length=100, unique=True)
+    value = models.CharField(max_length=255)
+    modified = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        t = (
+            self.name,
+            self.value,
+        )
+        return u'sync state "%s" has value "%s"' % t
+
+    @classmethod
+    def get_value(cls, name, default=None):
+        """
+        returns the value of the named piece of sync state, or the given default if it has never been set
+        """
+        try:
+            return cls.objects.get(name=name).value
+        except cls.DoesNotExist:
+            return default
+
+    @classmethod
+    def set_value(cls, name, value):
+        cls.objects.update_or_create(name=name, defaults={'value': value})
+
+
+@python_2_unicode_compatible
+class SyncRun(models.Model):
+    """
+    a sync, with what it did and what it cost, so that trends can be seen over time
+    a resumable full sync also records the checkpoints (each a section and a partition of courses) it has applied so far,
+    so that if it fails, a rerun against the same Moodle snapshot can continue from where it got to
+    a dry run (which writes nothing else) is recorded too, so that what it would have done can be seen once it has finished
+    """
+    FULL = 'full'
+    DELTA = 'delta'
+    KIND_CHOICES = (
+        (FULL, 'Full'),
+        (DELTA, 'Delta'),
+    )
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (RUNNING, 'Running'),
+        (SUCCEEDED, 'Succeeded'),
+        (FAILED, 'Failed'),
+    )
+
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES, default=FULL)
+    started = models.DateTimeField(auto_now_add=True, db_index=True)
+    finished = models.DateTimeField(null=True, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=RUNNING)
+    dry_run = models.BooleanField(default=False)
+    snapshot = models.CharField(max_length=64, blank=True, default='')
+    checkpoints = models.TextField(blank=True, default='')
+    total = models.PositiveIntegerField(default=0)
+    resumed_from = models.ForeignKey('self', null=True, blank=True)
+    error = models.TextField(blank=True, default='')
+    payload_bytes = models.BigIntegerField(default=0)
+    rows = models.TextField(blank=True, default='')
+    queries = models.PositiveIntegerField(default=0)
+    peak_rss = models.PositiveIntegerField(null=True, blank=True, help_text='In kilobytes')
+    phase = models.CharField(max_length=10, blank=True, default='')
+    processed = models.PositiveIntegerField(default=0)
+    expected = models.PositiveIntegerField(null=True, blank=True)
+    summary = models.TextField(blank=True, default='')
+
+    def __str__(self):
+        t = (
+            self.kind,
+            self.started,
+            self.status,
+            len(self.get_checkpoints()),
+            self.total,
+        )
+        return u'%s sync run started %s %s (%d of %d checkpoints)' % t
+
+    @property
+    def duration(self):
+        """
+        returns how long the run took, in seconds, or None if it hasn't finished
+        """
+        if self.finished is None:
+            return None
+        return (self.finished - self.started).total_seconds()
+
+    def get_rows(self):
+        """
+        returns a dict of section to a dict of how many rows were created, updated, deleted and skipped
+        """
+        return json.loads(self.rows) if self.rows else {}
+
+    def get_checkpoints(self):
+        return self.checkpoints.split()
+
+    def add_checkpoint(self, checkpoint):
+        self.checkpoints = ' '.join(self.get_checkpoints() + [checkpoint])
+        self.save(update_fields=['checkpoints'])
+
+    def finish(self, error=None, report=None):
+        """
+        records that the run has finished (or failed with the given error), along with the metrics and summary of the given report
+        """
+        self.finished = timezone.now()
+        self.status = self.FAILED if error else self.SUCCEEDED
+        self.error = error or ''
+        update_fields = ['finished', 'status', 'error']
+        if report is not None:
+            self.payload_bytes = report.payload_bytes
+            self.rows = json.dumps(report.counts)
+            self.queries = sum(report.queries.values())
+            self.peak_rss = get_peak_rss()
+            self.processed, self.expected = report.processed, report.expected
+            self.summary = '\n'.join(report.lines())
+            update_fields += ['payload_bytes', 'rows', 'queries', 'peak_rss', 'processed', 'expected', 'summary']
+        self.phase = ''
+        self.save(update_fields=update_fields + ['phase'])
+
+    def save_progress(self, report):
+        """
+        records the current phase of the given report, and how many items it has processed (of how many, if known)
+        """
+        self.phase, self.processed, self.expected = report.current or '', report.processed, report.expected
+        self.save(update_fields=['phase', 'processed', 'expected'])
+
+    def get_status(self):
+        """
+        returns a dict of the run's status and progress, with its throughput in items per second
+        """
+        seconds = ((self.finished or timezone.now()) - self.started).total_seconds()
+        return {
+            'id': self.pk,
+            'status': self.status,
+            'phase': self.phase,
+            'processed': self.processed,
+            'expected': self.expected,
+            'seconds': seconds,
+            'rowsPerSecond': self.processed / seconds if seconds > 0 else 0,
+            'error': self.error,
+            'dryRun': self.dry_run,
+            'summary': self.summary,
+        }
+
+
+@python_2_unicode_compatible
+class SyncLease(models.Model):
+    """
+    a lock on syncing, held until it is released or it expires (as it will if its holder dies without releasing it)
+    """
+    name = models.CharField(max_length=100, unique=True)
+    holder = models.CharField(max_length=255)
+    acquired = models.DateTimeField()
+    expires = models.DateTimeField()
+    run = models.ForeignKey(SyncRun, null=True, blank=True, on_delete=models.SET_NULL)
+
+    def __str__(self):
+        t = (
+            self.name,
+            self.holder,
+            self.expires,
+        )
+        return u'sync lease "%s" held by "%s" until %s' % t
+
+
+@python_2_unicode_compatible
+class RecipientVersion(models.Model):
+    """
+    the version of something expanded recipients depend on (everything, the users, or a course), which changes
+    whenever it's written to (see recipients.py)
+    """
+    name = models.CharField(max_length=110, unique=True)
+    version = models.CharField(max_length=32)
+
+    def __str__(self):
+        t = (
+            self.name,
+            self.version,
+        )
+        return u'recipient version of "%s" is "%s"' % t
+
+
+def purge_courses(vle_course_ids, batch_size=None):
+    """
+    deletes the given courses and everything in them (their groups, and course and group memberships) in one transaction,
+    with one raw DELETE per model per batch of course ids, so no rows are loaded to be deleted
+    returns a dict of each model to the number of its rows deleted
+    """
+    qn = connection.ops.quote_name
+    deleted = OrderedDict((model, 0) for model in (CourseMember, GroupMember, GroupKVStore, CourseKVStore,))
+    with transaction.atomic(), connection.cursor() as cursor:
+        for chunk in chunks(vle_course_ids, batch_size or get_batch_size()):
+            for model in deleted:
+                cursor.execute('DELETE FROM %s WHERE %s IN (%s)' % (
+                    qn(model._meta.db_table), qn('vle_course_id'), ', '.join(['%s'] * len(chunk)),
+                ), chunk)
+                deleted[model] += cursor.rowcount
+    return deleted
+
+
+def expand_user_group_course_ids_to_user_ids(delimiter, user_ids, group_ids, course_ids, is_tutor=None, exclude_user_ids=()):
+    """
+    gets all the users in the given groups and courses (and the given users), deduplicated and sorted
+    by the database, with one query (unless there are more ids than can be given in one, see get_recipient_queries)
+    if is_tutor is given, only the members who are (or aren't) tutors, and never the excluded users
+    the result is cached until any of the courses it depends on is written to (see recipients.py),
+    or with the VLE_RECIPIENTS_INDEX setting, merged from the membership index (see index.py) instead
+    """
+    user_ids, group_ids, course_ids, pairs, exclude_user_ids = _normalise(delimiter, user_ids, group_ids, course_ids, exclude_user_ids)
+    if getattr(settings, 'VLE_RECIPIENTS_INDEX', False):
+        from .index import membership_index
+        result = membership_index.expand(user_ids, pairs, course_ids, is_tutor, exclude_user_ids)
+        if result is not None:
+            return result
+    affected = set(course_ids).union(c for c, g in pairs)
+    return recipient_cache.get(
+        [user_ids, pairs, course_ids, is_tutor, exclude_user_ids],
+        sorted(affected),
+        lambda: _expand(delimiter, user_ids, group_ids, course_ids, is_tutor, exclude_user_ids)
+    )
+
+
+def count_recipients(delimiter, user_ids, group_ids, course_ids, is_tutor=None, exclude_user_ids=()):
+    """
+    returns how many users expand_user_group_course_ids_to_user_ids would, counted by the database (or the membership index)
+    without the ids being fetched, and cached in the same way
+    """
+    user_ids, group_ids, course_ids, pairs, exclude_user_ids = _normalise(delimiter, user_ids, group_ids, course_ids, exclude_user_ids)
+    if getattr(settings, 'VLE_RECIPIENTS_INDEX', False):
+        from .index import membership_index
+        result = membership_index.count(user_ids, pairs, course_ids, is_tutor, exclude_user_ids)
+        if result is not None:
+            return result
+
+    def count():
+        queries = None
+        if len(exclude_user_ids) < get_batch_size():
+            queries = get_recipient_queries(delimiter, user_ids, group_ids, course_ids, is_tutor=is_tutor, exclude_user_ids=exclude_user_ids)
+        if queries is None or len(queries) > 1:
+            # the queries may overlap, so their ids are merged rather than their counts added up
+            # (as they are if there are too many excluded users to leave out in the database)
+            return sum(len(batch) for batch in iter_expand_user_group_course_ids_to_user_ids(
+                delimiter, user_ids, group_ids, course_ids, is_tutor=is_tutor, exclude_user_ids=exclude_user_ids
+            ))
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT COUNT(DISTINCT user_id) FROM (%s) recipients' % queries[0][0], queries[0][1])
+            return cursor.fetchone()[0]
+
+    affected = set(course_ids).union(c for c, g in pairs)
+    return recipient_cache.get(
+        ['count', user_ids, pairs, course_ids, is_tutor, exclude_user_ids], sorted(affected), count
+    )
+
+
+def is_recipient(user_id, delimiter, user_ids, group_ids, course_ids, is_tutor=None, exclude_user_ids=()):
+    """
+    returns whether expand_user_group_course_ids_to_user_ids would return the given user, asked of the database
+    (or the membership index) with EXISTS, and cached in the same way
+    """
+    user_ids, group_ids, course_ids, pairs, exclude_user_ids = _normalise(delimiter, user_ids, group_ids, course_ids, exclude_user_ids)
+    if user_id in exclude_user_ids:
+        return False
+    if user_id in user_ids:
+        return True
+    if getattr(settings, 'VLE_RECIPIENTS_INDEX', False):
+        from .index import membership_index
+        result = membership_index.contains(user_id, pairs, course_ids, is_tutor)
+        if result is not None:
+            return result
+
+    def exists():
+        # neither the exclusions nor the given users matter, having already been checked
+        queries = get_recipient_queries(delimiter, [], group_ids, course_ids, batch_size=max(1, get_batch_size() - 1), is_tutor=is_tutor)
+        with connection.cursor() as cursor:
+            for sql, params in queries:
+                cursor.execute('SELECT EXISTS (SELECT 1 FROM (%s) recipients WHERE user_id = %%s)' % sql, params + [user_id])
+                if cursor.fetchone()[0]:
+                    return True
+        return False
+
+    affected = set(course_ids).union(c for c, g in pairs)
+    return recipient_cache.get(['is_recipient', user_id, pairs, course_ids, is_tutor], sorted(affected), exists)
+
+
+def iter_expand_user_group_course_ids_to_user_ids(delimiter, user_ids, group_ids, course_ids, batch_size=None, is_tutor=None, exclude_user_ids=()):
+    """
+    yields the same users as expand_user_group_course_ids_to_user_ids, in sorted, deduplicated lists of (at most)
+    batch_size ids, so that they can be sent to before they've all been expanded
+    each list is merged from the given users and a page of each query, after the last id of the one before
+    (or is a slice of the membership index), so only about a page per query is held at once, and nothing is cached
+    """
+    batch_size = batch_size or get_batch_size()
+    user_ids, group_ids, course_ids, pairs, exclude_user_ids = _normalise(delimiter, user_ids, group_ids, course_ids, exclude_user_ids)
+    ids = None
+    if getattr(settings, 'VLE_RECIPIENTS_INDEX', False):
+        from .index import membership_index
+        ids = membership_index.iterate(user_ids, pairs, course_ids, is_tutor, exclude_user_ids)
+    if ids is None:
+        queries = _get_recipient_selects(delimiter, [], group_ids, course_ids, get_batch_size(), is_tutor, paged=True)
+        excluded = set(exclude_user_ids)
+        ids = merge([[user_id for user_id in user_ids if user_id not in excluded]] + [
+            _paginate(selects, batch_size, exclude_user_ids) for selects in queries
+        ])
+    for chunk in chunks(ids, batch_size):
+        yield chunk
+
+
+def _paginate(selects, batch_size, exclude_user_ids=()):
+    """
+    yields the distinct user ids of the given SELECTs (see _get_recipient_selects) in order, but for the excluded,
+    a page at a time, in which each SELECT reads at most batch_size distinct ids after the last id of the page before,
+    so a page costs about the same however far in it is
+    a page only goes as far as the lowest last id of the SELECTs that filled theirs, as beyond it, ids of those SELECTs
+    are yet to be read (and the excluded users are left out here, so as not to change where that is)
+    """
+    exclude_user_ids = set(exclude_user_ids)
+    last = None
+    while True:
+        sql, params = _page(selects, last, batch_size)
+        pages = [[] for select in selects]
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            for user_id, i in cursor.fetchall():
+                pages[i].append(user_id)
+        full = [max(page) for page in pages if len(page) == batch_size]
+        last = min(full) if full else None
+        for user_id in sorted(set(user_id for page in pages for user_id in page if last is None or user_id <= last)):
+            if user_id not in exclude_user_ids:
+                yield user_id
+        if last is None:
+            return
+
+
+def _normalise(delimiter, user_ids, group_ids, course_ids, exclude_user_ids=()):
+    """
+    returns the given ids deduplicated and sorted (leaving out group ids without the delimiter),
+    the (vle_course_id, vle_group_id) pair of each group, and the excluded user ids deduplicated and sorted
+    """
+    user_ids = sorted(set(user_ids))
+    group_ids = sorted(set(group_id for group_id in group_ids if delimiter in group_id))
+    course_ids = sorted(set(force_text(course_id) for course_id in course_ids))
+    exclude_user_ids = sorted(set(exclude_user_ids))
+    return user_ids, group_ids, course_ids, [group_id.split(delimiter)[:2] for group_id in group_ids], exclude_user_ids
+
+
+def _expand(delimiter, user_ids, group_ids, course_ids, is_tutor=None, exclude_user_ids=()):
+    # too many excluded users to leave out in the database are left out here instead
+    excluded = set(exclude_user_ids) if len(exclude_user_ids) >= get_batch_size() else None
+    if excluded is not None:
+        exclude_user_ids = ()
+    results = []
+    with connection.cursor() as cursor:
+        queries = get_recipient_queries(delimiter, user_ids, group_ids, course_ids, is_tutor=is_tutor, exclude_user_ids=exclude_user_ids)
+        for sql, params in queries:
+            # a query of only one SELECT isn't deduplicated by a UNION
+            cursor.execute('SELECT DISTINCT user_id FROM (%s) recipients ORDER BY user_id' % sql, params)
+            results.append([row[0] for row in cursor.fetchall()])
+    if len(results) == 1:
+        result = results[0]
+    else:
+        result = sorted(set(user_id for result in results for user_id in result))
+    if excluded is not None:
+        result = [user_id for user_id in result if user_id not in excluded]
+    return result
+
+
+def get_recipient_queries(delimiter, user_ids, group_ids, course_ids, batch_size=None, is_tutor=None, exclude_user_ids=()):
+    """
+    returns a list of (sql, params) pairs, each a UNION of SELECTs of the distinct user_id of the given users (as literals), of the members
+    of the given groups (each a vle_course_id and vle_group_id joined by the delimiter) and of the members of the given courses
+    group pairs are joined against rather than ORed together, and the ids are split into as few queries as there can be,
+    each with at most batch_size parameters (or one, if there are no ids)
+    if is_tutor is given, course members are filtered on it, as are group members, joined against their membership of the course,
+    and the excluded users are left out of every query, so there must be fewer of them than batch_size (or ValueError is raised)
+    """
+    batch_size = batch_size or get_batch_size()
+    exclude_user_ids = list(exclude_user_ids)
+    if len(exclude_user_ids) >= batch_size:
+        raise ValueError('There must be fewer excluded users than batch_size (%d), not %d' % (batch_size, len(exclude_user_ids)))
+    size = max(1, batch_size - len(exclude_user_ids))
+    queries = [_union(selects) for selects in _get_recipient_selects(delimiter, user_ids, group_ids, course_ids, size, is_tutor)]
+    if not queries:
+        return [('SELECT user_id FROM %s WHERE 1 = 0' % connection.ops.quote_name(CourseMember._meta.db_table), [])]
+
+    if exclude_user_ids:
+        queries = [
+            ('SELECT user_id FROM (%s) included WHERE user_id NOT IN (%s)' % (sql, _placeholders(exclude_user_ids)), params + exclude_user_ids)
+            for sql, params in queries
+        ]
+    return queries
+
+
+def _get_recipient_selects(delimiter, user_ids, group_ids, course_ids, size, is_tutor=None, paged=False):
+    """
+    returns the SELECTs of get_recipient_queries, as a list of each query's, with at most size parameters between them
+    each SELECT is a (tables, conditions, params, column) tuple, of what it selects from, conditions to be ANDed together
+    and the column of its user id, or whose params are the given users if it has no column
+    if paged, every SELECT (but of the given users) is left a parameter for the last id of the page before (see _page)
+    """
+    qn = connection.ops.quote_name
+    role = [] if is_tutor is None else [is_tutor]
+    last = 1 if paged else 0
+    selects = []
+
+    # the given users, as they are
+    for chunk in chunks(user_ids, size):
+        selects.append((None, [], list(chunk), None))
+
+    # the members of each group, joined against a derived table of (vle_course_id, vle_group_id) pairs
+    # (and against the members of their course who have the role)
+    table = qn(GroupMember._meta.db_table)
+    course_table = qn(CourseMember._meta.db_table)
+    for chunk in chunks([group_id.split(delimiter)[:2] for group_id in group_ids if delimiter in group_id], max(1, (size - len(role) - last) // 2)):
+        pairs = ' UNION ALL '.join(['SELECT %s AS vle_course_id, %s AS vle_group_id'] * len(chunk))
+        sql = '%s JOIN (%s) pairs ON %s.vle_course_id = pairs.vle_course_id AND %s.vle_group_id = pairs.vle_group_id' % (
+            table, pairs, table, table,
+        )
+        conditions = []
+        if role:
+            sql += ' JOIN %s ON %s.user_id = %s.user_id AND %s.vle_course_id = %s.vle_course_id' % (
+                course_table, course_table, table, course_table, table,
+            )
+            conditions.append('%s.is_tutor = %%s' % course_table)
+        selects.append((sql, conditions, [id for pair in chunk for id in pair] + role, '%s.user_id' % table))
+
+    # the members of each course (who have the role)
+    for chunk in chunks(course_ids, max(1, size - len(role) - last)):
+        conditions = ['vle_course_id IN (%s)' % _placeholders(chunk)] + (['is_tutor = %s'] if role else [])
+        selects.append((course_table, conditions, list(chunk) + role, 'user_id'))
+
+    # as many SELECTs per query as there are parameters for
+    queries, query, count = [], [], 0
+    for select in selects:
+        n = len(select[2]) + (last if select[3] else 0)
+        if query and count + n > size:
+            queries.append(query)
+            query, count = [], 0
+        query.append(select)
+        count += n
+    if query:
+        queries.append(query)
+    return queries
+
+
+def _union(selects):
+    """
+    returns the (sql, params) of a UNION of the given SELECTs (see _get_recipient_selects)
+    """
+    sqls, params = [], []
+    for tables, conditions, p, column in selects:
+        if column is None:
+            sqls.append(' UNION '.join(['SELECT %s AS user_id'] * len(p)))
+        else:
+            sqls.append(_select(tables, conditions, column))
+        params.extend(p)
+    return ' UNION '.join(sqls), params
+
+
+def _page(selects, last, limit):
     """
-    gets all the users in the given groups and courses
+    returns the (sql, params) of a UNION ALL of a page of each of the given SELECTs (see _get_recipient_selects),
+    i.e. its first limit distinct user ids after last (if given), alongside the SELECT's index
+    so that paging reads (via the index on the user id, if there is one) only as much of each SELECT as a page could need
     """
+    sqls, params = [], []
+    for i, (tables, conditions, p, column) in enumerate(selects):
+        if last is not None:
+            conditions, p = conditions + ['%s > %%s' % column], p + [last]
+        sqls.append('SELECT user_id, %d AS part FROM (%s ORDER BY user_id LIMIT %d) page' % (
+            i, _select(tables, conditions, column, distinct=True), limit,
+        ))
+        params.extend(p)
+    return ' UNION ALL '.join(sqls), params
 
-    # start off with a list of user_ids
-    ids = []
-    ids.extend(user_ids)
 
-    # for groups, append each user in each group
-    if group_ids:
-        group_ids = map(lambda x: x.split(delimiter), group_ids)
-        ids.extend(GroupMember.objects.filter(GroupMember.get_groups_filter(group_ids)).values_list('user__id', flat=True))
+def _select(tables, conditions, column, distinct=False):
+    sql = 'SELECT %s%s AS user_id FROM %s' % ('DISTINCT ' if distinct else '', column, tables)
+    if conditions:
+        sql += ' WHERE ' + ' AND '.join(conditions)
+    return sql
 
-    # for courses, append each user in each course
-    if course_ids:
-        ids.extend(CourseMember.objects.filter(vle_course_id__in=course_ids).values_list('user__id', flat=True))
 
-    # return user ids
-    return sorted(set(ids))
+def _placeholders(values):
+    return ', '.join(['%s'] * len(values))
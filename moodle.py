@@ -0,0 +1,160 @@
+import io
+import json
+from types import GeneratorType
+
+from django.conf import settings
+from django.utils.translation import gettext as _
+
+import requests
+from requests.packages.urllib3.util.retry import Retry
+
+from .models import SyncState
+from .snapshot import is_snapshot, iter_snapshot_json, read_snapshot
+
+ETAG = 'etag'
+LAST_MODIFIED = 'last_modified'
+
+
+class SyncError(Exception):
+    """
+    raised with the error message returned by Moodle
+    """
+    pass
+
+
+class NotModified(Exception):
+    """
+    raised when Moodle says the data hasn't changed since the last conditional request was synced
+    """
+    pass
+
+
+class MoodleClient(object):
+    """
+    requests data from Moodle's local/messaging endpoint over a pool of keep-alive connections,
+    negotiating compression and with connect and read timeouts (the VLE_SYNC_CONNECT_TIMEOUT and VLE_SYNC_READ_TIMEOUT settings)
+    a conditional request sends the validators (ETag and Last-Modified) of the last one synced, and raises NotModified on a 304;
+    the validators of its response are only stored by remember(), once its data has been synced
+    """
+
+    def __init__(self, pool_size=None):
+        pool_size = pool_size or getattr(settings, 'VLE_SYNC_FETCH_WORKERS', 4)
+        self.url = '%s/local/messaging/' % settings.MOODLEWWWROOT
+        self.timeout = (
+            getattr(settings, 'VLE_SYNC_CONNECT_TIMEOUT', 5),
+            getattr(settings, 'VLE_SYNC_READ_TIMEOUT', 300),
+        )
+        self.validators = None
+        self.session = requests.Session()
+        self.session.auth = settings.VLE_SYNC_BASIC_AUTH
+        self.session.headers['Accept-Encoding'] = 'gzip, deflate'
+        adapter = requests.adapters.HTTPAdapter(
+            pool_maxsize=pool_size,
+            # a read timeout isn't retried, as the request has probably already cost Moodle a lot;
+            # once the retries are used up, the last response is returned for its error message
+            max_retries=Retry(total=3, read=False, backoff_factor=0.5, status_forcelist=(502, 503, 504,), raise_on_status=False)
+        )
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def get(self, params=None, stream=False, conditional=False):
+        """
+        returns Moodle's (successful) response to a request with the given parameters
+        raises SyncError with Moodle's error message, or if it times out or can't be reached
+        """
+        headers = {}
+        if conditional:
+            etag, last_modified = SyncState.get_value(ETAG), SyncState.get_value(LAST_MODIFIED)
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+        try:
+            response = self.session.get(self.url, params=params or {}, stream=stream, headers=headers, timeout=self.timeout)
+        except requests.exceptions.Timeout as e:
+            raise SyncError(_('Moodle timed out: %s') % e)
+        except requests.exceptions.ConnectionError as e:
+            raise SyncError(_('Moodle could not be reached: %s') % e)
+        if response.status_code == 304:
+            raise NotModified()
+        if response.status_code != 200:
+            try:
+                message = response.json()['errorMessage']
+            except (ValueError, KeyError, TypeError):
+                # e.g. a proxy's error page
+                message = _('Moodle responded with status %d') % response.status_code
+            raise SyncError(message)
+        if conditional:
+            self.validators = (response.headers.get('ETag', ''), response.headers.get('Last-Modified', ''))
+        return response
+
+    def remember(self):
+        """
+        stores the validators of the last conditional response, for the next conditional request to send
+        """
+        if self.validators is not None:
+            etag, last_modified = self.validators
+            SyncState.set_value(ETAG, etag)
+            SyncState.set_value(LAST_MODIFIED, last_modified)
+
+    def close(self):
+        self.session.close()
+
+
+class FileClient(object):
+    """
+    stands in for MoodleClient, answering every request with a payload (or a snapshot) saved to a file
+    (so sections are filtered by course after the fact, and there is only ever one page)
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def get(self, params=None, stream=False, conditional=False):
+        if is_snapshot(self.path):
+            return _SnapshotResponse(self.path)
+        return _FileResponse(self.path)
+
+    def remember(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class _FileResponse(object):
+    """
+    the parts of a requests response that syncing uses, read from a file
+    """
+    status_code = 200
+
+    def __init__(self, path):
+        self.path = path
+        self._content = None
+
+    @property
+    def content(self):
+        if self._content is None:
+            with io.open(self.path, 'rb') as f:
+                self._content = f.read()
+        return self._content
+
+    def json(self):
+        return json.loads(self.content.decode('utf-8'))
+
+    def iter_content(self, chunk_size=1):
+        with io.open(self.path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                yield chunk
+
+
+class _SnapshotResponse(_FileResponse):
+    """
+    the parts of a requests response that syncing uses, presenting a snapshot as a JSON payload
+    """
+
+    def json(self):
+        return {key: list(value) if isinstance(value, GeneratorType) else value for key, value in read_snapshot(self.path)}
+
+    def iter_content(self, chunk_size=1):
+        return iter_snapshot_json(self.path, chunk_size)
@@ -0,0 +1,114 @@
+import codecs
+import json
+import numbers
+
+
+# the characters a JSON number can go on with
+_NUMBER_CHARS = u'0123456789.eE+-'
+
+
+def _is_number(value):
+    return isinstance(value, numbers.Number) and not isinstance(value, bool)
+
+
+class _Buffer(object):
+    """
+    a text buffer over an iterable of byte chunks, refilled on demand
+    """
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.text = u''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        """
+        reads another chunk into the buffer, returning False if there are no more
+        """
+        if self.eof:
+            return False
+        try:
+            chunk = next(self.chunks)
+        except StopIteration:
+            self.eof = True
+            chunk = b''
+        # drop what has already been consumed so the buffer stays the size of a chunk or two
+        self.text = self.text[self.pos:] + self.decoder.decode(chunk, final=self.eof)
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """
+        skips whitespace and returns the next character (or an empty string at the end of the input)
+        """
+        while True:
+            while self.pos < len(self.text) and self.text[self.pos] in u' \t\r\n':
+                self.pos += 1
+            if self.pos < len(self.text) or not self.fill():
+                return self.text[self.pos:self.pos + 1]
+
+    def expect(self, c):
+        if self.peek() != c:
+            raise ValueError('Expecting %r at offset %d of the current chunk' % (c, self.pos))
+        self.pos += 1
+
+    def decode(self, decoder):
+        """
+        decodes the next JSON value, reading more chunks until it is complete
+        a value has to be followed by something (or the end of the input) to be complete, and a number by something
+        that couldn't be more of it, otherwise it could be cut short (e.g. 26864.17 read as 26864 up to the end of a chunk)
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = decoder.raw_decode(self.text, self.pos)
+                if self.eof or (end < len(self.text) and not (_is_number(value) and self.text[end] in _NUMBER_CHARS)):
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            self.fill()
+
+
+def iter_sections(chunks):
+    """
+    incrementally parses a JSON object read from the given iterable of byte chunks (e.g. response.iter_content())
+    yields a (key, value) pair for each of its members, where an array value is a generator of its items
+    each generator must be consumed (or abandoned) before the next pair is requested, as with itertools.groupby
+    so that no more than one item (plus a chunk) is ever held in memory
+    """
+    buf = _Buffer(chunks)
+    decoder = json.JSONDecoder()
+    buf.expect(u'{')
+    if buf.peek() == u'}':
+        return
+    while True:
+        key = buf.decode(decoder)
+        buf.expect(u':')
+        if buf.peek() == u'[':
+            buf.pos += 1
+            items = _iter_items(buf, decoder)
+            yield key, items
+            # drain whatever the consumer didn't read
+            for _ in items:
+                pass
+        else:
+            yield key, buf.decode(decoder)
+        if buf.peek() == u'}':
+            return
+        buf.expect(u',')
+
+
+def _iter_items(buf, decoder):
+    if buf.peek() == u']':
+        buf.pos += 1
+        return
+    while True:
+        yield buf.decode(decoder)
+        if buf.peek() == u']':
+            buf.pos += 1
+            return
+        buf.expect(u',')
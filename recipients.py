@@ -0,0 +1,114 @@
+import hashlib
+import json
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import IntegrityError, transaction
+from django.utils.encoding import force_text
+
+from .utils import chunks, get_batch_size
+
+ALL = 'all'
+
+# the version of everything while a sync is writing, when nothing is cached
+SYNCING = 'syncing'
+
+
+def _course_version_name(vle_course_id):
+    return 'course:%s' % force_text(vle_course_id)
+
+
+class RecipientCache(object):
+    """
+    caches expanded recipients in the Django cache with the given alias, keyed on what was expanded and the versions
+    of what it depends on: each course it is in, and everything
+    versions are kept in the database (see RecipientVersion), where they're never culled, and a write bumps the versions
+    it affects after (or in the same transaction as) writing, so every process sees it as soon as it commits
+    while a sync is writing, nothing is cached at all
+    without an alias, nothing is cached (nor versioned), and a timeout of zero turns caching off (but not versioning)
+    """
+
+    def __init__(self, alias=None, timeout=300):
+        self.alias = alias
+        self.timeout = timeout
+        self._cache = None
+
+    @property
+    def cache(self):
+        if self._cache is None and self.alias:
+            self._cache = caches[self.alias]
+        return self._cache
+
+    @property
+    def versioned(self):
+        return bool(self.alias)
+
+    def get(self, key, course_ids, expand):
+        """
+        returns the (cached) result of calling expand, for the given JSON-serialisable key, which depends on the given courses
+        """
+        if not self.alias or not self.timeout:
+            return expand()
+        versions = self.get_versions(course_ids)
+        if versions is None:
+            return expand()
+        k = 'vle:recipients:%s' % hashlib.sha1(json.dumps([key, versions]).encode('utf-8')).hexdigest()
+        result = self.cache.get(k)
+        if result is None:
+            result = expand()
+            self.cache.set(k, result, self.timeout)
+        return result
+
+    def get_versions(self, course_ids):
+        """
+        returns the versions of everything and the given courses (with one query per batch of them),
+        or None if they can't be relied on (e.g. while a sync is writing, or without versioning)
+        something that's never been written to has the version ''
+        """
+        if not self.versioned:
+            return None
+        from .models import RecipientVersion
+        names = [ALL] + [_course_version_name(c) for c in course_ids]
+        versions = {}
+        for chunk in chunks(names, get_batch_size()):
+            versions.update(RecipientVersion.objects.filter(name__in=chunk).values_list('name', 'version'))
+        if versions.get(ALL) == SYNCING:
+            return None
+        return [versions.get(name, '') for name in names]
+
+    def invalidate(self, course_ids=None):
+        """
+        bumps the versions of the given courses, or of everything
+        """
+        self._set([ALL] if course_ids is None else [_course_version_name(c) for c in course_ids], uuid.uuid4().hex)
+
+    def start_sync(self):
+        """
+        stops anything being cached until the sync finishes and invalidates everything
+        """
+        self._set([ALL], SYNCING)
+
+    def _set(self, names, version):
+        if not self.versioned:
+            return
+        from .models import RecipientVersion
+        for chunk in chunks(sorted(set(names)), get_batch_size()):
+            if RecipientVersion.objects.filter(name__in=chunk).update(version=version) == len(chunk):
+                continue
+            existing = set(RecipientVersion.objects.filter(name__in=chunk).values_list('name', flat=True))
+            for name in chunk:
+                if name in existing:
+                    continue
+                try:
+                    with transaction.atomic():
+                        RecipientVersion.objects.create(name=name, version=version)
+                except IntegrityError:
+                    # created by another process in the meantime
+                    RecipientVersion.objects.filter(name=name).update(version=version)
+
+
+recipient_cache = RecipientCache(
+    alias=getattr(settings, 'VLE_RECIPIENTS_CACHE', None),
+    timeout=getattr(settings, 'VLE_RECIPIENTS_CACHE_TIMEOUT', 300),
+)
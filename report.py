@@ -0,0 +1,155 @@
+import functools
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.backends.utils import CursorWrapper
+from django.utils.translation import gettext as _
+
+SECTIONS = ('course_kv_store', 'group_kv_store', 'course_member', 'group_member',)
+PHASES = ('fetch', 'parse', 'diff', 'apply',)
+ACTIONS = ('created', 'updated', 'deleted', 'skipped',)
+
+
+class _CountingCursor(CursorWrapper):
+    """
+    counts each query against the report's current phase, without the timing, formatting and logging of a debug cursor
+    """
+
+    def __init__(self, cursor, db, report):
+        super(_CountingCursor, self).__init__(cursor, db)
+        self.report = report
+
+    def _count(self):
+        if self.report.current is not None:
+            self.report.queries[self.report.current] += 1
+
+    def execute(self, sql, params=None):
+        self._count()
+        return super(_CountingCursor, self).execute(sql, params)
+
+    def executemany(self, sql, param_list):
+        self._count()
+        return super(_CountingCursor, self).executemany(sql, param_list)
+
+
+class SyncReport(object):
+    """
+    what a sync did (or, in a dry run, would have done) to each model, how many bytes of payload it read,
+    and the wall time and queries of each phase
+    the given progress callable, if any, is called with the report whenever rows have been counted
+    time (and queries) in a nested phase only count towards that phase, not the one it's nested in
+    """
+
+    def __init__(self, dry_run=False, progress=None):
+        self.dry_run = dry_run
+        self.progress = progress
+        self.counts = OrderedDict((key, OrderedDict((action, 0) for action in ACTIONS)) for key in SECTIONS)
+        self.unknown_usernames = set()
+        self.payload_bytes = 0
+        self.expected = None
+        self.timings = OrderedDict((phase, 0.0) for phase in PHASES)
+        self.queries = OrderedDict((phase, 0) for phase in PHASES)
+        self.current = None
+        self.started = time.time()
+
+    def count(self, key, action, n):
+        self.counts[key][action] += n
+        if self.progress is not None:
+            self.progress(self)
+
+    def expect(self, n):
+        """
+        adds to the number of items the payload is known to have
+        """
+        self.expected = (self.expected or 0) + n
+
+    @property
+    def processed(self):
+        """
+        returns the number of items diffed so far (deleted rows are orphans rather than items, so aren't included)
+        """
+        return sum(counts['created'] + counts['updated'] + counts['skipped'] for counts in self.counts.values())
+
+    @contextmanager
+    def phase(self, name):
+        previous, started = self.current, time.time()
+        self.current = name
+        try:
+            yield
+        finally:
+            elapsed = time.time() - started
+            self.timings[name] += elapsed
+            if previous is not None:
+                # the outer phase wasn't running while this one was
+                self.timings[previous] -= elapsed
+            self.current = previous
+
+    @contextmanager
+    def recording(self):
+        """
+        counts the queries made within each phase (on this thread's default connection), without keeping them
+        """
+        db = connections[DEFAULT_DB_ALIAS]
+        # even with DEBUG on, queries aren't logged while they're counted
+        names = ('make_cursor', 'make_debug_cursor',)
+        saved = dict((name, vars(db).get(name)) for name in names)
+        for name in names:
+            setattr(db, name, functools.partial(_CountingCursor, db=db, report=self))
+        try:
+            yield
+        finally:
+            for name in names:
+                if saved[name] is None:
+                    delattr(db, name)
+                else:
+                    setattr(db, name, saved[name])
+
+    def timed(self, name, iterable):
+        """
+        yields from the given iterable, counting the time spent producing each item towards the named phase
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def merge(self, other):
+        """
+        adds the counts, unknown usernames, payload bytes, timings and queries of another report (e.g. from a worker process) to this one
+        """
+        for key, counts in other.counts.items():
+            for action, n in counts.items():
+                self.counts[key][action] += n
+        self.unknown_usernames.update(other.unknown_usernames)
+        self.payload_bytes += other.payload_bytes
+        for phase in PHASES:
+            self.timings[phase] += other.timings[phase]
+            self.queries[phase] += other.queries[phase]
+
+    def lines(self):
+        """
+        returns a list of human-readable lines summarising the report
+        """
+        lines = []
+        for key, counts in self.counts.items():
+            t = dict(counts, section=key)
+            if self.dry_run:
+                lines.append(_('%(section)s: %(created)d to create, %(updated)d to update, %(deleted)d to delete') % t)
+            else:
+                lines.append(_('%(section)s: %(created)d created, %(updated)d updated, %(deleted)d deleted') % t)
+        if self.unknown_usernames:
+            lines.append(_('Unknown usernames: %s') % ', '.join(sorted(self.unknown_usernames)))
+        for phase in PHASES:
+            t = {
+                'phase': phase,
+                'seconds': self.timings[phase],
+                'queries': self.queries[phase],
+            }
+            lines.append(_('%(phase)s: %(seconds).3fs, %(queries)d queries') % t)
+        return lines
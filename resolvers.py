@@ -0,0 +1,85 @@
+from collections import OrderedDict
+from threading import Lock
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+
+from .utils import chunks, get_batch_size
+
+
+class UsernameResolver(object):
+    """
+    resolves usernames to user ids with chunked IN queries, optionally through a process-local LRU cache
+    the cache only holds known usernames, and is invalidated by user save and delete signals (see apps.py)
+    it's keyed by username, with a reverse map of user id to username so that a user can be forgotten without a scan
+    """
+
+    def __init__(self, cache_size=0, batch_size=None):
+        self.cache_size = cache_size
+        self.batch_size = batch_size
+        self.cache = OrderedDict()
+        self.usernames = {}
+        self.lock = Lock()
+
+    def resolve(self, usernames):
+        """
+        returns a (dict of username to user id, set of unknown usernames) pair for the given usernames
+        """
+        usernames = set(usernames)
+        user_ids = {}
+
+        # anything cached is most recently used
+        if self.cache_size:
+            with self.lock:
+                for username in usernames:
+                    if username in self.cache:
+                        user_ids[username] = self.cache.pop(username)
+                        self.cache[username] = user_ids[username]
+
+        # query for the rest
+        for chunk in chunks(usernames.difference(user_ids), self.batch_size or get_batch_size()):
+            found = dict(get_user_model().objects.filter(username__in=chunk).values_list('username', 'id'))
+            user_ids.update(found)
+            if self.cache_size:
+                with self.lock:
+                    for username, user_id in found.items():
+                        self._remember(username, user_id)
+                    while len(self.cache) > self.cache_size:
+                        self._forget(next(iter(self.cache)))
+
+        return user_ids, usernames.difference(user_ids)
+
+    def invalidate(self, user=None):
+        """
+        forgets the given user (under both its current username and any previous one), or everyone
+        """
+        with self.lock:
+            if user is None:
+                self.cache.clear()
+                self.usernames.clear()
+                return
+            self._forget(user.username)
+            if user.pk in self.usernames:
+                self._forget(self.usernames[user.pk])
+
+    def _remember(self, username, user_id):
+        """
+        caches the given user id as the most recently used (with the lock held)
+        """
+        if self.usernames.get(user_id, username) != username:
+            # it was renamed, so its previous username is stale
+            self._forget(self.usernames[user_id])
+        self._forget(username)
+        self.cache[username] = user_id
+        self.usernames[user_id] = username
+
+    def _forget(self, username):
+        """
+        removes the given username from the cache, if it's there (with the lock held)
+        """
+        user_id = self.cache.pop(username, None)
+        if user_id is not None and self.usernames.get(user_id) == username:
+            del self.usernames[user_id]
+
+
+resolver = UsernameResolver(cache_size=getattr(settings, 'VLE_USERNAME_CACHE_SIZE', 0))
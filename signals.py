@@ -0,0 +1,24 @@
+from .recipients import recipient_cache
+from .resolvers import resolver
+
+
+def user_changed(sender, instance, **kwargs):
+    """
+    a user was saved or deleted, so forget any username it was cached under
+    """
+    resolver.invalidate(instance)
+
+
+def member_saving(sender, instance, **kwargs):
+    """
+    a course or group member is about to be saved, so forget the recipients of the course it was in, if it's moving
+    """
+    if instance.pk is not None:
+        recipient_cache.invalidate(sender.objects.filter(pk=instance.pk).values_list('vle_course_id', flat=True))
+
+
+def member_changed(sender, instance, **kwargs):
+    """
+    a course or group member was saved or deleted, so forget the recipients of its course
+    """
+    recipient_cache.invalidate([instance.vle_course_id])
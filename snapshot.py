@@ -0,0 +1,181 @@
+"""
+snapshots of the four models in a compact, streaming format: gzipped lines of JSON, which are
+a header object (the format version, and the high-water mark if there is one),
+then for each section, an object naming it and its fields followed by an array of those fields' values for each item
+
+the items are as they would be in a Moodle payload (with usernames rather than user ids), so that a snapshot
+can be loaded on another node, or synced as if Moodle had returned it
+"""
+import functools
+import gzip
+import json
+from collections import OrderedDict
+from types import GeneratorType
+
+from django.db import connection, transaction
+from django.utils.encoding import force_text
+
+from .models import CourseKVStore, GroupKVStore, CourseMember, GroupMember, SyncState
+from .recipients import recipient_cache
+from .report import SECTIONS, SyncReport
+from .resolvers import resolver
+from .utils import chunks, get_batch_size
+
+VERSION = 1
+HIGH_WATER_MARK = 'high_water_mark'
+
+# the model of each section, its fields in a snapshot, and the model fields (or lookups) they are exported from
+_SECTIONS = OrderedDict((
+    ('course_kv_store', (CourseKVStore, ('vle_course_id', 'name',), ('vle_course_id', 'name',),)),
+    ('group_kv_store', (GroupKVStore, ('vle_course_id', 'vle_group_id', 'name',), ('vle_course_id', 'vle_group_id', 'name',),)),
+    ('course_member', (CourseMember, ('username', 'vle_course_id', 'is_tutor',), ('user__username', 'vle_course_id', 'is_tutor',),)),
+    ('group_member', (GroupMember, ('username', 'vle_course_id', 'vle_group_id',), ('user__username', 'vle_course_id', 'vle_group_id',),)),
+))
+
+
+def _line(value):
+    return (json.dumps(value, separators=(',', ':')) + '\n').encode('utf-8')
+
+
+def is_snapshot(path):
+    """
+    returns whether the given file is (or at least is gzipped like) a snapshot
+    """
+    with open(path, 'rb') as f:
+        return f.read(2) == b'\x1f\x8b'
+
+
+def dump_snapshot(path):
+    """
+    writes a snapshot of the four models to the given path, streaming each model from the database
+    """
+    write_snapshot(path, OrderedDict(
+        (key, model.objects.order_by('pk').values_list(*lookups).iterator())
+        for key, (model, fields, lookups) in _SECTIONS.items()
+    ), SyncState.get_value(HIGH_WATER_MARK))
+
+
+def write_snapshot(path, sections, high_water_mark=None):
+    """
+    writes a snapshot to the given path of the given dict of section key to iterable of rows
+    (each a sequence of the section's snapshot fields' values), consuming each iterable in turn
+    """
+    header = {'version': VERSION}
+    if high_water_mark is not None:
+        header[HIGH_WATER_MARK] = high_water_mark
+    with gzip.open(path, 'wb') as f:
+        f.write(_line(header))
+        for key, rows in sections.items():
+            f.write(_line({'section': key, 'fields': _SECTIONS[key][1]}))
+            for row in rows:
+                f.write(_line(row))
+
+
+def read_snapshot(path):
+    """
+    yields a (key, value) pair for the high-water mark (if any) and for each section of the snapshot at the given path,
+    where a section's value is a generator of its items
+    as with payload.iter_sections, each generator must be consumed (or abandoned) before the next pair is requested
+    """
+    with gzip.open(path, 'rb') as f:
+        lines = (json.loads(force_text(line)) for line in f)
+        header = next(lines)
+        if header.get('version') != VERSION:
+            raise ValueError('Unsupported snapshot version %r' % header.get('version'))
+        if HIGH_WATER_MARK in header:
+            yield HIGH_WATER_MARK, header[HIGH_WATER_MARK]
+        section = next(lines, None)
+        while section is not None:
+            following = []
+            items = _iter_items(lines, section['fields'], following)
+            yield section['section'], items
+            # drain whatever the consumer didn't read
+            for _ in items:
+                pass
+            section = following[0] if following else None
+
+
+def _iter_items(lines, fields, following):
+    """
+    yields each item of a section, stopping at the next section (which is appended to following)
+    """
+    for line in lines:
+        if isinstance(line, dict):
+            following.append(line)
+            return
+        yield dict(zip(fields, line))
+
+
+def iter_snapshot_json(path, chunk_size):
+    """
+    yields the snapshot at the given path as the bytes of a JSON payload, in chunks of about the given size,
+    without holding more than a chunk of it in memory
+    """
+    buf, size = [], 0
+    for piece in _iter_json(path):
+        buf.append(piece)
+        size += len(piece)
+        if size >= chunk_size:
+            yield b''.join(buf)
+            buf, size = [], 0
+    if buf:
+        yield b''.join(buf)
+
+
+def _iter_json(path):
+    yield b'{'
+    for i, (key, value) in enumerate(read_snapshot(path)):
+        if i:
+            yield b','
+        yield json.dumps(key).encode('utf-8') + b':'
+        if isinstance(value, GeneratorType):
+            yield b'['
+            for j, item in enumerate(value):
+                yield (b',' if j else b'') + json.dumps(item).encode('utf-8')
+            yield b']'
+        else:
+            yield json.dumps(value).encode('utf-8')
+    yield b'}'
+
+
+def load_snapshot(path, batch_size=None, report=None):
+    """
+    replaces the four models with the snapshot at the given path in one transaction, bulk creating each section
+    items with unknown usernames are skipped
+    what was done and how long it took is recorded in the given report, if any, which is returned
+    like a sync, it holds the sync lease, waiting for any sync in progress to finish first, so that they never overlap
+    """
+    # sync imports this module (through moodle)
+    from .sync import WAIT, _leased
+    return _leased(WAIT, functools.partial(_load_snapshot, path=path, batch_size=batch_size, report=report))
+
+
+def _load_snapshot(lease, path, batch_size, report):
+    """
+    does the work of load_snapshot, holding the given lease
+    """
+    batch_size = batch_size or get_batch_size()
+    report = report or SyncReport()
+    with report.recording(), transaction.atomic():
+        with report.phase('apply'), connection.cursor() as cursor:
+            for key in reversed(SECTIONS):
+                # without signals, so the rows aren't loaded
+                cursor.execute('DELETE FROM %s' % connection.ops.quote_name(_SECTIONS[key][0]._meta.db_table))
+                report.count(key, 'deleted', cursor.rowcount)
+        for key, value in report.timed('parse', read_snapshot(path)):
+            if key == HIGH_WATER_MARK:
+                SyncState.set_value(HIGH_WATER_MARK, force_text(value))
+                continue
+            model, fields = _SECTIONS[key][:2]
+            columns = ('user_id',) + fields[1:] if 'username' in fields else fields
+            for batch in chunks(report.timed('parse', value), batch_size):
+                if 'username' in fields:
+                    with report.phase('diff'):
+                        user_ids, unknown = resolver.resolve([item['username'] for item in batch])
+                    report.unknown_usernames.update(unknown)
+                    batch = [dict(item, user_id=user_ids[item['username']]) for item in batch if item['username'] in user_ids]
+                with report.phase('apply'):
+                    model.objects.bulk_create([model(**{c: item[c] for c in columns}) for item in batch], batch_size=batch_size)
+                report.count(key, 'created', len(batch))
+        recipient_cache.invalidate()
+    return report
@@ -1,107 +1,1080 @@
+import functools
+import hashlib
+import json
+import multiprocessing
+import zlib
+from collections import OrderedDict, defaultdict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from types import GeneratorType
+
 from django.conf import settings
-from django.contrib.auth import get_user_model
+from django.db import connection, connections, transaction
+from django.db.models import Case, CharField, Max, Q, Value, When
+from django.utils.encoding import force_text
 from django.utils.translation import gettext as _
 
-import requests
+from .lease import Lease
+from .models import CourseKVStore, GroupKVStore, CourseMember, GroupMember, SyncRun, SyncState, purge_courses
+from .models import StagedCourseKVStore, StagedGroupKVStore, StagedCourseMember, StagedGroupMember
+from .moodle import FileClient, MoodleClient, NotModified, SyncError
+from .payload import iter_sections
+from .recipients import recipient_cache
+from .report import SECTIONS, SyncReport
+from .resolvers import resolver
+from .utils import chunks, get_batch_size, setup_worker
+
+STREAM_CHUNK_SIZE = 64 * 1024
+HIGH_WATER_MARK = 'high_water_mark'
+
+# what to do if another sync is in progress
+WAIT = 'wait'
+ATTACH = 'attach'
+SKIP = 'skip'
+
+# the modes of a full sync, with their settings and defaults (course_ids has no setting)
+_MODES = (
+    ('course_ids', None, ()),
+    ('skip_unchanged', 'VLE_SYNC_SKIP_UNCHANGED', False),
+    ('partitions', 'VLE_SYNC_PARTITIONS', 1),
+    ('resumable', 'VLE_SYNC_RESUMABLE', False),
+    ('staged', 'VLE_SYNC_STAGED', False),
+    ('stream', 'VLE_SYNC_STREAM', False),
+    ('paged', 'VLE_SYNC_PAGED', False),
+    ('conditional', 'VLE_SYNC_CONDITIONAL', False),
+)
 
-from .models import CourseKVStore, GroupKVStore, CourseMember, GroupMember
+# the modes each mode can't be combined with, as it would ignore them
+_INCOMPATIBLE = {
+    'course_ids': ('skip_unchanged', 'partitions', 'resumable', 'staged', 'stream', 'paged', 'conditional',),
+    'skip_unchanged': ('partitions', 'resumable', 'staged', 'stream', 'paged', 'conditional',),
+    'partitions': ('resumable', 'staged', 'stream', 'paged',),
+    'resumable': ('staged', 'stream', 'paged',),
+    'paged': ('conditional',),
+}
 
 
-def full_sync():
-    # request all data requiring synchronization from Moodle
-    response = requests.get(
-        '%s/local/messaging/' % settings.MOODLEWWWROOT,
-        auth=settings.VLE_SYNC_BASIC_AUTH
+class IncompatibleModes(ValueError):
+    """
+    raised when a full sync is asked to combine modes that would ignore each other
+    """
+    pass
+
+
+def full_sync(stream=None, paged=None, staged=None, skip_unchanged=None, partitions=None, resumable=None, conditional=None,
+              course_ids=None, source=None, batch_size=None, on_busy=None, run=None, dry_run=False, report=None):
+    """
+    synchronizes all four models with Moodle
+    if course_ids are given, only those courses are synced (see _sync_courses)
+    if stream is true (it defaults to the VLE_SYNC_STREAM setting), the response is parsed incrementally as it is read,
+    so that peak memory doesn't depend on the size of the payload
+    if paged is true (it defaults to the VLE_SYNC_PAGED setting), each section is requested page by page, concurrently
+    if staged is true (it defaults to the VLE_SYNC_STAGED setting), the data is loaded into staging tables first
+    and then swapped in with a few set-based statements in one short transaction, so readers never see a half-synced state
+    if skip_unchanged is true (it defaults to the VLE_SYNC_SKIP_UNCHANGED setting), only courses whose digest has changed
+    are reconciled (see _sync_changed_courses)
+    if partitions (it defaults to the VLE_SYNC_PARTITIONS setting) is more than one, memberships are split by course
+    and reconciled by that many processes (see _sync_partitioned)
+    if resumable is true (it defaults to the VLE_SYNC_RESUMABLE setting), progress is checkpointed in a SyncRun, and a
+    rerun after a failure continues from the last checkpoint (see _sync_resumable), except that a dry run isn't resumable
+    if conditional is true (it defaults to the VLE_SYNC_CONDITIONAL setting), the whole sync is skipped if Moodle says
+    its data hasn't changed since the last one
+    course_ids, skip_unchanged, partitions and resumable each take the whole sync over, so IncompatibleModes (a ValueError)
+    is raised if modes that would ignore each other are combined (see _INCOMPATIBLE), whether given or set; a mode that's
+    given leaves the settings of those it's incompatible with out
+    if source is the path of a file holding a payload, it is synced instead of Moodle's
+    batch_size defaults to the VLE_SYNC_BATCH_SIZE setting
+    if dry_run is true, the diff is computed but nothing is written (staging included)
+    what was done (or would have been) and how long it took is recorded in the given report, if any,
+    and in the given SyncRun, or (unless it's a dry run) a new one
+    unless it's a dry run, the sync holds the sync lease, so that syncs never overlap; if another sync holds it,
+    on_busy (which defaults to the VLE_SYNC_ON_BUSY setting) says what to do (see _leased)
+    """
+    modes = get_modes(
+        course_ids=course_ids or None, skip_unchanged=skip_unchanged, partitions=partitions, resumable=resumable,
+        staged=staged, stream=stream, paged=paged, conditional=conditional
     )
+    sync = functools.partial(_full_sync, source=source, batch_size=batch_size, run=run, dry_run=dry_run, report=report, **modes)
+    if dry_run:
+        # which doesn't write anything, so needn't wait its turn
+        return sync(None)
+    return _leased(on_busy or getattr(settings, 'VLE_SYNC_ON_BUSY', SKIP), sync)
+
+
+def get_modes(**given):
+    """
+    returns a dict of the modes of a full sync (see full_sync), those not given (i.e. None) defaulting to their settings,
+    unless a mode that's given is incompatible with them, in which case they're off
+    raises IncompatibleModes if any modes that are on are incompatible
+    """
+    modes = {}
+    for name, setting, default in _MODES:
+        value = given.get(name)
+        if value is None:
+            value = default
+            if setting and not any(_clash(name, other) for other in given if given[other] is not None and _is_on(other, given[other])):
+                value = getattr(settings, setting, default)
+        modes[name] = value
+    on = [name for name, setting, default in _MODES if _is_on(name, modes[name])]
+    for i, name in enumerate(on):
+        clashes = [other for other in on[i + 1:] if _clash(name, other)]
+        if clashes:
+            raise IncompatibleModes('A full sync can\'t combine %s with %s' % (name, ' or '.join(clashes)))
+    return modes
 
-    # return error message
-    if response.status_code != 200:
-        e = response.json()
-        return e['errorMessage']
 
-    # sync each of the four models
-    d = response.json()
-    _sync_course_kv_store(d['course_kv_store'])
-    _sync_group_kv_store(d['group_kv_store'])
-    _sync_course_member(d['course_member'])
-    _sync_group_member(d['group_member'])
+def _is_on(name, value):
+    return value > 1 if name == 'partitions' else bool(value)
 
+
+def _clash(name, other):
+    return other in _INCOMPATIBLE.get(name, ()) or name in _INCOMPATIBLE.get(other, ())
+
+
+def _full_sync(lease, stream, paged, staged, skip_unchanged, partitions, resumable, conditional, course_ids, source,
+               batch_size, run, dry_run, report):
+    """
+    does the work of full_sync, holding the given lease (if it isn't a dry run)
+    """
+    report = report or SyncReport()
+    report.dry_run = dry_run
+    if lease is not None:
+        run = run or SyncRun.objects.create(kind=SyncRun.FULL)
+        lease.set_run(run)
+        recipient_cache.start_sync()
+    client = FileClient(source) if source else MoodleClient()
+    try:
+        with report.recording():
+            if course_ids:
+                error = _sync_courses(client, course_ids, report, batch_size)
+            elif skip_unchanged:
+                error = _sync_changed_courses(client, report, batch_size)
+            elif partitions > 1:
+                error = _sync_partitioned(client, partitions, conditional, report, batch_size)
+            elif resumable and not dry_run:
+                checkpoints = getattr(settings, 'VLE_SYNC_CHECKPOINTS', 16)
+                error = _sync_resumable(client, run, checkpoints, conditional, report, batch_size)
+            else:
+                error = _fetch_and_sync(
+                    client, {}, stream, paged,
+                    delta=False, staged=staged and not dry_run, conditional=conditional, report=report, batch_size=batch_size
+                )
+    except NotModified:
+        _finish(run, report)
+        return _('Full VLE synchronization skipped as nothing has changed in Moodle')
+    except Exception as e:
+        _finish(run, report, error=force_text(e) or repr(e))
+        raise
+    finally:
+        client.close()
+    _finish(run, report, error=error)
+    if error:
+        return error
+    if dry_run:
+        return _('Full VLE synchronization dry run completed successfully')
     return _('Full VLE synchronization completed successfully')
 
 
-def _sync_course_kv_store(course_kv_store):
-    # orphaned ids to delete
-    to_delete = list(CourseKVStore.objects.all().values_list('vle_course_id', flat=True))
+def delta_sync(stream=None, paged=None, dry_run=False, report=None):
+    """
+    synchronizes only what has changed in Moodle since the high-water mark of the last successful sync
+    falls back to a full sync if there has never been one
+    as delta syncs are frequent, one is skipped if another sync holds the sync lease
+    """
+    since = SyncState.get_value(HIGH_WATER_MARK)
+    if since is None:
+        return full_sync(stream, paged, on_busy=SKIP, dry_run=dry_run, report=report)
+    sync = functools.partial(_delta_sync, since=since, stream=stream, paged=paged, dry_run=dry_run, report=report)
+    if dry_run:
+        return sync(None)
+    return _leased(SKIP, sync)
 
-    # create or update each item
-    for item in course_kv_store:
-        obj, created = CourseKVStore.objects.get_or_create(vle_course_id=item['vle_course_id'])
-        obj.name = item['name']
-        obj.save()
-        if item['vle_course_id'] in to_delete:
-            to_delete.remove(item['vle_course_id'])
 
-    # delete orphans
-    if to_delete:
-        CourseKVStore.objects.filter(vle_course_id__in=to_delete).delete()
-        GroupKVStore.objects.filter(vle_course_id__in=to_delete).delete()
-        CourseMember.objects.filter(vle_course_id__in=to_delete).delete()
-        GroupMember.objects.filter(vle_course_id__in=to_delete).delete()
+def _delta_sync(lease, since, stream, paged, dry_run, report):
+    """
+    does the work of delta_sync, holding the given lease (if it isn't a dry run)
+    """
+    report = report or SyncReport()
+    report.dry_run = dry_run
+    run = None
+    if lease is not None:
+        run = SyncRun.objects.create(kind=SyncRun.DELTA)
+        lease.set_run(run)
+        recipient_cache.start_sync()
+    client = MoodleClient()
+    try:
+        with report.recording():
+            error = _fetch_and_sync(client, {'since': since}, stream, paged, delta=True, report=report)
+    except Exception as e:
+        _finish(run, report, error=force_text(e) or repr(e))
+        raise
+    finally:
+        client.close()
+    _finish(run, report, error=error)
+    if error:
+        return error
+    if dry_run:
+        return _('Delta VLE synchronization dry run completed successfully')
+    return _('Delta VLE synchronization completed successfully')
 
 
-def _sync_group_kv_store(group_kv_store):
-    # orphaned ids to delete
-    to_delete = list(GroupKVStore.objects.all().values_list('vle_course_id', 'vle_group_id'))
+def _leased(on_busy, sync):
+    """
+    returns the result of calling the given sync function with the sync lease, which it holds until it returns
+    if another sync holds the lease, then depending on on_busy, waits for it to finish and then takes the lease (WAIT),
+    waits for it to finish and returns its result instead (ATTACH), or returns straight away (SKIP)
+    """
+    lease = Lease()
+    while not lease.acquire():
+        if on_busy == ATTACH:
+            return _get_result(lease.wait())
+        if on_busy != WAIT:
+            return _('VLE synchronization already in progress')
+        lease.wait()
+    with lease.kept_alive():
+        return sync(lease)
+
+
+def _get_result(run):
+    """
+    returns the message the given (finished) SyncRun returned
+    """
+    if run is None or run.status == SyncRun.RUNNING:
+        # it's not known how it went
+        return _('VLE synchronization already in progress')
+    if run.status == SyncRun.FAILED:
+        return run.error
+    if run.kind == SyncRun.DELTA:
+        return _('Delta VLE synchronization completed successfully')
+    return _('Full VLE synchronization completed successfully')
+
+
+def _finish(run, report, error=None):
+    """
+    records the given report (and error, if any) in the given SyncRun, if any,
+    and (unless it was a dry run) forgets every cached recipient
+    """
+    if run is not None:
+        run.finish(error=error, report=report)
+    if not report.dry_run:
+        recipient_cache.invalidate()
+
+
+def _remember(client, report):
+    """
+    stores the validators of the client's response, so that the next conditional sync is skipped if nothing has changed,
+    unless some usernames were unknown, so that their memberships are tried again next time (as with course digests)
+    """
+    if not report.unknown_usernames:
+        client.remember()
+
+
+def _fetch_and_sync(client, params, stream, paged, delta, staged=False, conditional=False, report=None, batch_size=None):
+    """
+    requests data requiring synchronization from Moodle and syncs each of the four models
+    returns an error message if Moodle returned one
+    raises NotModified if the request was conditional and Moodle's data hasn't changed
+    """
+    if stream is None:
+        stream = getattr(settings, 'VLE_SYNC_STREAM', False)
+    if paged is None:
+        paged = getattr(settings, 'VLE_SYNC_PAGED', False)
+    report = report or SyncReport()
+
+    # sync (or stage) each of the four models as its data arrives
+    # a paged section arrives in pieces, so orphans can only be deleted once every page has been applied
+    sinks = {}
+    high_water_mark = None
+    try:
+        for key, value in _fetch_pages(client, params, report) if paged else _fetch(client, params, stream, report, conditional):
+            if key in _RECONCILERS:
+                if key not in sinks:
+                    if staged:
+                        sinks[key] = _Stager(key, batch_size=batch_size, report=report)
+                    else:
+                        sinks[key] = _RECONCILERS[key](batch_size=batch_size, delta=delta, report=report)
+                sinks[key].feed(value)
+                if not paged:
+                    sinks[key].finish()
+            elif key == HIGH_WATER_MARK:
+                high_water_mark = value
+    except SyncError as e:
+        return force_text(e)
+    if paged:
+        for key in SECTIONS:
+            if key in sinks:
+                sinks[key].finish()
+    if staged:
+        _swap([sinks[key] for key in SECTIONS if key in sinks])
+
+    # the next delta sync continues from where this one got to, and the next conditional sync from this one
+    if not report.dry_run:
+        if high_water_mark is not None:
+            SyncState.set_value(HIGH_WATER_MARK, force_text(high_water_mark))
+        _remember(client, report)
+
+    return None
+
+
+def _sync_courses(client, course_ids, report, batch_size=None):
+    """
+    syncs only the given courses (deleting any that have vanished), requesting the data of just those courses from Moodle
+    returns an error message if Moodle returned one
+    """
+    scope = set(course_ids)
+    try:
+        d = _fetch_courses(client, scope, report)
+    except SyncError as e:
+        return force_text(e)
+    _sync_scope(d, scope, report, batch_size)
+    return None
+
+
+def _fetch_courses(client, course_ids, report):
+    """
+    requests the full data of the given courses from Moodle, a few at a time, returning a dict of the four sections
+    """
+    d = {key: [] for key in SECTIONS}
+    for chunk in chunks(sorted(course_ids), getattr(settings, 'VLE_SYNC_COURSES_PER_REQUEST', 100)):
+        for key, value in _fetch(client, {'courses': chunk}, False, report):
+            if key in d:
+                d[key].extend(value)
+    return d
+
+
+def _sync_scope(d, scope, report, batch_size=None):
+    """
+    reconciles the given courses only, against their items in the given payload
+    """
+    for key in SECTIONS:
+        reconciler = _RECONCILERS[key](batch_size=batch_size, course_ids=scope, report=report)
+        reconciler.sync(item for item in d.get(key, []) if item['vle_course_id'] in scope)
+
 
-    # create or update each item
-    for item in group_kv_store:
-        obj, created = GroupKVStore.objects.get_or_create(vle_course_id=item['vle_course_id'], vle_group_id=item['vle_group_id'])
-        obj.name = item['name']
-        obj.save()
-        if (item['vle_course_id'], item['vle_group_id']) in to_delete:
-            to_delete.remove((item['vle_course_id'], item['vle_group_id']))
+def _sync_changed_courses(client, report, batch_size=None):
+    """
+    syncs only the courses whose digest differs from the one stored when they were last synced (and deletes vanished courses)
+    Moodle is first asked for just the digests, and then for the full data of changed courses only;
+    if it doesn't support digests, it returns the full payload instead and the digests are computed from that
+    returns an error message if Moodle returned one
+    """
+    batch_size = batch_size or get_batch_size()
+    try:
+        d = dict(_fetch(client, {'digests': 1}, False, report))
+        digests = d.get('digests')
+        with report.phase('diff'):
+            stored = dict(CourseKVStore.objects.values_list('vle_course_id', 'digest'))
+            if digests is None:
+                digests = get_course_digests(d)
+            changed = set(c for c, digest in digests.items() if stored.get(c) != digest)
+        if 'digests' in d:
+            d = _fetch_courses(client, changed, report)
+    except SyncError as e:
+        return force_text(e)
 
-    # delete orphans
-    if to_delete:
-        GroupKVStore.objects.filter(GroupMember.get_groups_filter(to_delete)).delete()
-        GroupMember.objects.filter(GroupMember.get_groups_filter(to_delete)).delete()
+    # reconcile changed and vanished courses only
+    _sync_scope(d, changed.union(set(stored).difference(digests)), report, batch_size)
+    if report.dry_run:
+        return None
+
+    # store the digests of changed courses, except those with unknown members, so that they are tried again next time
+    with report.phase('apply'):
+        incomplete = set(
+            item['vle_course_id'] for key in ('course_member', 'group_member',) for item in d.get(key, [])
+            if item['username'] in report.unknown_usernames
+        )
+        to_update = [(c, '' if c in incomplete else digests[c]) for c in changed]
+        pks = {}
+        for chunk in chunks(changed, batch_size):
+            pks.update(CourseKVStore.objects.filter(vle_course_id__in=chunk).values_list('vle_course_id', 'id'))
+        _bulk_update(CourseKVStore, 'digest', [(pks[c], digest) for c, digest in to_update if c in pks], batch_size)
+    return None
+
+
+def _sync_partitioned(client, partitions, conditional, report, batch_size=None):
+    """
+    reconciles courses and groups, then splits memberships by vle_course_id into the given number of partitions
+    and reconciles each in a pool of processes (each with its own database connection)
+    returns an error message if Moodle returned one
+    raises NotModified if the request was conditional and Moodle's data hasn't changed
+    """
+    try:
+        d = dict(_fetch(client, {}, False, report, conditional))
+    except SyncError as e:
+        return force_text(e)
+
+    # courses and groups are comparatively few, and reconciling courses here deletes everything in vanished courses,
+    # whichever partition their memberships would have been in
+    for key in ('course_kv_store', 'group_kv_store',):
+        if key in d:
+            _RECONCILERS[key](batch_size=batch_size, report=report).sync(d[key])
+
+    with report.phase('diff'):
+        parts = _split_by_course(d, [key for key in ('course_member', 'group_member',) if key in d], partitions)
+
+    pool = _get_pool(partitions)
+    try:
+        for r in pool.imap_unordered(_sync_partition, [(part, report.dry_run, batch_size) for part in parts]):
+            report.merge(r)
+    finally:
+        pool.close()
+        pool.join()
+    if not report.dry_run:
+        if HIGH_WATER_MARK in d:
+            SyncState.set_value(HIGH_WATER_MARK, force_text(d[HIGH_WATER_MARK]))
+        _remember(client, report)
+    return None
+
+
+def _get_pool(processes):
+    """
+    returns a pool of the given number of processes, which are spawned (rather than forked, which isn't safe
+    with the lease's heartbeat thread running, nor possible on every platform), and set up Django for themselves,
+    connected to the same databases as this process (see setup_worker)
+    """
+    databases = dict((alias, connections[alias].settings_dict) for alias in connections)
+    context = multiprocessing.get_context('spawn') if hasattr(multiprocessing, 'get_context') else multiprocessing
+    return context.Pool(processes, initializer=setup_worker, initargs=(databases,))
+
+
+def _sync_partition(args):
+    """
+    reconciles the memberships of one partition of courses (in a worker process), returning a report
+    """
+    part, dry_run, batch_size = args
+    report = SyncReport(dry_run=dry_run)
+    with report.recording():
+        for key in ('course_member', 'group_member',):
+            if key in part:
+                _RECONCILERS[key](batch_size=batch_size, course_ids=part['course_ids'], report=report).sync(part[key])
+    return report
+
+
+def _sync_resumable(client, run, partitions, conditional, report, batch_size=None):
+    """
+    reconciles each section one partition of courses at a time (courses first, so vanished courses are deleted first),
+    recording each (section, partition) in the given SyncRun as a checkpoint once it has been applied
+    if the last full run before it didn't succeed and was against the same Moodle snapshot, the checkpoints it reached are skipped
+    (runs that never got as far as holding the lease, such as one skipped as another sync was in progress, don't count)
+    returns an error message if Moodle returned one
+    raises NotModified if the request was conditional and Moodle's data hasn't changed
+    """
+    previous = SyncRun.objects.filter(
+        Q(started__lt=run.started) | Q(started=run.started, pk__lt=run.pk),
+        # a snapshot is only recorded under the lease, and a run only succeeds under it
+        Q(snapshot__gt='') | Q(status=SyncRun.SUCCEEDED),
+        kind=SyncRun.FULL, dry_run=False
+    ).order_by('-started', '-pk').first()
+    try:
+        d = dict(_fetch(client, {}, False, report, conditional))
+    except SyncError as e:
+        return force_text(e)
+    keys = [key for key in SECTIONS if key in d]
+    run.snapshot = get_snapshot_id(d)
+    run.total = len(keys) * partitions
+    if previous is not None and previous.status != SyncRun.SUCCEEDED and previous.snapshot == run.snapshot:
+        if previous.status == SyncRun.RUNNING:
+            # its process must have died
+            previous.finish(error=_('Interrupted'))
+        run.resumed_from, run.checkpoints = previous, previous.checkpoints
+    run.save()
+
+    with report.phase('diff'):
+        parts = _split_by_course(d, keys, partitions)
+    done = set(run.get_checkpoints())
+    for key in keys:
+        for i, part in enumerate(parts):
+            # the number of partitions is part of the checkpoint, as a different number splits courses differently
+            checkpoint = '%s:%d/%d' % (key, i, partitions)
+            if checkpoint not in done:
+                _RECONCILERS[key](batch_size=batch_size, course_ids=part['course_ids'], report=report).sync(part[key])
+                run.add_checkpoint(checkpoint)
+
+    if HIGH_WATER_MARK in d:
+        SyncState.set_value(HIGH_WATER_MARK, force_text(d[HIGH_WATER_MARK]))
+    _remember(client, report)
+    return None
+
+
+def _split_by_course(d, keys, partitions):
+    """
+    splits the given sections of a full payload by vle_course_id into the given number of partitions,
+    returning a dict for each with a list of the items of each section and the set of its course_ids
+    every course with rows (existing or not) belongs to exactly one partition, so that its orphans are deleted
+    """
+    parts = [dict({key: [] for key in keys}, course_ids=set()) for i in range(partitions)]
+    for key in keys:
+        for vle_course_id in _RECONCILERS[key].model.objects.values_list('vle_course_id', flat=True).distinct().iterator():
+            parts[get_partition(vle_course_id, partitions)]['course_ids'].add(vle_course_id)
+        for item in d[key]:
+            part = parts[get_partition(item['vle_course_id'], partitions)]
+            part['course_ids'].add(item['vle_course_id'])
+            part[key].append(item)
+    return parts
+
+
+def get_snapshot_id(d):
+    """
+    identifies the snapshot of Moodle's data that the given full payload is: its snapshot_id if Moodle gives one,
+    else its high-water mark (as nothing has changed since), else a digest of its course digests
+    """
+    if 'snapshot_id' in d:
+        return force_text(d['snapshot_id'])
+    if HIGH_WATER_MARK in d:
+        return force_text(d[HIGH_WATER_MARK])
+    s = json.dumps(sorted(get_course_digests(d).items()), separators=(',', ':'))
+    return hashlib.sha1(s.encode('utf-8')).hexdigest()
+
+
+def get_partition(vle_course_id, partitions):
+    """
+    returns which of the given number of partitions the given course belongs to (the same in every process)
+    """
+    return (zlib.crc32(vle_course_id.encode('utf-8')) & 0xffffffff) % partitions
+
+
+def get_course_digests(d):
+    """
+    given a full payload, returns a dict of vle_course_id to a stable digest of everything in that course:
+    the SHA-1 of the compact, key-sorted JSON of its name, its sorted [vle_group_id, name] groups,
+    its sorted [username, is_tutor] members and its sorted [vle_group_id, username] group members
+    """
+    courses = defaultdict(lambda: {'name': '', 'groups': [], 'members': [], 'group_members': []})
+    for item in d.get('course_kv_store', []):
+        courses[item['vle_course_id']]['name'] = item['name']
+    for item in d.get('group_kv_store', []):
+        courses[item['vle_course_id']]['groups'].append([item['vle_group_id'], item['name']])
+    for item in d.get('course_member', []):
+        courses[item['vle_course_id']]['members'].append([item['username'], bool(item['is_tutor'])])
+    for item in d.get('group_member', []):
+        courses[item['vle_course_id']]['group_members'].append([item['vle_group_id'], item['username']])
+    digests = {}
+    for vle_course_id, course in courses.items():
+        for k in ('groups', 'members', 'group_members',):
+            course[k].sort()
+        s = json.dumps(course, sort_keys=True, separators=(',', ':'))
+        digests[vle_course_id] = hashlib.sha1(s.encode('utf-8')).hexdigest()
+    return digests
+
+
+def _fetch(client, params, stream, report, conditional=False):
+    """
+    requests all data requiring synchronization from Moodle in one response
+    yields a (key, value) pair for each of its members, the four sections first
+    """
+    with report.phase('fetch'):
+        response = client.get(params, stream=stream, conditional=conditional)
+    if stream:
+        content = report.timed('fetch', _counted(response.iter_content(chunk_size=STREAM_CHUNK_SIZE), report))
+        for key, value in report.timed('parse', iter_sections(content)):
+            yield key, report.timed('parse', value) if isinstance(value, GeneratorType) else value
+    else:
+        with report.phase('parse'):
+            d = response.json()
+        report.payload_bytes += len(response.content)
+        report.expect(sum(len(d[key]) for key in SECTIONS if key in d))
+        for key in SECTIONS:
+            if key in d:
+                yield key, d[key]
+        for key, value in d.items():
+            if key not in SECTIONS:
+                yield key, value
+
+
+def _counted(chunks, report):
+    """
+    yields the given chunks of payload, adding up their size in the report
+    """
+    for chunk in chunks:
+        report.payload_bytes += len(chunk)
+        yield chunk
+
+
+def _fetch_pages(client, params, report):
+    """
+    requests each section page by page (Moodle pages sections by course range), with a bounded pool of threads
+    sharing the client's pooled session, and yields a (key, value) pair for each page as soon as it arrives
+    so that waiting on the network overlaps with writing to the database
+    the first page of each section says how many pages there are
+    """
+    executor = ThreadPoolExecutor(max_workers=getattr(settings, 'VLE_SYNC_FETCH_WORKERS', 4))
+    futures = {}
+    try:
+        for key in SECTIONS:
+            futures[executor.submit(client.get, dict(params, section=key, page=0))] = (key, 0)
+        while futures:
+            with report.phase('fetch'):
+                done, not_done = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                key, page = futures.pop(future)
+                response = future.result()
+                with report.phase('parse'):
+                    d = response.json()
+                report.payload_bytes += len(response.content)
+                report.expect(len(d.get(key, [])))
+                if page == 0:
+                    for p in range(1, d.get('pages', 1)):
+                        futures[executor.submit(client.get, dict(params, section=key, page=p))] = (key, p)
+                yield key, d.get(key, [])
+                if HIGH_WATER_MARK in d:
+                    yield HIGH_WATER_MARK, d[HIGH_WATER_MARK]
+    finally:
+        for future in futures:
+            future.cancel()
+        executor.shutdown()
+
+
+def _sync_course_kv_store(course_kv_store):
+    _CourseKVStoreReconciler().sync(course_kv_store)
+
+
+def _sync_group_kv_store(group_kv_store):
+    _GroupKVStoreReconciler().sync(group_kv_store)
 
 
 def _sync_course_member(course_member):
-    # orphaned ids to delete
-    to_delete = list(CourseMember.objects.all().values_list('id', flat=True))
-
-    # create or update each item
-    for item in course_member:
-        try:
-            user = get_user_model().objects.get(username=item['username'])
-            obj, created = CourseMember.objects.get_or_create(user=user, vle_course_id=item['vle_course_id'])
-            obj.is_tutor = item['is_tutor']
-            obj.save()
-            if obj.pk in to_delete:
-                to_delete.remove(obj.pk)
-        except get_user_model().DoesNotExist:
-            pass
-
-    # delete orphans
-    if to_delete:
-        CourseMember.objects.filter(pk__in=to_delete).delete()
+    _CourseMemberReconciler().sync(course_member)
 
 
 def _sync_group_member(group_member):
-    # orphaned ids to delete
-    to_delete = list(GroupMember.objects.all().values_list('id', flat=True))
-
-    # create or update each item
-    for item in group_member:
-        try:
-            user = get_user_model().objects.get(username=item['username'])
-            obj, created = GroupMember.objects.get_or_create(user=user, vle_course_id=item['vle_course_id'], vle_group_id=item['vle_group_id'])
-            if obj.pk in to_delete:
-                to_delete.remove(obj.pk)
-        except get_user_model().DoesNotExist:
-            pass
-
-    # delete orphans
-    if to_delete:
-        GroupMember.objects.filter(pk__in=to_delete).delete()
+    _GroupMemberReconciler().sync(group_member)
+
+
+def _bulk_update(model, field, to_update, batch_size):
+    """
+    given a list of (pk, value) pairs, updates the given (char) field of each row with one query per batch
+    (each row takes three query parameters, hence the smaller chunks)
+    """
+    for chunk in chunks(to_update, max(1, batch_size // 3)):
+        whens = [When(pk=pk, then=Value(value)) for pk, value in chunk]
+        model.objects.filter(pk__in=[pk for pk, value in chunk]).update(**{field: Case(*whens, output_field=CharField())})
+
+
+class _Reconciler(object):
+    """
+    reconciles one model against its section of the Moodle payload, with items diffed in batches using sets and dicts
+    in a full sync, existing keys are loaded once and whatever is left unseen once every item has been fed is an orphan to be deleted,
+    unless the reconciler is generational, when only the rows matching each batch are looked up, and marked with this sync's generation,
+    and orphans are whatever rows (in scope) are left with a stale generation, deleted in the database
+    in a delta sync, only the rows matching each batch are looked up, and items flagged as deleted (tombstones) are deleted
+    given course_ids, only rows in those courses are loaded (so only they can be orphans), and items should be filtered to match
+    in a dry run (according to the report), the diff is counted but not written
+    """
+    key = None
+    model = None
+    key_fields = ()
+    value_fields = ()
+    generational = False
+
+    def __init__(self, batch_size=None, delta=False, course_ids=None, report=None):
+        self.batch_size = batch_size or get_batch_size()
+        self.delta = delta
+        self.course_ids = course_ids
+        self.report = report or SyncReport()
+        self.generational = self.generational and not delta
+        self.generation = self.max_pk = None
+        if self.generational:
+            latest = self.model.objects.aggregate(generation=Max('generation'), pk=Max('pk'))
+            # newer than any row's, so every row starts off stale
+            if not self.report.dry_run:
+                self.generation = (latest['generation'] or 0) + 1
+            # but only rows that existed when the sync started can be orphans, not those created since (e.g. by the views)
+            self.max_pk = latest['pk']
+        self.matched = 0
+        with self.report.phase('diff'):
+            self.existing = {} if delta or self.generational else self.load_existing()
+        self.seen = set()
+
+    def sync(self, items):
+        self.feed(items)
+        self.finish()
+
+    def feed(self, items):
+        for batch in chunks(items, self.batch_size):
+            tombstones, matched = {}, []
+            with self.report.phase('diff'):
+                pairs = self.keyed(batch)
+                if self.delta:
+                    deleted = [key for key, item in pairs if item.get('deleted')]
+                    if deleted:
+                        tombstones = self.lookup(deleted)
+                    pairs = [(key, item) for key, item in pairs if not item.get('deleted')]
+                if self.delta or self.generational:
+                    self.existing = self.lookup([key for key, item in pairs])
+                if self.generational:
+                    matched = [t[0] for t in self.existing.values()]
+                    self.matched += len(matched)
+                to_create, to_update = self.diff(pairs)
+            if tombstones:
+                self.delete(tombstones)
+            self.write(to_create, to_update)
+            if matched:
+                self.mark(matched)
+
+    def keyed(self, batch):
+        """
+        returns a list of (key, item) pairs for the given batch
+        in a full sync, keys that have already been seen are skipped
+        in a delta (or generational) sync, the last change to a key in the batch wins
+        """
+        if self.delta or self.generational:
+            return list(OrderedDict((key, item) for key, item in zip(self.get_keys(batch), batch) if key is not None).items())
+        pairs = []
+        for key, item in zip(self.get_keys(batch), batch):
+            if key is None or key in self.seen:
+                continue
+            self.seen.add(key)
+            pairs.append((key, item))
+        return pairs
+
+    def diff(self, pairs):
+        """
+        returns a (list of instances to create, list of (pk, value) pairs to update) pair for the given (key, item) pairs
+        """
+        to_create, to_update = [], []
+        for key, item in pairs:
+            if key not in self.existing:
+                to_create.append(self.create(key, item))
+                continue
+            existing = self.existing.pop(key)
+            if self.value_fields and existing[1] != self.get_value(item):
+                to_update.append((existing[0], self.get_value(item)))
+        self.report.count(self.key, 'skipped', len(pairs) - len(to_create) - len(to_update))
+        return to_create, to_update
+
+    def write(self, to_create, to_update):
+        self.report.count(self.key, 'created', len(to_create))
+        self.report.count(self.key, 'updated', len(to_update))
+        if self.report.dry_run:
+            return
+        with self.report.phase('apply'):
+            if to_create:
+                if self.generational:
+                    for instance in to_create:
+                        instance.generation = self.generation
+                self.model.objects.bulk_create(to_create, batch_size=self.batch_size)
+            if to_update:
+                self.update(to_update)
+
+    def mark(self, pks):
+        """
+        marks the rows with the given pks as seen in this sync's generation
+        """
+        if self.report.dry_run:
+            return
+        with self.report.phase('apply'):
+            for chunk in chunks(pks, self.batch_size):
+                self.model.objects.filter(pk__in=chunk).update(generation=self.generation)
+
+    def delete(self, orphans):
+        self.report.count(self.key, 'deleted', len(orphans))
+        if self.report.dry_run:
+            return
+        with self.report.phase('apply'):
+            self.delete_orphans(orphans)
+
+    def finish(self):
+        if self.generational:
+            self.delete_stale()
+        elif self.existing and not self.delta:
+            self.delete(self.existing)
+        self.existing = {}
+
+    def delete_stale(self):
+        """
+        deletes the rows (in scope) that existed when the sync started but weren't marked with this sync's generation,
+        with one raw DELETE (per chunk of courses, if scoped), or in a dry run counts how many of them weren't matched
+        """
+        if self.max_pk is None:
+            # there were none
+            return
+        qn = connection.ops.quote_name
+        sql = 'DELETE FROM %s WHERE %s <> %%s AND %s <= %%s' % (
+            qn(self.model._meta.db_table), qn('generation'), qn(self.model._meta.pk.column),
+        )
+        if self.course_ids is None:
+            scopes = [(self.model.objects.all(), sql, [])]
+        else:
+            scopes = [
+                (
+                    self.model.objects.filter(vle_course_id__in=chunk),
+                    sql + ' AND %s IN (%s)' % (qn('vle_course_id'), ', '.join(['%s'] * len(chunk))),
+                    chunk,
+                )
+                for chunk in chunks(self.course_ids, self.batch_size)
+            ]
+        if self.report.dry_run:
+            with self.report.phase('diff'):
+                orphans = sum(qs.filter(pk__lte=self.max_pk).count() for qs, sql, params in scopes) - self.matched
+            self.report.count(self.key, 'deleted', max(0, orphans))
+            return
+        deleted = 0
+        with self.report.phase('apply'), connection.cursor() as cursor:
+            # without signals, so the rows aren't loaded (the sync forgets cached recipients itself)
+            for qs, sql, params in scopes:
+                cursor.execute(sql, [self.generation, self.max_pk] + list(params))
+                deleted += cursor.rowcount
+        self.report.count(self.key, 'deleted', deleted)
+
+    def rows(self, qs):
+        """
+        yields a (key, (pk, value, ...)) pair for each row of the given queryset
+        """
+        n = len(self.key_fields)
+        for t in qs.values_list(*(self.key_fields + ('id',) + self.value_fields)).iterator():
+            yield t[0] if n == 1 else t[:n], t[n:]
+
+    def load_existing(self):
+        """
+        returns a dict of key to (pk, value, ...) for every existing row (in scope)
+        """
+        if self.course_ids is None:
+            return dict(self.rows(self.model.objects.all()))
+        existing = {}
+        for chunk in chunks(self.course_ids, self.batch_size):
+            existing.update(self.rows(self.model.objects.filter(vle_course_id__in=chunk)))
+        return existing
+
+    def lookup(self, keys):
+        """
+        returns a dict of key to (pk, value, ...) for the existing rows matching the given keys
+        (each key field takes one query parameter per key, hence the smaller chunks)
+        """
+        existing = {}
+        n = len(self.key_fields)
+        for chunk in chunks(keys, max(1, self.batch_size // n)):
+            wanted = set(chunk)
+            if n == 1:
+                filters = {'%s__in' % self.key_fields[0]: chunk}
+            else:
+                filters = {'%s__in' % f: set(key[i] for key in chunk) for i, f in enumerate(self.key_fields)}
+            existing.update((key, value) for key, value in self.rows(self.model.objects.filter(**filters)) if key in wanted)
+        return existing
+
+    def resolve(self, usernames):
+        """
+        returns a dict of username to user id for the given usernames, reporting any that are unknown
+        """
+        user_ids, unknown = resolver.resolve(usernames)
+        self.report.unknown_usernames.update(unknown)
+        return user_ids
+
+    def get_keys(self, batch):
+        """
+        returns a list of keys (or None, for items that cannot be synced) for the given batch of items
+        """
+        raise NotImplementedError
+
+    def get_value(self, item):
+        raise NotImplementedError
+
+    def create(self, key, item):
+        """
+        returns a new (unsaved) instance for the given key and item
+        """
+        raise NotImplementedError
+
+    def update(self, to_update):
+        """
+        given a list of (pk, value) pairs, updates the value of each row
+        """
+        raise NotImplementedError
+
+    def delete_orphans(self, orphans):
+        """
+        deletes the rows of the given dict of key to (pk, value, ...)
+        """
+        for chunk in chunks([t[0] for t in orphans.values()], self.batch_size):
+            self.model.objects.filter(pk__in=chunk).delete()
+
+
+class _CourseKVStoreReconciler(_Reconciler):
+    key = 'course_kv_store'
+    model = CourseKVStore
+    key_fields = ('vle_course_id',)
+    value_fields = ('name',)
+
+    def get_keys(self, batch):
+        return [item['vle_course_id'] for item in batch]
+
+    def get_value(self, item):
+        return item['name']
+
+    def create(self, key, item):
+        return CourseKVStore(vle_course_id=key, name=item['name'])
+
+    def update(self, to_update):
+        _bulk_update(CourseKVStore, 'name', to_update, self.batch_size)
+
+    def delete_orphans(self, orphans):
+        # deleting a course deletes everything in it
+        purge_courses(list(orphans.keys()), self.batch_size)
+
+
+class _GroupKVStoreReconciler(_Reconciler):
+    key = 'group_kv_store'
+    model = GroupKVStore
+    key_fields = ('vle_course_id', 'vle_group_id',)
+    value_fields = ('name',)
+
+    def get_keys(self, batch):
+        return [(item['vle_course_id'], item['vle_group_id']) for item in batch]
+
+    def get_value(self, item):
+        return item['name']
+
+    def create(self, key, item):
+        return GroupKVStore(vle_course_id=key[0], vle_group_id=key[1], name=item['name'])
+
+    def update(self, to_update):
+        _bulk_update(GroupKVStore, 'name', to_update, self.batch_size)
+
+    def delete_orphans(self, orphans):
+        # deleting a group deletes its members (each pair takes two query parameters, hence the smaller chunks)
+        for chunk in chunks(orphans.keys(), max(1, self.batch_size // 2)):
+            GroupKVStore.objects.filter(GroupMember.get_groups_filter(chunk)).delete()
+            GroupMember.objects.filter(GroupMember.get_groups_filter(chunk)).delete()
+
+
+class _CourseMemberReconciler(_Reconciler):
+    key = 'course_member'
+    model = CourseMember
+    key_fields = ('user', 'vle_course_id',)
+    value_fields = ('is_tutor',)
+    generational = True
+
+    def get_keys(self, batch):
+        user_ids = self.resolve([item['username'] for item in batch])
+        return [
+            (user_ids[item['username']], item['vle_course_id']) if item['username'] in user_ids else None
+            for item in batch
+        ]
+
+    def get_value(self, item):
+        return bool(item['is_tutor'])
+
+    def create(self, key, item):
+        return CourseMember(user_id=key[0], vle_course_id=key[1], is_tutor=bool(item['is_tutor']))
+
+    def update(self, to_update):
+        for is_tutor in (True, False,):
+            pks = [pk for pk, value in to_update if value == is_tutor]
+            if pks:
+                CourseMember.objects.filter(pk__in=pks).update(is_tutor=is_tutor)
+
+
+class _GroupMemberReconciler(_Reconciler):
+    key = 'group_member'
+    model = GroupMember
+    key_fields = ('user', 'vle_course_id', 'vle_group_id',)
+    generational = True
+
+    def get_keys(self, batch):
+        user_ids = self.resolve([item['username'] for item in batch])
+        return [
+            (user_ids[item['username']], item['vle_course_id'], item['vle_group_id']) if item['username'] in user_ids else None
+            for item in batch
+        ]
+
+    def create(self, key, item):
+        return GroupMember(user_id=key[0], vle_course_id=key[1], vle_group_id=key[2])
+
+
+_RECONCILERS = dict((r.key, r) for r in (
+    _CourseKVStoreReconciler,
+    _GroupKVStoreReconciler,
+    _CourseMemberReconciler,
+    _GroupMemberReconciler,
+))
+
+
+class _Stager(object):
+    """
+    loads one section of the Moodle payload into the staging table of its model
+    """
+
+    def __init__(self, key, batch_size=None, report=None):
+        self.key = key
+        self.model, self.staged_model, self.key_fields, self.value_field = _STAGING[key]
+        self.batch_size = batch_size or get_batch_size()
+        self.report = report or SyncReport()
+        self.seen = set()
+        self.staged = 0
+        self.staged_model.objects.all().delete()
+
+    def feed(self, items):
+        fields = self.key_fields + ((self.value_field,) if self.value_field else ())
+        for batch in chunks(items, self.batch_size):
+            with self.report.phase('diff'):
+                if 'user_id' in fields:
+                    user_ids, unknown = resolver.resolve([item['username'] for item in batch])
+                    self.report.unknown_usernames.update(unknown)
+                    batch = [dict(item, user_id=user_ids[item['username']]) for item in batch if item['username'] in user_ids]
+                to_create = []
+                for item in batch:
+                    key = tuple(item[f] for f in self.key_fields)
+                    if key not in self.seen:
+                        self.seen.add(key)
+                        to_create.append(self.staged_model(**{f: item[f] for f in fields}))
+            with self.report.phase('apply'):
+                self.staged_model.objects.bulk_create(to_create, batch_size=self.batch_size)
+            self.staged += len(to_create)
+
+    def finish(self):
+        self.seen = set()
+
+    def apply(self):
+        """
+        makes the model match its staging table with (at most) three set-based statements,
+        an anti-join delete, a correlated update and an anti-join insert
+        """
+        qn = connection.ops.quote_name
+        table, staged = qn(self.model._meta.db_table), qn(self.staged_model._meta.db_table)
+        keys = [qn(f) for f in self.key_fields]
+        match = ' AND '.join('%s.%s = %s.%s' % (staged, k, table, k) for k in keys)
+        changed = 0
+        with connection.cursor() as cursor:
+            cursor.execute('DELETE FROM %s WHERE NOT EXISTS (SELECT 1 FROM %s WHERE %s)' % (table, staged, match))
+            self.report.count(self.key, 'deleted', cursor.rowcount)
+            columns = keys
+            if self.value_field:
+                value = qn(self.value_field)
+                columns = keys + [value]
+                cursor.execute('UPDATE %s SET %s = (SELECT %s.%s FROM %s WHERE %s) WHERE EXISTS (SELECT 1 FROM %s WHERE %s AND %s.%s <> %s.%s)' % (
+                    table, value, staged, value, staged, match, staged, match, staged, value, table, value,
+                ))
+                self.report.count(self.key, 'updated', cursor.rowcount)
+                changed += cursor.rowcount
+            # any other columns get their field's default
+            defaults = [f for f in self.model._meta.concrete_fields if not f.primary_key and qn(f.column) not in columns]
+            cursor.execute('INSERT INTO %s (%s) SELECT %s FROM %s WHERE NOT EXISTS (SELECT 1 FROM %s WHERE %s)' % (
+                table,
+                ', '.join(columns + [qn(f.column) for f in defaults]),
+                ', '.join(['%s.%s' % (staged, c) for c in columns] + ['%s'] * len(defaults)),
+                staged, table, match,
+            ), [f.get_default() for f in defaults])
+            self.report.count(self.key, 'created', cursor.rowcount)
+            changed += cursor.rowcount
+        self.report.count(self.key, 'skipped', self.staged - changed)
+
+
+def _swap(stagers):
+    """
+    applies every staging table in one transaction, then empties them
+    """
+    if not stagers:
+        return
+    report = stagers[0].report
+    with report.phase('apply'):
+        with transaction.atomic():
+            for stager in stagers:
+                stager.apply()
+        for stager in stagers:
+            stager.staged_model.objects.all().delete()
+
+
+_STAGING = {
+    'course_kv_store': (CourseKVStore, StagedCourseKVStore, ('vle_course_id',), 'name'),
+    'group_kv_store': (GroupKVStore, StagedGroupKVStore, ('vle_course_id', 'vle_group_id',), 'name'),
+    'course_member': (CourseMember, StagedCourseMember, ('user_id', 'vle_course_id',), 'is_tutor'),
+    'group_member': (GroupMember, StagedGroupMember, ('user_id', 'vle_course_id', 'vle_group_id',), None),
+}
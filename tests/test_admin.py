@@ -0,0 +1,140 @@
+# -*- coding: UTF-8 -*-
+
+import datetime
+import json
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from django.contrib.auth import get_user_model
+from django.core.urlresolvers import reverse
+from django.db import DatabaseError
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from vle.admin import _sparkline
+from vle.models import CourseKVStore, SyncLease, SyncRun
+
+
+class SyncRunAdminTestCase(TestCase):
+
+    def setUp(self):
+        get_user_model().objects.create_superuser(username='tywin.lannister', email='tywin.lannister@into.uk.com', password='Wibble123!')
+        self.client.login(username='tywin.lannister', password='Wibble123!')
+
+    def test_sparkline(self):
+        self.assertEqual(u'▁▄█', _sparkline([1, 2.5, 4]))
+        self.assertEqual(u'▁▁', _sparkline([3, None, 3]))
+        self.assertEqual(u'', _sparkline([None]))
+
+    def test_changelist(self):
+        now = timezone.now()
+        for i in range(3):
+            run = SyncRun.objects.create(
+                status=SyncRun.SUCCEEDED,
+                queries=100 * (i + 1),
+                peak_rss=1000,
+                rows=json.dumps({'course_member': {'created': 1, 'updated': 0, 'deleted': 0, 'skipped': i}}),
+            )
+            SyncRun.objects.filter(pk=run.pk).update(
+                started=now + datetime.timedelta(hours=i),
+                finished=now + datetime.timedelta(hours=i, seconds=10 * (i + 1)),
+            )
+        response = self.client.get(reverse('admin:vle_syncrun_changelist'))
+        self.assertEqual(200, response.status_code)
+        self.assertContains(response, u'time ▁▄█')
+        self.assertContains(response, u'queries ▁▄█')
+        self.assertContains(response, u'rss ▁▁▁')
+
+        response = self.client.get(reverse('admin:vle_syncrun_change', args=(run.pk,)))
+        self.assertContains(response, 'course_member: 1 created, 0 updated, 0 deleted, 2 skipped')
+
+
+class _SynchronousThread(object):
+    """
+    stands in for threading.Thread, running its target when started
+    """
+
+    def __init__(self, target, args=()):
+        self.target, self.args = target, args
+
+    def start(self):
+        self.target(*self.args)
+
+
+@mock.patch('vle.views.connection', mock.Mock())
+@mock.patch('vle.views.threading', mock.Mock(Thread=_SynchronousThread))
+class BackgroundSyncTestCase(TestCase):
+
+    def setUp(self):
+        get_user_model().objects.create_superuser(username='tywin.lannister', email='tywin.lannister@into.uk.com', password='Wibble123!')
+        self.client.login(username='tywin.lannister', password='Wibble123!')
+        self.payload = {
+            u'course_kv_store': [{u'vle_course_id': '001', u'name': 'Needlework'}],
+            u'course_member': [{u'username': 'tywin.lannister', u'vle_course_id': '001', u'is_tutor': True}],
+        }
+
+    @mock.patch('vle.moodle.requests.Session.get')
+    def test_full_sync_view(self, get):
+        get.return_value.status_code = 200
+        get.return_value.json.return_value = self.payload
+        get.return_value.content = json.dumps(self.payload).encode('utf-8')
+        response = self.client.get(reverse('vle_full_sync'))
+        run = SyncRun.objects.get()
+        self.assertRedirects(response, reverse('admin:vle_syncrun_progress', args=(run.pk,)))
+        self.assertEqual(1, CourseKVStore.objects.count())
+
+        # the run recorded its progress
+        self.assertEqual((SyncRun.FULL, SyncRun.SUCCEEDED, '', 2), (run.kind, run.status, run.phase, run.processed))
+
+        response = self.client.get(reverse('admin:vle_syncrun_progress', args=(run.pk,)))
+        self.assertContains(response, reverse('admin:vle_syncrun_status', args=(run.pk,)))
+
+        status = json.loads(self.client.get(reverse('admin:vle_syncrun_status', args=(run.pk,))).content.decode('utf-8'))
+        self.assertEqual((run.pk, SyncRun.SUCCEEDED, '', 2, ''), (status['id'], status['status'], status['phase'], status['processed'], status['error']))
+        self.assertTrue(status['rowsPerSecond'] >= 0)
+
+    def test_busy(self):
+        SyncLease.objects.create(name='sync', holder='elsewhere', acquired=timezone.now(), expires=timezone.now() + datetime.timedelta(hours=1))
+        self.client.get(reverse('vle_full_sync'))
+        run = SyncRun.objects.get()
+        self.assertEqual((SyncRun.FAILED, 'VLE synchronization already in progress'), (run.status, run.error))
+
+    @mock.patch('vle.moodle.requests.Session.get')
+    def test_dry_run(self, get):
+        get.return_value.status_code = 200
+        get.return_value.json.return_value = self.payload
+        get.return_value.content = json.dumps(self.payload).encode('utf-8')
+        response = self.client.get(reverse('vle_full_sync') + '?dry_run=1')
+        run = SyncRun.objects.get()
+        self.assertRedirects(response, reverse('admin:vle_syncrun_progress', args=(run.pk,)))
+        self.assertFalse(CourseKVStore.objects.exists())
+        self.assertEqual((True, SyncRun.SUCCEEDED), (run.dry_run, run.status))
+
+        status = json.loads(self.client.get(reverse('admin:vle_syncrun_status', args=(run.pk,))).content.decode('utf-8'))
+        self.assertTrue(status['dryRun'])
+        self.assertIn('course_kv_store: 1 to create, 0 to update, 0 to delete', status['summary'].splitlines())
+
+    @override_settings(VLE_SYNC_RESUMABLE=True, VLE_SYNC_STAGED=True)
+    def test_incompatible_modes(self):
+        with mock.patch('vle.views.logger') as logger:
+            self.client.get(reverse('vle_full_sync'))
+        run = SyncRun.objects.get()
+        self.assertEqual((SyncRun.FAILED, 'A full sync can\'t combine resumable with staged'), (run.status, run.error))
+        self.assertTrue(logger.exception.called)
+
+    @mock.patch('vle.sync._fetch_and_sync', side_effect=DatabaseError('deadlock detected'))
+    def test_raises(self, fetch_and_sync):
+        with mock.patch('vle.views.logger') as logger:
+            self.client.get(reverse('vle_full_sync'))
+        run = SyncRun.objects.get()
+        self.assertEqual((SyncRun.FAILED, 'deadlock detected'), (run.status, run.error))
+        self.assertTrue(logger.exception.called)
+
+    def test_status(self):
+        run = SyncRun.objects.create(phase='diff', processed=50, expected=200)
+        status = json.loads(self.client.get(reverse('admin:vle_syncrun_status', args=(run.pk,))).content.decode('utf-8'))
+        self.assertEqual((SyncRun.RUNNING, 'diff', 50, 200), (status['status'], status['phase'], status['processed'], status['expected']))
+        self.assertEqual(404, self.client.get(reverse('admin:vle_syncrun_status', args=(run.pk + 1,))).status_code)
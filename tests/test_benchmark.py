@@ -0,0 +1,50 @@
+from django.test import TestCase
+
+from vle.benchmark import compare, generate, run_benchmark
+from vle.models import CourseKVStore, CourseMember, GroupMember
+
+
+class BenchmarkTestCase(TestCase):
+
+    def test_generate(self):
+        sections = generate(3, groups=2, members=4, tutor_ratio=0.5, users=10, seed=1)
+        rows = {key: list(value) for key, value in sections.items()}
+        self.assertEqual(3, len(rows['course_kv_store']))
+        self.assertEqual(6, len(rows['group_kv_store']))
+        self.assertEqual(12, len(rows['course_member']))
+        self.assertEqual(12, len(rows['group_member']))
+
+        # members are distinct within a course, and each in one of its groups
+        for course_id, name in rows['course_kv_store']:
+            usernames = [username for username, vle_course_id, is_tutor in rows['course_member'] if vle_course_id == course_id]
+            self.assertEqual(4, len(set(usernames)))
+            grouped = [username for username, vle_course_id, vle_group_id in rows['group_member'] if vle_course_id == course_id]
+            self.assertEqual(sorted(usernames), sorted(grouped))
+
+        # the same arguments generate the same data, and a different seed different data
+        again = {key: list(value) for key, value in generate(3, groups=2, members=4, tutor_ratio=0.5, users=10, seed=1).items()}
+        self.assertEqual(rows, again)
+        other = {key: list(value) for key, value in generate(3, groups=2, members=4, tutor_ratio=0.5, users=10, seed=2).items()}
+        self.assertNotEqual(rows['course_member'], other['course_member'])
+
+    def test_run_benchmark(self):
+        results = run_benchmark(40, groups=2, members=10, users=20)
+        self.assertEqual(
+            ['full_sync', 'full_sync_unchanged', 'expand_user_group_course_ids_to_user_ids', 'add_course_members', 'delete_course'],
+            list(results.keys())
+        )
+        self.assertTrue(all(metrics['seconds'] >= 0 and metrics['queries'] > 0 for metrics in results.values()))
+        self.assertTrue(all(metrics['peak_memory'] >= 0 for metrics in results.values()))
+
+        # course 0 was deleted and the benchmark course added
+        self.assertEqual(4, CourseKVStore.objects.count())
+        self.assertEqual(40, CourseMember.objects.count())
+        self.assertEqual(30, GroupMember.objects.count())
+
+    def test_compare(self):
+        baseline = {'10': {'full_sync': {'seconds': 1.0, 'queries': 10, 'peak_memory': 1000}}}
+        results = {'10': {'full_sync': {'seconds': 1.05, 'queries': 20, 'peak_memory': None}}}
+        self.assertEqual([
+            ('10 full_sync seconds: 1.000 -> 1.050 (+5.0%)', False),
+            ('10 full_sync queries: 10 -> 20 (+100.0%)', True),
+        ], compare(results, baseline))
@@ -0,0 +1,119 @@
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from django.contrib.auth import get_user_model
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import CommandError, call_command
+from django.test import TestCase, override_settings
+from django.utils.six import StringIO
+
+from vle.index import membership_index
+from vle.models import CourseMember, GroupMember, count_recipients, expand_user_group_course_ids_to_user_ids, is_recipient
+from vle.recipients import recipient_cache
+
+
+@override_settings(VLE_RECIPIENTS_INDEX=True)
+class MembershipIndexTestCase(TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.multiple(recipient_cache, alias='default', _cache=None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        recipient_cache.cache.clear()
+        membership_index.clear()
+        self.users = [get_user_model().objects.create_user(username='user%d' % i, password='Wibble123!') for i in range(4)]
+        CourseMember.objects.create(user=self.users[2], vle_course_id='001')
+        CourseMember.objects.create(user=self.users[0], vle_course_id='001')
+        GroupMember.objects.create(user=self.users[1], vle_course_id='001', vle_group_id='g1')
+        GroupMember.objects.create(user=self.users[3], vle_course_id='002', vle_group_id='g1')
+
+    def _expand(self, user_ids=(), group_ids=(), course_ids=()):
+        return expand_user_group_course_ids_to_user_ids('|', user_ids, group_ids, course_ids)
+
+    def test_expand(self):
+        pks = [user.pk for user in self.users]
+        self.assertEqual([pks[0], pks[2], pks[3]], self._expand(group_ids=['002|g1', '002|g2'], course_ids=['001', '003']))
+        self.assertEqual([0, pks[1], pks[3]], self._expand(user_ids=[pks[3], 0], group_ids=['001|g1', 'invalid']))
+
+        # each course is loaded once, and the users with them, so only the versions are read
+        with self.assertNumQueries(1):
+            self.assertEqual(pks, self._expand(user_ids=pks[3:], group_ids=['001|g1'], course_ids=['001']))
+
+    def test_count_and_is_recipient(self):
+        pks = [user.pk for user in self.users]
+        self.assertEqual(5, count_recipients('|', [pks[3], 0], ['001|g1'], ['001']))
+        # given users are recipients without the index being asked
+        with self.assertNumQueries(2):
+            self.assertTrue(is_recipient(pks[1], '|', [], ['001|g1'], []))
+            self.assertFalse(is_recipient(pks[3], '|', [], ['001|g1'], ['001']))
+            self.assertTrue(is_recipient(pks[3], '|', [pks[3]], [], ['001']))
+            self.assertTrue(is_recipient(0, '|', [0], [], []))
+
+    def test_roles(self):
+        pks = [user.pk for user in self.users]
+        CourseMember.objects.filter(user=self.users[2]).update(is_tutor=True)
+        CourseMember.objects.create(user=self.users[1], vle_course_id='001')
+        self.assertEqual(pks[2:3], self._expand_roles(['001|g1', '002|g1'], ['001'], is_tutor=True))
+        with self.assertNumQueries(5):
+            self.assertEqual(pks[:2], self._expand_roles(['001|g1', '002|g1'], ['001'], is_tutor=False))
+            self.assertEqual(pks[1:2], self._expand_roles(['001|g1'], [], is_tutor=False))
+            self.assertEqual(pks[1:2], self._expand_roles(['001|g1'], ['001'], is_tutor=False, exclude_user_ids=[pks[0]]))
+            self.assertEqual(1, count_recipients('|', [], [], ['001'], is_tutor=True))
+            self.assertFalse(is_recipient(pks[2], '|', [], [], ['001'], is_tutor=False))
+            self.assertFalse(is_recipient(pks[2], '|', [], [], ['001'], exclude_user_ids=[pks[2]]))
+
+    def _expand_roles(self, group_ids, course_ids, **kwargs):
+        return expand_user_group_course_ids_to_user_ids('|', [], group_ids, course_ids, **kwargs)
+
+    def test_patched(self):
+        pks = [user.pk for user in self.users]
+        self.assertEqual([pks[0], pks[2]], self._expand(course_ids=['001']))
+        self.assertEqual(pks[3:], self._expand(group_ids=['002|g1']))
+
+        # only the course written to is reloaded
+        CourseMember.objects.filter(user=self.users[0]).delete()
+        with self.assertNumQueries(3):
+            self.assertEqual(pks[2:3], self._expand(course_ids=['001']))
+        with self.assertNumQueries(1):
+            self.assertEqual(pks[3:], self._expand(group_ids=['002|g1']))
+
+        # and everything after a sync
+        recipient_cache.invalidate()
+        with self.assertNumQueries(3):
+            self.assertEqual(pks[3:], self._expand(group_ids=['002|g1']))
+
+    def test_syncing(self):
+        recipient_cache.start_sync()
+        self.assertIsNone(membership_index.expand([], [], ['001']))
+        self.assertEqual([self.users[0].pk, self.users[2].pk], self._expand(course_ids=['001']))
+        self.assertEqual({}, membership_index.courses)
+        self.assertRaises(CommandError, call_command, 'vle_recipients_index', stdout=StringIO())
+
+    def test_many_courses(self):
+        """
+        versions are kept in the database, so however many courses there are, none is culled
+        """
+        CourseMember.objects.bulk_create([CourseMember(user=self.users[0], vle_course_id='C%03d' % i) for i in range(400)])
+        recipient_cache.invalidate(['C%03d' % i for i in range(400)])
+        membership_index.build()
+        self.assertEqual(402, membership_index.get_stats()['courses'])
+        with self.assertNumQueries(1):
+            self.assertEqual([self.users[0].pk], self._expand(course_ids=['C000', 'C399']))
+
+    def test_not_versioned(self):
+        with mock.patch.object(recipient_cache, 'alias', None):
+            self.assertRaises(ImproperlyConfigured, self._expand, course_ids=['001'])
+            self.assertRaises(ImproperlyConfigured, membership_index.build)
+
+    def test_command(self):
+        out = StringIO()
+        call_command('vle_recipients_index', stdout=out)
+        self.assertIn('2 courses, 2 groups, 2 course members, 2 group members', out.getvalue())
+        self.assertEqual(
+            {'courses': 2, 'groups': 2, 'members': 2, 'group_members': 2},
+            dict((k, v) for k, v in membership_index.get_stats().items() if k != 'bytes')
+        )
+        with self.assertNumQueries(1):
+            self.assertEqual([self.users[0].pk, self.users[1].pk, self.users[2].pk], self._expand(group_ids=['001|g1'], course_ids=['001']))
@@ -0,0 +1,119 @@
+import datetime
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from django.test import TestCase
+from django.utils import timezone
+
+from vle.lease import Lease
+from vle.models import SyncLease, SyncRun
+from vle.sync import ATTACH, SKIP, WAIT, delta_sync, full_sync
+
+
+class LeaseTestCase(TestCase):
+
+    def test_acquire_and_release(self):
+        first, second = Lease(), Lease()
+        self.assertTrue(first.acquire())
+        self.assertFalse(second.acquire())
+        first.release()
+        self.assertTrue(second.acquire())
+        self.assertEqual(second.holder, SyncLease.objects.get().holder)
+
+    def test_expired(self):
+        """
+        a lease whose holder died is taken over once it expires
+        """
+        first, second = Lease(), Lease()
+        self.assertTrue(first.acquire())
+        SyncLease.objects.update(expires=timezone.now() - datetime.timedelta(seconds=1))
+        self.assertTrue(second.acquire())
+        self.assertFalse(first.renew())
+        first.release()
+        self.assertEqual(second.holder, SyncLease.objects.get().holder)
+
+    def test_renew(self):
+        lease = Lease(ttl=60)
+        lease.acquire()
+        SyncLease.objects.update(expires=timezone.now())
+        self.assertTrue(lease.renew())
+        self.assertTrue(SyncLease.objects.get().expires > timezone.now() + datetime.timedelta(seconds=59))
+
+    def test_kept_alive(self):
+        lease = Lease()
+        lease.acquire()
+        with lease.kept_alive():
+            self.assertTrue(SyncLease.objects.exists())
+        self.assertFalse(SyncLease.objects.exists())
+
+
+class BusySyncTestCase(TestCase):
+    """
+    syncing while another sync holds the lease
+    """
+
+    def setUp(self):
+        self.other = Lease()
+        self.other.acquire()
+        self.run = SyncRun.objects.create(status=SyncRun.SUCCEEDED)
+        self.other.set_run(self.run)
+
+    def _finish_other(self, seconds):
+        """
+        stands in for time.sleep, while which the other sync finishes
+        """
+        self.other.release()
+
+    @mock.patch('vle.moodle.requests.Session.get')
+    def test_skip(self, get):
+        self.assertEqual('VLE synchronization already in progress', full_sync(on_busy=SKIP))
+        self.assertFalse(get.called)
+        self.assertEqual(1, SyncRun.objects.count())
+
+    @mock.patch('vle.moodle.requests.Session.get')
+    def test_delta_skips(self, get):
+        self.assertEqual('VLE synchronization already in progress', delta_sync())
+        self.assertFalse(get.called)
+
+    @mock.patch('vle.moodle.requests.Session.get')
+    def test_attach(self, get):
+        with mock.patch('vle.lease.time.sleep', side_effect=self._finish_other) as sleep:
+            self.assertEqual('Full VLE synchronization completed successfully', full_sync(on_busy=ATTACH))
+        self.assertEqual(1, sleep.call_count)
+        self.assertFalse(get.called)
+
+    @mock.patch('vle.moodle.requests.Session.get')
+    def test_attach_failed(self, get):
+        SyncRun.objects.filter(pk=self.run.pk).update(status=SyncRun.FAILED, error='Oops')
+        with mock.patch('vle.lease.time.sleep', side_effect=self._finish_other):
+            self.assertEqual('Oops', full_sync(on_busy=ATTACH))
+
+    @mock.patch('vle.moodle.requests.Session.get')
+    def test_wait(self, get):
+        get.return_value.status_code = 200
+        get.return_value.json.return_value = {}
+        with mock.patch('vle.lease.time.sleep', side_effect=self._finish_other):
+            self.assertEqual('Full VLE synchronization completed successfully', full_sync(on_busy=WAIT))
+        self.assertTrue(get.called)
+        self.assertEqual(2, SyncRun.objects.count())
+        self.assertFalse(SyncLease.objects.exists())
+
+    @mock.patch('vle.moodle.requests.Session.get')
+    def test_dry_run(self, get):
+        """
+        a dry run doesn't write, so doesn't need the lease
+        """
+        get.return_value.status_code = 200
+        get.return_value.json.return_value = {}
+        self.assertEqual('Full VLE synchronization dry run completed successfully', full_sync(dry_run=True))
+
+    @mock.patch('vle.moodle.requests.Session.get')
+    def test_released_after_error(self, get):
+        self.other.release()
+        get.side_effect = ValueError('Bad JSON')
+        with self.assertRaises(ValueError):
+            full_sync()
+        self.assertFalse(SyncLease.objects.exists())
@@ -5,7 +5,9 @@ from django.test import TestCase
 
 import pytest
 
-from vle.models import CourseMember, GroupMember, GroupKVStore, expand_user_group_course_ids_to_user_ids
+from vle.models import CourseKVStore, CourseMember, GroupMember, GroupKVStore, purge_courses
+from vle.models import count_recipients, expand_user_group_course_ids_to_user_ids, get_recipient_queries, is_recipient
+from vle.models import iter_expand_user_group_course_ids_to_user_ids
 
 
 class ModelsTestCase(TestCase):
@@ -114,6 +116,25 @@ class GetGroupsFilterTestCase(TestCase):
         self.assertEqual(self.group002, g[1].vle_group_id)
 
 
+class PurgeCoursesTestCase(TestCase):
+
+    def setUp(self):
+        user = get_user_model().objects.create_user(username='sansa.stark', password='Wibble123!')
+        for vle_course_id in ['001', '002', '003']:
+            CourseKVStore.objects.create(vle_course_id=vle_course_id, name='Course %s' % vle_course_id)
+            GroupKVStore.objects.create(vle_course_id=vle_course_id, vle_group_id='g1', name='Group')
+            CourseMember.objects.create(user=user, vle_course_id=vle_course_id)
+            GroupMember.objects.create(user=user, vle_course_id=vle_course_id, vle_group_id='g1')
+
+    def test_purge_courses(self):
+        # one DELETE per model per batch of courses, in a transaction
+        with self.assertNumQueries(10):
+            deleted = purge_courses(['001', '002', '004'], batch_size=2)
+        self.assertEqual([2, 2, 2, 2], list(deleted.values()))
+        for model in (CourseKVStore, GroupKVStore, CourseMember, GroupMember):
+            self.assertEqual(['003'], list(model.objects.values_list('vle_course_id', flat=True)))
+
+
 @pytest.mark.django_db
 def test_expand_user_group_course_ids_to_user_ids():
     delimiter = '::'
@@ -149,3 +170,180 @@ def test_expand_user_group_course_ids_to_user_ids():
     course_ids = ['001']
     result = expand_user_group_course_ids_to_user_ids(delimiter, user_ids, group_ids, course_ids)
     assert result == list(map(lambda k: users[k].pk, first_names))
+
+
+class ExpandTestCase(TestCase):
+
+    delimiter = '::'
+
+    def setUp(self):
+        self.users = [get_user_model().objects.create_user(username='user%d' % i, password='Wibble123!') for i in range(6)]
+
+        # users 0 to 3 in course 001, 2 and 3 in its group g1, 4 in group g1 of course 002, and 5 in group g2 of course 001
+        for user in self.users[:4]:
+            CourseMember.objects.create(user=user, vle_course_id='001')
+        for user in self.users[2:4]:
+            GroupMember.objects.create(user=user, vle_course_id='001', vle_group_id='g1')
+        GroupMember.objects.create(user=self.users[4], vle_course_id='002', vle_group_id='g1')
+        GroupMember.objects.create(user=self.users[5], vle_course_id='001', vle_group_id='g2')
+
+    def _ids(self, *indexes):
+        return [self.users[i].pk for i in indexes]
+
+    def test_one_query(self):
+        with self.assertNumQueries(1):
+            result = expand_user_group_course_ids_to_user_ids(self.delimiter, self._ids(5), ['001::g1', '002::g1'], ['001'])
+        self.assertEqual(self._ids(0, 1, 2, 3, 4, 5), result)
+
+    def test_groups_are_pairs(self):
+        # g1 of course 001 isn't g1 of course 002, nor g2 of course 001
+        self.assertEqual(self._ids(2, 3), expand_user_group_course_ids_to_user_ids(self.delimiter, [], ['001::g1', 'g2'], []))
+
+    def test_given_users(self):
+        """
+        users given explicitly are returned as they are, whether or not they exist
+        """
+        self.assertEqual(self._ids(0) + [999], expand_user_group_course_ids_to_user_ids(self.delimiter, [999] + self._ids(0, 0), [], []))
+        self.assertEqual([], expand_user_group_course_ids_to_user_ids(self.delimiter, [], [], []))
+
+    def test_overlapping(self):
+        """
+        users in several of the courses (or groups) are returned once, as by the membership index
+        """
+        for user in self.users[:2]:
+            CourseMember.objects.create(user=user, vle_course_id='002')
+        GroupMember.objects.create(user=self.users[2], vle_course_id='001', vle_group_id='g2')
+        CourseMember.objects.filter(user__in=self._ids(0, 2)).update(is_tutor=True)
+        self.assertEqual(self._ids(0, 1, 2, 3), expand_user_group_course_ids_to_user_ids(self.delimiter, [], [], ['001', '002']))
+        self.assertEqual(self._ids(1, 3), expand_user_group_course_ids_to_user_ids(self.delimiter, [], [], ['001', '002'], is_tutor=False))
+        self.assertEqual(self._ids(2, 3, 5), expand_user_group_course_ids_to_user_ids(self.delimiter, [], ['001::g1', '001::g2'], []))
+        self.assertEqual(self._ids(2), expand_user_group_course_ids_to_user_ids(self.delimiter, [], ['001::g1', '001::g2'], [], is_tutor=True))
+
+    def test_count_overlapping(self):
+        """
+        users in several of the courses (or groups) are counted once, in one query or split across several
+        """
+        for user in self.users[:2]:
+            CourseMember.objects.create(user=user, vle_course_id='002')
+        GroupMember.objects.create(user=self.users[2], vle_course_id='001', vle_group_id='g2')
+        for args in (
+            (self.delimiter, [], [], ['001', '002']),
+            (self.delimiter, [], ['001::g1', '001::g2'], []),
+            (self.delimiter, self._ids(0), ['001::g1', '001::g2'], ['001', '002']),
+        ):
+            for batch_size in (1, 3, 100):
+                with self.settings(VLE_SYNC_BATCH_SIZE=batch_size):
+                    self.assertEqual(len(expand_user_group_course_ids_to_user_ids(*args)), count_recipients(*args))
+
+    def test_split_queries(self):
+        queries = get_recipient_queries(self.delimiter, self._ids(0, 5), ['001::g1', '002::g1'], ['001', '002'], batch_size=3)
+        self.assertEqual([2, 2, 2, 2], [len(params) for sql, params in queries])
+        with self.settings(VLE_SYNC_BATCH_SIZE=3):
+            with self.assertNumQueries(4):
+                result = expand_user_group_course_ids_to_user_ids(self.delimiter, self._ids(0, 5), ['001::g1', '002::g1'], ['001', '002'])
+        self.assertEqual(self._ids(0, 1, 2, 3, 4, 5), result)
+
+    def test_iter(self):
+        batches = iter_expand_user_group_course_ids_to_user_ids(self.delimiter, self._ids(5), ['001::g1', '002::g1'], ['001'], batch_size=4)
+        with self.assertNumQueries(1):
+            self.assertEqual(self._ids(0, 1, 2, 3), next(batches))
+        with self.assertNumQueries(1):
+            self.assertEqual([self._ids(4, 5)], list(batches))
+
+        # across split queries, each paginated
+        with self.settings(VLE_SYNC_BATCH_SIZE=4):
+            batches = iter_expand_user_group_course_ids_to_user_ids(
+                self.delimiter, self._ids(0, 5), ['001::g1', '002::g1'], ['001', '002'], batch_size=2
+            )
+            self.assertEqual([self._ids(0, 1), self._ids(2, 3), self._ids(4, 5)], list(batches))
+        self.assertEqual([], list(iter_expand_user_group_course_ids_to_user_ids(self.delimiter, [], [], [])))
+
+    def test_iter_pages(self):
+        """
+        a page of only excluded users isn't mistaken for the last
+        """
+        batches = iter_expand_user_group_course_ids_to_user_ids(
+            self.delimiter, self._ids(5), ['001::g1', '002::g1'], ['001'], batch_size=2, exclude_user_ids=self._ids(0, 1)
+        )
+        with self.assertNumQueries(3):
+            self.assertEqual([self._ids(2, 3), self._ids(4, 5)], list(batches))
+
+    def test_iter_overlapping(self):
+        """
+        users in several of the courses and groups are returned once, and none are skipped, whatever the page size,
+        nor are given users beyond the first page
+        """
+        for user in self.users[:2]:
+            CourseMember.objects.create(user=user, vle_course_id='002')
+        GroupMember.objects.create(user=self.users[2], vle_course_id='002', vle_group_id='g1')
+        args = (self.delimiter, [], ['001::g1', '002::g1'], ['001', '002'])
+        for batch_size in (1, 2, 3, 10):
+            batches = iter_expand_user_group_course_ids_to_user_ids(*args, batch_size=batch_size)
+            self.assertEqual(self._ids(0, 1, 2, 3, 4), [user_id for batch in batches for user_id in batch])
+            with self.settings(VLE_SYNC_BATCH_SIZE=4):
+                batches = iter_expand_user_group_course_ids_to_user_ids(*args, batch_size=batch_size)
+                self.assertEqual(self._ids(0, 1, 2, 3, 4), [user_id for batch in batches for user_id in batch])
+        self.assertEqual(
+            [self._ids(0, 1), self._ids(2, 3), [999]],
+            list(iter_expand_user_group_course_ids_to_user_ids(self.delimiter, [999], [], ['001', '002'], batch_size=2))
+        )
+
+    def test_count(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(7, count_recipients(self.delimiter, self._ids(5) + [999], ['001::g1', '002::g1'], ['001']))
+        self.assertEqual(2, count_recipients(self.delimiter, [], ['001::g1'], []))
+        self.assertEqual(0, count_recipients(self.delimiter, [], [], []))
+
+        # across split queries, overlapping ids are counted once
+        with self.settings(VLE_SYNC_BATCH_SIZE=3):
+            self.assertEqual(6, count_recipients(self.delimiter, self._ids(0, 5), ['001::g1', '002::g1'], ['001', '002']))
+
+    def test_is_recipient(self):
+        with self.assertNumQueries(1):
+            self.assertTrue(is_recipient(self.users[4].pk, self.delimiter, [], ['002::g1'], ['001']))
+        self.assertFalse(is_recipient(self.users[5].pk, self.delimiter, [], ['001::g1', '002::g1'], ['001']))
+        with self.assertNumQueries(0):
+            self.assertTrue(is_recipient(self.users[5].pk, self.delimiter, self._ids(5), [], []))
+            self.assertTrue(is_recipient(999, self.delimiter, [999], [], []))
+        with self.settings(VLE_SYNC_BATCH_SIZE=3):
+            self.assertTrue(is_recipient(self.users[1].pk, self.delimiter, self._ids(0, 5), ['001::g1', '002::g1'], ['001', '002']))
+
+    def test_roles(self):
+        # users 0 and 2 are tutors in course 001, and user 4 is in a group of course 002 without being one of its members
+        CourseMember.objects.filter(user__in=self._ids(0, 2)).update(is_tutor=True)
+        args = (self.delimiter, self._ids(5), ['001::g1', '002::g1'], ['001'])
+        with self.assertNumQueries(1):
+            self.assertEqual(self._ids(0, 2, 5), expand_user_group_course_ids_to_user_ids(*args, is_tutor=True))
+        self.assertEqual(self._ids(1, 3, 5), expand_user_group_course_ids_to_user_ids(*args, is_tutor=False))
+        self.assertEqual(self._ids(2), expand_user_group_course_ids_to_user_ids(self.delimiter, [], ['001::g1'], [], is_tutor=True))
+        self.assertEqual(2, count_recipients(*args, is_tutor=False, exclude_user_ids=self._ids(5)))
+        self.assertFalse(is_recipient(self.users[4].pk, *args, is_tutor=False))
+        self.assertEqual([self._ids(1), self._ids(3)], list(iter_expand_user_group_course_ids_to_user_ids(
+            *args, batch_size=1, is_tutor=False, exclude_user_ids=self._ids(5)
+        )))
+
+    def test_exclude(self):
+        args = (self.delimiter, self._ids(5), ['001::g1', '002::g1'], ['001'])
+        with self.assertNumQueries(1):
+            self.assertEqual(self._ids(1, 2, 3, 4), expand_user_group_course_ids_to_user_ids(*args, exclude_user_ids=self._ids(0, 5)))
+        self.assertFalse(is_recipient(self.users[0].pk, *args, exclude_user_ids=self._ids(0)))
+
+        # excluded from each of the split queries
+        with self.settings(VLE_SYNC_BATCH_SIZE=4):
+            result = expand_user_group_course_ids_to_user_ids(
+                self.delimiter, self._ids(0, 5), ['001::g1', '002::g1'], ['001', '002'], is_tutor=False, exclude_user_ids=self._ids(3)
+            )
+        self.assertEqual(self._ids(0, 1, 2, 5), result)
+
+    def test_exclude_many(self):
+        """
+        more excluded users than fit in a query are left out all the same, but can't be given to get_recipient_queries
+        """
+        args = (self.delimiter, self._ids(5), ['001::g1', '002::g1'], ['001'])
+        exclude_user_ids = self._ids(0, 1, 3) + [997, 998, 999]
+        with self.settings(VLE_SYNC_BATCH_SIZE=4):
+            self.assertEqual(self._ids(2, 4, 5), expand_user_group_course_ids_to_user_ids(*args, exclude_user_ids=exclude_user_ids))
+            self.assertEqual(3, count_recipients(*args, exclude_user_ids=exclude_user_ids))
+            self.assertEqual([self._ids(2, 4, 5)], list(iter_expand_user_group_course_ids_to_user_ids(*args, exclude_user_ids=exclude_user_ids)))
+            with self.assertRaises(ValueError):
+                get_recipient_queries(*args, exclude_user_ids=exclude_user_ids)
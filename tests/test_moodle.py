@@ -0,0 +1,215 @@
+import gzip
+import json
+import threading
+import time
+import zlib
+
+from django.contrib.auth import get_user_model
+from django.test import TestCase, override_settings
+from django.utils.six import BytesIO
+from django.utils.six.moves import BaseHTTPServer, socketserver
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from vle.models import CourseKVStore, CourseMember, SyncState
+from vle.moodle import ETAG, LAST_MODIFIED
+from vle.sync import full_sync
+
+
+class _StubMoodleHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    serves the server's payload, compressed as the client prefers, honouring If-None-Match
+    and recording each request's headers and client port (or answers the first requests with the server's errors)
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append((dict(self.headers.items()), self.client_address[1]))
+        time.sleep(server.delay)
+        if server.errors:
+            status, body = server.errors.pop(0)
+            self.send_response(status)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        if server.etag and self.headers.get('If-None-Match') == server.etag:
+            self.send_response(304)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = json.dumps(server.payload).encode('utf-8')
+        encoding = self.headers.get('Accept-Encoding', '')
+        self.send_response(200)
+        if server.encoding in encoding and server.encoding == 'gzip':
+            buf = BytesIO()
+            with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+                f.write(body)
+            body = buf.getvalue()
+            self.send_header('Content-Encoding', 'gzip')
+        elif server.encoding in encoding and server.encoding == 'deflate':
+            body = zlib.compress(body)
+            self.send_header('Content-Encoding', 'deflate')
+        if server.etag:
+            self.send_header('ETag', server.etag)
+            self.send_header('Last-Modified', 'Sat, 17 Oct 2026 09:00:00 GMT')
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class _StubMoodleServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    payload = {}
+    encoding = 'gzip'
+    etag = None
+    delay = 0
+    errors = ()
+
+    def handle_error(self, request, client_address):
+        # the client hanging up on a delayed response is expected
+        pass
+
+
+class MoodleClientTestCase(TestCase):
+
+    def setUp(self):
+        get_user_model().objects.create_user(username='cersei.lannister', password='Wibble123!')
+        self.server = _StubMoodleServer(('127.0.0.1', 0), _StubMoodleHandler)
+        self.server.requests = []
+        self.server.errors = []
+        self.server.payload = {
+            'course_kv_store': [{'vle_course_id': '001', 'name': 'Course 1'}],
+            'group_kv_store': [],
+            'course_member': [{'username': 'cersei.lannister', 'vle_course_id': '001', 'is_tutor': True}],
+            'group_member': [],
+        }
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.settings = override_settings(MOODLEWWWROOT='http://127.0.0.1:%d' % self.server.server_address[1])
+        self.settings.enable()
+
+    def tearDown(self):
+        self.settings.disable()
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def _assert_synced(self):
+        self.assertEqual(['001'], list(CourseKVStore.objects.values_list('vle_course_id', flat=True)))
+        self.assertEqual(1, CourseMember.objects.filter(vle_course_id='001', is_tutor=True).count())
+
+    def test_gzip(self):
+        self.assertEqual('Full VLE synchronization completed successfully', full_sync())
+        self._assert_synced()
+        headers, port = self.server.requests[0]
+        self.assertIn('gzip', headers['Accept-Encoding'])
+        self.assertIn('deflate', headers['Accept-Encoding'])
+
+    def test_deflate(self):
+        self.server.encoding = 'deflate'
+        self.assertEqual('Full VLE synchronization completed successfully', full_sync(stream=True))
+        self._assert_synced()
+
+    @override_settings(VLE_SYNC_FETCH_WORKERS=1)
+    def test_keep_alive(self):
+        """
+        every page of a paged sync is requested over the same connection
+        """
+        self.assertEqual('Full VLE synchronization completed successfully', full_sync(paged=True))
+        self._assert_synced()
+        self.assertEqual(4, len(self.server.requests))
+        self.assertEqual(1, len(set(port for headers, port in self.server.requests)))
+
+    def test_conditional(self):
+        self.server.etag = '"v1"'
+        self.assertEqual('Full VLE synchronization completed successfully', full_sync(conditional=True))
+        self._assert_synced()
+        self.assertNotIn('If-None-Match', self.server.requests[0][0])
+        self.assertEqual('"v1"', SyncState.get_value(ETAG))
+        self.assertEqual('Sat, 17 Oct 2026 09:00:00 GMT', SyncState.get_value(LAST_MODIFIED))
+
+        # nothing has changed, so nothing is reconciled
+        CourseMember.objects.all().delete()
+        self.assertEqual('Full VLE synchronization skipped as nothing has changed in Moodle', full_sync(conditional=True))
+        self.assertEqual('"v1"', self.server.requests[1][0]['If-None-Match'])
+        self.assertEqual('Sat, 17 Oct 2026 09:00:00 GMT', self.server.requests[1][0]['If-Modified-Since'])
+        self.assertEqual(0, CourseMember.objects.count())
+
+        # until it has
+        self.server.etag = '"v2"'
+        self.assertEqual('Full VLE synchronization completed successfully', full_sync(conditional=True))
+        self._assert_synced()
+        self.assertEqual('"v2"', SyncState.get_value(ETAG))
+
+    def test_conditional_unknown_usernames(self):
+        """
+        validators aren't stored while any usernames are unknown, so their memberships are tried again next time
+        """
+        self.server.etag = '"v1"'
+        self.server.payload['course_member'].append({'username': 'jaime.lannister', 'vle_course_id': '001', 'is_tutor': False})
+        self.assertEqual('Full VLE synchronization completed successfully', full_sync(conditional=True))
+        self.assertIsNone(SyncState.get_value(ETAG))
+
+        get_user_model().objects.create_user(username='jaime.lannister', password='Wibble123!')
+        self.assertEqual('Full VLE synchronization completed successfully', full_sync(conditional=True))
+        self.assertNotIn('If-None-Match', self.server.requests[1][0])
+        self.assertEqual(2, CourseMember.objects.count())
+        self.assertEqual('"v1"', SyncState.get_value(ETAG))
+
+    def test_conditional_dry_run(self):
+        """
+        a dry run doesn't store validators, so the next sync isn't skipped
+        """
+        self.server.etag = '"v1"'
+        full_sync(conditional=True, dry_run=True)
+        self.assertIsNone(SyncState.get_value(ETAG))
+        self.assertEqual('Full VLE synchronization completed successfully', full_sync(conditional=True))
+        self._assert_synced()
+
+    @override_settings(VLE_SYNC_READ_TIMEOUT=0.1)
+    def test_read_timeout(self):
+        self.server.delay = 0.5
+        self.assertTrue(full_sync().startswith('Moodle timed out'))
+        self.assertEqual(1, len(self.server.requests))
+        self.assertEqual(0, CourseKVStore.objects.count())
+
+    @mock.patch('vle.moodle.Retry.get_backoff_time', return_value=0)
+    def test_unavailable(self, get_backoff_time):
+        """
+        a 503 is retried, and once the retries are used up its error message is returned
+        """
+        self.server.errors = [(503, b'{"errorMessage": "Moodle is in maintenance mode"}')] * 4
+        self.assertEqual('Moodle is in maintenance mode', full_sync())
+        self.assertEqual(4, len(self.server.requests))
+        self.assertEqual(0, CourseKVStore.objects.count())
+
+    @mock.patch('vle.moodle.Retry.get_backoff_time', return_value=0)
+    def test_unavailable_recovers(self, get_backoff_time):
+        self.server.errors = [(502, b'<html>Bad Gateway</html>'), (503, b'')]
+        self.assertEqual('Full VLE synchronization completed successfully', full_sync())
+        self.assertEqual(3, len(self.server.requests))
+        self._assert_synced()
+
+    @mock.patch('vle.moodle.Retry.get_backoff_time', return_value=0)
+    def test_error_page(self, get_backoff_time):
+        self.server.errors = [(503, b'<html>Service Unavailable</html>')] * 4
+        self.assertEqual('Moodle responded with status 503', full_sync())
+
+    @mock.patch('vle.moodle.Retry.get_backoff_time', return_value=0)
+    def test_unreachable(self, get_backoff_time):
+        # a port nothing is listening on
+        closed = _StubMoodleServer(('127.0.0.1', 0), _StubMoodleHandler)
+        closed.server_close()
+        with override_settings(MOODLEWWWROOT='http://127.0.0.1:%d' % closed.server_address[1]):
+            self.assertTrue(full_sync().startswith('Moodle could not be reached'))
+        self.assertEqual(0, CourseKVStore.objects.count())
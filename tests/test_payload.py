@@ -0,0 +1,89 @@
+# -*- coding: UTF-8 -*-
+
+import json
+
+from django.contrib.auth import get_user_model
+from django.test import TestCase
+
+from vle.models import CourseKVStore, CourseMember
+from vle.payload import iter_sections
+from vle.sync import _sync_course_kv_store, _sync_course_member
+
+
+def _chunked(s, size):
+    b = s.encode('utf-8')
+    return [b[i:i + size] for i in range(0, len(b), size)]
+
+
+class IterSectionsTestCase(TestCase):
+
+    payload = {
+        'course_kv_store': [
+            {'vle_course_id': '001', 'name': u'Mucho dinero £££'},
+            {'vle_course_id': '002', 'name': u'Dragons'},
+        ],
+        'group_kv_store': [],
+        'high_water_mark': 12345,
+        'course_member': [
+            {'username': 'cersei.lannister', 'vle_course_id': '001', 'is_tutor': True},
+        ],
+    }
+
+    def _parse(self, chunk_size):
+        sections = iter_sections(_chunked(json.dumps(self.payload, indent=1), chunk_size))
+        return [(k, v if isinstance(v, int) else list(v)) for k, v in sections]
+
+    def test_parse_whole(self):
+        self.assertEqual(sorted(self.payload.items()), sorted(self._parse(1024 * 1024)))
+
+    def test_parse_byte_by_byte(self):
+        """
+        multi-byte characters and numbers are split across chunks
+        """
+        self.assertEqual(sorted(self.payload.items()), sorted(self._parse(1)))
+
+    def test_split_floats(self):
+        """
+        a number isn't complete until something that can't be more of it follows, wherever the chunk ends
+        """
+        s = '{"a": 26864.17, "b": [1.5e-3, -2E+10, 7], "c": 1}'
+        for size in range(1, 7):
+            sections = [(k, v if isinstance(v, (int, float)) else list(v)) for k, v in iter_sections(_chunked(s, size))]
+            self.assertEqual([('a', 26864.17), ('b', [1.5e-3, -2E+10, 7]), ('c', 1)], sections)
+
+    def test_unconsumed_sections_are_skipped(self):
+        keys = [k for k, v in iter_sections(_chunked(json.dumps(self.payload), 7))]
+        self.assertEqual(sorted(self.payload.keys()), sorted(keys))
+
+    def test_partially_consumed_section(self):
+        sections = iter_sections(_chunked(json.dumps({'a': [1, 2, 3], 'b': [4]}), 3))
+        key, items = next(sections)
+        self.assertEqual(('a', 1), (key, next(items)))
+        key, items = next(sections)
+        self.assertEqual(('b', [4]), (key, list(items)))
+
+    def test_empty_object(self):
+        self.assertEqual([], list(iter_sections([b' { } '])))
+
+    def test_truncated(self):
+        with self.assertRaises(ValueError):
+            for key, items in iter_sections(_chunked('{"a": [{"b": 1}, {"b":', 4)):
+                list(items)
+
+
+class StreamingSyncTestCase(TestCase):
+
+    def test_sync_from_stream(self):
+        get_user_model().objects.create_user(username='cersei.lannister', password='Wibble123!')
+        payload = json.dumps({
+            'course_kv_store': [{'vle_course_id': '%03d' % i, 'name': 'Course %d' % i} for i in range(100)],
+            'course_member': [{'username': 'cersei.lannister', 'vle_course_id': '%03d' % i, 'is_tutor': False} for i in range(100)],
+        })
+        syncs = {
+            'course_kv_store': _sync_course_kv_store,
+            'course_member': _sync_course_member,
+        }
+        for key, items in iter_sections(_chunked(payload, 64)):
+            syncs[key](items)
+        self.assertEqual(100, CourseKVStore.objects.all().count())
+        self.assertEqual(100, CourseMember.objects.all().count())
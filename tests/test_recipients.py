@@ -0,0 +1,129 @@
+import base64
+import json
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.urlresolvers import reverse
+from django.test import TestCase
+from django.utils.encoding import force_str
+
+from vle.models import CourseKVStore, CourseMember, GroupMember, count_recipients, expand_user_group_course_ids_to_user_ids, is_recipient
+from vle.recipients import recipient_cache
+from vle.sync import full_sync
+
+
+class RecipientCacheTestCase(TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.multiple(recipient_cache, alias='default', _cache=None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        recipient_cache.cache.clear()
+        self.users = [get_user_model().objects.create_user(username='user%d' % i, password='Wibble123!') for i in range(3)]
+        CourseKVStore.objects.create(vle_course_id='001', name='Course 1')
+        CourseMember.objects.create(user=self.users[0], vle_course_id='001')
+        GroupMember.objects.create(user=self.users[0], vle_course_id='002', vle_group_id='g1')
+
+    def _expand(self, user_ids=(), group_ids=(), course_ids=()):
+        return expand_user_group_course_ids_to_user_ids('|', user_ids, group_ids, course_ids)
+
+    def _assert_cached(self, expected, **kwargs):
+        # but for the versions
+        with self.assertNumQueries(1):
+            self.assertEqual(expected, self._expand(**kwargs))
+
+    def test_cached(self):
+        pks = [user.pk for user in self.users]
+        self.assertEqual(pks[:1], self._expand(course_ids=['001']))
+        self._assert_cached(pks[:1], course_ids=['001'])
+
+        # the same ids in another order (or repeated) are the same key
+        self.assertEqual(pks[:1], self._expand(group_ids=['002|g1'], course_ids=['001']))
+        self._assert_cached(pks[:1], group_ids=['002|g1', '002|g1'], course_ids=['001'])
+
+    @mock.patch.object(recipient_cache, 'timeout', 0)
+    def test_off(self):
+        self._expand(course_ids=['001'])
+        with self.assertNumQueries(1):
+            self._expand(course_ids=['001'])
+
+    def test_no_cache(self):
+        """
+        without a cache that every process shares, nothing is cached, as other processes' writes couldn't be seen
+        """
+        with mock.patch.multiple(recipient_cache, alias=None, _cache=None):
+            self._expand(course_ids=['001'])
+            with self.assertNumQueries(1):
+                self._expand(course_ids=['001'])
+            self.assertIsNone(recipient_cache.get_versions(['001']))
+
+    def test_signals(self):
+        pks = [user.pk for user in self.users]
+        self.assertEqual(pks[:1], self._expand(group_ids=['002|g1'], course_ids=['001']))
+        self.assertEqual([], self._expand(course_ids=['003']))
+
+        # a member of one of the courses is saved
+        CourseMember.objects.create(user=self.users[1], vle_course_id='001')
+        self.assertEqual(pks[:2], self._expand(group_ids=['002|g1'], course_ids=['001']))
+        self._assert_cached([], course_ids=['003'])
+
+        # a member of a group moves course
+        GroupMember.objects.filter(vle_course_id='002').update(user=self.users[2])
+        member = GroupMember.objects.get()
+        member.vle_course_id = '003'
+        member.save()
+        self.assertEqual([], self._expand(group_ids=['002|g1']))
+
+        # or is deleted, along with their user (who is still returned if given explicitly)
+        self.users[0].delete()
+        self.assertEqual(pks[1:2], self._expand(course_ids=['001']))
+        self.assertEqual(pks[:2], self._expand(user_ids=pks[:1], course_ids=['001']))
+
+    def test_webhooks(self):
+        pks = [user.pk for user in self.users]
+        self.assertEqual(pks[:1], self._expand(course_ids=['001']))
+        joined = ':'.join(settings.VLE_SYNC_BASIC_AUTH)
+        response = self.client.post(
+            reverse('vle_api:add_course_members'),
+            content_type='application/json',
+            data=json.dumps({'vle_course_id': '001', 'usernames': ['user1', 'user2']}),
+            HTTP_AUTHORIZATION=force_str(b'Basic ' + base64.b64encode(joined.encode('utf-8')))
+        )
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(pks, self._expand(course_ids=['001']))
+
+    @mock.patch('vle.moodle.requests.Session.get')
+    def test_sync(self, get):
+        pks = [user.pk for user in self.users]
+        self.assertEqual(pks[:1], self._expand(course_ids=['001']))
+        payload = {
+            u'course_kv_store': [{u'vle_course_id': '001', u'name': 'Course 1'}],
+            u'course_member': [{u'username': 'user2', u'vle_course_id': '001', u'is_tutor': False}],
+        }
+        get.return_value.status_code = 200
+        get.return_value.content = b''
+
+        # nothing is cached while the sync is writing
+        def get_payload(*args, **kwargs):
+            self.assertIsNone(recipient_cache.get_versions(['001']))
+            return payload
+        get.return_value.json.side_effect = get_payload
+
+        full_sync()
+        self.assertEqual(pks[2:], self._expand(course_ids=['001']))
+        self._assert_cached(pks[2:], course_ids=['001'])
+
+    def test_count_and_is_recipient(self):
+        self.assertEqual(1, count_recipients('|', [], ['002|g1'], ['001']))
+        self.assertFalse(is_recipient(self.users[1].pk, '|', [], [], ['001']))
+        with self.assertNumQueries(2):
+            self.assertEqual(1, count_recipients('|', [], ['002|g1'], ['001']))
+            self.assertFalse(is_recipient(self.users[1].pk, '|', [], [], ['001']))
+        CourseMember.objects.create(user=self.users[1], vle_course_id='001')
+        self.assertEqual(2, count_recipients('|', [], ['002|g1'], ['001']))
+        self.assertTrue(is_recipient(self.users[1].pk, '|', [], [], ['001']))
@@ -0,0 +1,66 @@
+from django.contrib.auth import get_user_model
+from django.test import TestCase
+
+from vle.resolvers import UsernameResolver, resolver
+
+
+class UsernameResolverTestCase(TestCase):
+
+    def setUp(self):
+        self.users = {}
+        for first_name in [u'Cersei', u'Jaime', u'Tyrion', u'Tywin']:
+            self.users[first_name] = get_user_model().objects.create_user(username='%s.lannister' % first_name.lower(), password='Wibble123!')
+
+    def test_resolve_in_chunks(self):
+        r = UsernameResolver(batch_size=3)
+        with self.assertNumQueries(2):
+            user_ids, unknown = r.resolve(['cersei.lannister', 'jaime.lannister', 'tyrion.lannister', 'tywin.lannister', 'unknown.user'])
+        self.assertEqual({'%s.lannister' % k.lower(): v.pk for k, v in self.users.items()}, user_ids)
+        self.assertEqual({'unknown.user'}, unknown)
+
+    def test_cache(self):
+        r = UsernameResolver(cache_size=2)
+        r.resolve(['cersei.lannister', 'jaime.lannister'])
+        with self.assertNumQueries(0):
+            self.assertEqual(({'cersei.lannister': self.users['Cersei'].pk}, set()), r.resolve(['cersei.lannister']))
+
+        # Jaime is least recently used, so is evicted
+        r.resolve(['tyrion.lannister'])
+        self.assertEqual(['cersei.lannister', 'tyrion.lannister'], list(r.cache.keys()))
+
+        # unknown usernames are never cached
+        with self.assertNumQueries(1):
+            r.resolve(['cersei.lannister', 'unknown.user'])
+
+    def test_invalidate(self):
+        r = UsernameResolver(cache_size=2)
+        r.resolve(['cersei.lannister', 'jaime.lannister', 'tyrion.lannister'])
+        self.assertEqual({v: k for k, v in r.cache.items()}, r.usernames)
+
+        # a user is found by id, whatever it's called now
+        tyrion = self.users['Tyrion']
+        tyrion.username = 'the.imp'
+        r.invalidate(tyrion)
+        self.assertEqual(1, len(r.cache))
+        self.assertEqual({v: k for k, v in r.cache.items()}, r.usernames)
+
+        r.invalidate()
+        self.assertEqual(({}, {}), (dict(r.cache), r.usernames))
+
+    def test_cache_invalidated_by_signals(self):
+        resolver.cache_size = 10
+        try:
+            resolver.resolve(['cersei.lannister', 'jaime.lannister', 'tyrion.lannister'])
+
+            # renaming a user forgets its old username
+            self.users['Cersei'].username = 'cersei.baratheon'
+            self.users['Cersei'].save()
+            self.assertEqual(({}, {'cersei.lannister'}), resolver.resolve(['cersei.lannister']))
+
+            # so does deleting a user
+            self.users['Jaime'].delete()
+            self.assertEqual(({}, {'jaime.lannister'}), resolver.resolve(['jaime.lannister']))
+            self.assertEqual(['tyrion.lannister'], list(resolver.cache.keys()))
+        finally:
+            resolver.cache_size = 0
+            resolver.invalidate()
@@ -0,0 +1,136 @@
+# -*- coding: UTF-8 -*-
+
+import gzip
+import json
+import os
+import shutil
+import tempfile
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils.six import StringIO
+
+from vle.lease import Lease
+from vle.models import CourseKVStore, GroupKVStore, CourseMember, GroupMember, SyncLease, SyncState
+from vle.snapshot import HIGH_WATER_MARK, dump_snapshot, iter_snapshot_json, load_snapshot, read_snapshot
+from vle.sync import full_sync
+
+
+class SnapshotTestCase(TestCase):
+
+    def setUp(self):
+        self.users = {}
+        for first_name in [u'Arya', u'Bran', u'Sansa']:
+            self.users[first_name] = get_user_model().objects.create_user(username='%s.stark' % first_name.lower(), password='Wibble123!')
+        CourseKVStore.objects.create(vle_course_id='001', name=u'Needlework £')
+        CourseKVStore.objects.create(vle_course_id='002', name='Swordplay')
+        GroupKVStore.objects.create(vle_course_id='001', vle_group_id='g1', name='Beginners')
+        CourseMember.objects.create(user=self.users['Arya'], vle_course_id='002')
+        CourseMember.objects.create(user=self.users['Sansa'], vle_course_id='001', is_tutor=True)
+        GroupMember.objects.create(user=self.users['Sansa'], vle_course_id='001', vle_group_id='g1')
+        SyncState.set_value(HIGH_WATER_MARK, '1000')
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'vle.jsonl.gz')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _snapshot(self):
+        return (
+            list(CourseKVStore.objects.order_by('vle_course_id').values_list('vle_course_id', 'name')),
+            list(GroupKVStore.objects.order_by('vle_course_id').values_list('vle_course_id', 'vle_group_id', 'name')),
+            list(CourseMember.objects.order_by('vle_course_id').values_list('user__username', 'vle_course_id', 'is_tutor')),
+            list(GroupMember.objects.order_by('vle_course_id').values_list('user__username', 'vle_course_id', 'vle_group_id')),
+            SyncState.get_value(HIGH_WATER_MARK),
+        )
+
+    def _clear(self):
+        for model in (CourseKVStore, GroupKVStore, CourseMember, GroupMember, SyncState,):
+            model.objects.all().delete()
+
+    def test_format(self):
+        dump_snapshot(self.path)
+        with gzip.open(self.path, 'rb') as f:
+            lines = [json.loads(line.decode('utf-8')) for line in f]
+        self.assertEqual({'version': 1, 'high_water_mark': '1000'}, lines[0])
+        self.assertEqual({'section': 'course_member', 'fields': ['username', 'vle_course_id', 'is_tutor']}, lines[6])
+        self.assertEqual(['arya.stark', '002', False], lines[7])
+
+    def test_read(self):
+        dump_snapshot(self.path)
+        sections = dict((key, list(value) if key != HIGH_WATER_MARK else value) for key, value in read_snapshot(self.path))
+        self.assertEqual('1000', sections[HIGH_WATER_MARK])
+        self.assertEqual([{'username': 'sansa.stark', 'vle_course_id': '001', 'vle_group_id': 'g1'}], sections['group_member'])
+
+    def test_unconsumed_sections_are_skipped(self):
+        dump_snapshot(self.path)
+        self.assertEqual(
+            [HIGH_WATER_MARK, 'course_kv_store', 'group_kv_store', 'course_member', 'group_member'],
+            [key for key, value in read_snapshot(self.path)]
+        )
+
+    def test_json(self):
+        dump_snapshot(self.path)
+        for chunk_size in (1, 1024 * 1024):
+            d = json.loads(b''.join(iter_snapshot_json(self.path, chunk_size)).decode('utf-8'))
+            self.assertEqual([{'vle_course_id': '001', 'name': u'Needlework £'}, {'vle_course_id': '002', 'name': 'Swordplay'}], d['course_kv_store'])
+
+    def test_load(self):
+        before = self._snapshot()
+        dump_snapshot(self.path)
+        self._clear()
+        CourseKVStore.objects.create(vle_course_id='003', name='Warging')
+        report = load_snapshot(self.path, batch_size=1)
+        self.assertEqual(before, self._snapshot())
+        self.assertEqual({'created': 2, 'updated': 0, 'deleted': 1, 'skipped': 0}, dict(report.counts['course_kv_store']))
+
+    def test_load_unknown_usernames(self):
+        dump_snapshot(self.path)
+        self.users['Arya'].delete()
+        report = load_snapshot(self.path)
+        self.assertEqual({'arya.stark'}, report.unknown_usernames)
+        self.assertEqual(1, CourseMember.objects.count())
+
+    def test_load_waits_for_sync(self):
+        """
+        a load holds the sync lease, waiting for a sync that holds it to finish first
+        """
+        dump_snapshot(self.path)
+        self._clear()
+        other = Lease()
+        other.acquire()
+        with mock.patch('vle.lease.time.sleep', side_effect=lambda seconds: other.release()) as sleep:
+            with mock.patch('vle.snapshot.recipient_cache') as recipient_cache:
+                recipient_cache.invalidate.side_effect = lambda: self.assertTrue(SyncLease.objects.exists())
+                load_snapshot(self.path)
+        self.assertEqual(1, sleep.call_count)
+        self.assertTrue(recipient_cache.invalidate.called)
+        self.assertFalse(SyncLease.objects.exists())
+        self.assertEqual(2, CourseKVStore.objects.count())
+
+    def test_commands(self):
+        before = self._snapshot()
+        call_command('vle_dump_snapshot', self.path)
+        self._clear()
+        out = StringIO()
+        call_command('vle_load_snapshot', self.path, stdout=out)
+        self.assertEqual(before, self._snapshot())
+        self.assertIn('group_member: 1 created, 0 updated, 0 deleted', out.getvalue().splitlines())
+
+    def test_full_sync_source(self):
+        """
+        a snapshot can be synced as if Moodle had returned it, whether streamed or not
+        """
+        before = self._snapshot()
+        dump_snapshot(self.path)
+        for stream in (False, True):
+            self._clear()
+            CourseKVStore.objects.create(vle_course_id='003', name='Warging')
+            self.assertEqual('Full VLE synchronization completed successfully', full_sync(source=self.path, stream=stream))
+            self.assertEqual(before, self._snapshot())
@@ -1,8 +1,25 @@
+import json
+import os
+import shutil
+import tempfile
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
 from django.contrib.auth import get_user_model
-from django.test import TestCase
+from django.core.management import CommandError, call_command
+from django.db import DatabaseError, connections
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils.six import StringIO
 
-from vle.models import CourseKVStore, GroupKVStore, CourseMember, GroupMember
+from vle.models import CourseKVStore, GroupKVStore, CourseMember, GroupMember, SyncRun, SyncState
+from vle.models import StagedCourseKVStore, StagedGroupKVStore, StagedCourseMember, StagedGroupMember
 from vle.sync import _sync_course_kv_store, _sync_group_kv_store, _sync_course_member, _sync_group_member
+from vle.sync import _CourseKVStoreReconciler, _CourseMemberReconciler, _GroupMemberReconciler
+from vle.report import SyncReport
+from vle.sync import HIGH_WATER_MARK, IncompatibleModes, delta_sync, full_sync, get_course_digests, get_modes, get_partition, get_snapshot_id
 
 
 class FullSyncTestCase(TestCase):
@@ -190,3 +207,852 @@ class FullSyncTestCase(TestCase):
         self.assertEqual(0, GroupMember.objects.filter(user=self.users['Tywin'], vle_course_id='001', vle_group_id='001a').count())
         self.assertEqual(1, GroupMember.objects.filter(user=self.users['Jaime'], vle_course_id='001', vle_group_id='001a').count())
         self.assertEqual(3, GroupMember.objects.all().count())
+
+    def test_sync_course_member_query_count_independent_of_row_count(self):
+        # seed the database with one row to update, one to leave alone and one to delete
+        CourseMember.objects.create(user=self.users['Cersei'], vle_course_id='001')
+        CourseMember.objects.create(user=self.users['Tyrion'], vle_course_id='001', is_tutor=True)
+        CourseMember.objects.create(user=self.users['Tywin'], vle_course_id='001')
+
+        # every user in ten courses
+        course_member = [
+            {
+                u'username': '%s.lannister' % first_name.lower(),
+                u'vle_course_id': '%03d' % i,
+                u'is_tutor': first_name == 'Cersei',
+            }
+            for first_name in ['Cersei', 'Jaime', 'Tyrion'] for i in range(1, 11)
+        ]
+
+        # find the generation, resolve usernames, look up existing, bulk create, update tutors, mark as seen, delete orphans
+        with self.assertNumQueries(8):
+            _sync_course_member(course_member)
+
+        # expectations
+        self.assertEqual(30, CourseMember.objects.all().count())
+        self.assertEqual(10, CourseMember.objects.filter(is_tutor=True).count())
+        self.assertEqual(0, CourseMember.objects.filter(user=self.users['Tywin']).count())
+
+    @override_settings(VLE_SYNC_BATCH_SIZE=2)
+    def test_sync_in_batches(self):
+        # seed the database
+        CourseKVStore.objects.create(vle_course_id='001', name='Overwrite me')
+        CourseKVStore.objects.create(vle_course_id='002', name='Overwrite me too')
+        GroupMember.objects.create(user=self.users['Tywin'], vle_course_id='001', vle_group_id='001a')
+
+        # synchronize the data
+        _sync_course_kv_store([
+            {u'vle_course_id': '%03d' % i, u'name': 'Course %d' % i} for i in range(1, 6)
+        ])
+        _sync_group_member([
+            {u'username': '%s.lannister' % first_name.lower(), u'vle_course_id': '001', u'vle_group_id': '001a'}
+            for first_name in ['Cersei', 'Jaime', 'Tyrion', 'Tywin', 'Cersei']
+        ])
+
+        # expectations
+        self.assertEqual(5, CourseKVStore.objects.all().count())
+        self.assertEqual(1, CourseKVStore.objects.filter(vle_course_id='001', name='Course 1').count())
+        self.assertEqual(1, CourseKVStore.objects.filter(vle_course_id='002', name='Course 2').count())
+        self.assertEqual(4, GroupMember.objects.all().count())
+
+    def test_sync_generations(self):
+        """
+        memberships are looked up a batch at a time, and orphans are the rows (in scope) left with a stale generation
+        """
+        CourseMember.objects.create(user=self.users['Cersei'], vle_course_id='001', generation=7)
+        CourseMember.objects.create(user=self.users['Jaime'], vle_course_id='001', generation=7)
+        CourseMember.objects.create(user=self.users['Tywin'], vle_course_id='001', generation=7)
+        CourseMember.objects.create(user=self.users['Tywin'], vle_course_id='002', generation=7)
+        course_member = [
+            {u'username': '%s.lannister' % first_name.lower(), u'vle_course_id': '001', u'is_tutor': False}
+            for first_name in ['Cersei', 'Jaime', 'Tyrion']
+        ]
+        with mock.patch.object(_CourseMemberReconciler, 'load_existing', side_effect=AssertionError):
+            report = SyncReport()
+            _CourseMemberReconciler(batch_size=2, course_ids=['001'], report=report).sync(course_member)
+        self.assertEqual({'created': 1, 'updated': 0, 'deleted': 1, 'skipped': 2}, dict(report.counts['course_member']))
+        self.assertEqual(
+            [('001', 'cersei.lannister', 8), ('001', 'jaime.lannister', 8), ('001', 'tyrion.lannister', 8), ('002', 'tywin.lannister', 7)],
+            list(CourseMember.objects.order_by('vle_course_id', 'user__username').values_list('vle_course_id', 'user__username', 'generation'))
+        )
+
+        # a dry run counts the unmatched rows instead
+        report = SyncReport(dry_run=True)
+        _CourseMemberReconciler(batch_size=2, report=report).sync(course_member[:1])
+        self.assertEqual({'created': 0, 'updated': 0, 'deleted': 3, 'skipped': 1}, dict(report.counts['course_member']))
+        self.assertEqual(4, CourseMember.objects.count())
+
+    def test_sync_generations_created_meanwhile(self):
+        """
+        memberships created while a sync is running (e.g. by the views) aren't orphans
+        """
+        CourseMember.objects.create(user=self.users['Cersei'], vle_course_id='001')
+        reconciler = _CourseMemberReconciler(batch_size=2)
+        reconciler.feed([{u'username': 'jaime.lannister', u'vle_course_id': '001', u'is_tutor': False}])
+        CourseMember.objects.create(user=self.users['Tywin'], vle_course_id='001')
+        reconciler.finish()
+        self.assertEqual(
+            ['jaime.lannister', 'tywin.lannister'],
+            list(CourseMember.objects.order_by('user__username').values_list('user__username', flat=True))
+        )
+
+
+class DeltaSyncTestCase(TestCase):
+
+    def setUp(self):
+        self.users = {}
+        for first_name in [u'Arya', u'Bran', u'Sansa']:
+            self.users[first_name] = get_user_model().objects.create_user(username='%s.stark' % first_name.lower(), password='Wibble123!')
+
+        # seed the database
+        CourseKVStore.objects.create(vle_course_id='001', name='Needlework')
+        CourseKVStore.objects.create(vle_course_id='002', name='Swordplay')
+        CourseMember.objects.create(user=self.users['Arya'], vle_course_id='001')
+        CourseMember.objects.create(user=self.users['Sansa'], vle_course_id='001')
+        CourseMember.objects.create(user=self.users['Arya'], vle_course_id='002')
+        GroupMember.objects.create(user=self.users['Arya'], vle_course_id='001', vle_group_id='001a')
+        GroupMember.objects.create(user=self.users['Sansa'], vle_course_id='001', vle_group_id='001a')
+
+    def test_apply_changes(self):
+        """
+        only the given changes are applied; rows that aren't mentioned are left alone
+        """
+        _CourseKVStoreReconciler(delta=True).sync([
+            {u'vle_course_id': '001', u'name': 'Advanced needlework'},
+            {u'vle_course_id': '003', u'name': 'Warging'},
+            {u'vle_course_id': '002', u'deleted': True},
+        ])
+        _CourseMemberReconciler(delta=True).sync([
+            {u'username': 'sansa.stark', u'vle_course_id': '001', u'is_tutor': True},
+            {u'username': 'bran.stark', u'vle_course_id': '003', u'is_tutor': False},
+            {u'username': 'arya.stark', u'vle_course_id': '001', u'is_tutor': False, u'deleted': True},
+        ])
+        _GroupMemberReconciler(delta=True).sync([
+            {u'username': 'bran.stark', u'vle_course_id': '003', u'vle_group_id': '003a'},
+            {u'username': 'bran.stark', u'vle_course_id': '003', u'vle_group_id': '003b'},
+            {u'username': 'bran.stark', u'vle_course_id': '003', u'vle_group_id': '003b', u'deleted': True},
+            {u'username': 'arya.stark', u'vle_course_id': '001', u'vle_group_id': '001a', u'deleted': True},
+        ])
+
+        # expectations
+        self.assertEqual(['Advanced needlework', 'Warging'], list(CourseKVStore.objects.order_by('vle_course_id').values_list('name', flat=True)))
+        self.assertEqual(0, CourseMember.objects.filter(vle_course_id='002').count())
+        self.assertEqual(0, CourseMember.objects.filter(user=self.users['Arya']).count())
+        self.assertEqual(1, CourseMember.objects.filter(user=self.users['Sansa'], vle_course_id='001', is_tutor=True).count())
+        self.assertEqual(1, CourseMember.objects.filter(user=self.users['Bran'], vle_course_id='003', is_tutor=False).count())
+        self.assertEqual(
+            [('001', '001a', self.users['Sansa'].pk), ('003', '003a', self.users['Bran'].pk)],
+            list(GroupMember.objects.order_by('vle_course_id').values_list('vle_course_id', 'vle_group_id', 'user'))
+        )
+
+    @mock.patch('vle.moodle.requests.Session.get')
+    def test_high_water_mark(self, get):
+        get.return_value.status_code = 200
+
+        # the first sync is a full sync, since there is no high-water mark
+        get.return_value.json.return_value = {
+            u'course_kv_store': [{u'vle_course_id': '001', u'name': 'Needlework'}],
+            u'group_kv_store': [],
+            u'course_member': [],
+            u'group_member': [],
+            HIGH_WATER_MARK: 1000,
+        }
+        delta_sync()
+        self.assertEqual({}, get.call_args[1]['params'])
+        self.assertEqual('1000', SyncState.get_value(HIGH_WATER_MARK))
+        self.assertEqual(1, CourseKVStore.objects.all().count())
+        self.assertEqual(0, CourseMember.objects.all().count())
+
+        # the second sync only asks for changes since the first
+        get.return_value.json.return_value = {
+            u'course_member': [{u'username': 'bran.stark', u'vle_course_id': '001', u'is_tutor': False}],
+            HIGH_WATER_MARK: 1001,
+        }
+        delta_sync()
+        self.assertEqual({'since': '1000'}, get.call_args[1]['params'])
+        self.assertEqual('1001', SyncState.get_value(HIGH_WATER_MARK))
+        self.assertEqual(1, CourseKVStore.objects.all().count())
+        self.assertEqual(1, CourseMember.objects.all().count())
+
+
+class PagedSyncTestCase(TestCase):
+
+    def setUp(self):
+        for i in range(6):
+            get_user_model().objects.create_user(username='user%d' % i, password='Wibble123!')
+        CourseKVStore.objects.create(vle_course_id='999', name='Vanished')
+        CourseMember.objects.create(user=get_user_model().objects.get(username='user0'), vle_course_id='999')
+
+    def _get(self, url, params, **kwargs):
+        """
+        three pages of course members, two per page, and one page of everything else
+        """
+        response = mock.Mock(status_code=200, content=b'')
+        key, page = params['section'], params['page']
+        d = {key: [], 'pages': 1}
+        if key == 'course_kv_store':
+            d[key] = [{u'vle_course_id': '001', u'name': 'Course 1'}]
+        elif key == 'course_member':
+            d.update(pages=3)
+            d[key] = [{u'username': 'user%d' % i, u'vle_course_id': '001', u'is_tutor': False} for i in (page * 2, page * 2 + 1)]
+        response.json.return_value = d
+        return response
+
+    @mock.patch('vle.moodle.requests.Session')
+    def test_paged_sync(self, session):
+        session.return_value.get.side_effect = self._get
+        self.assertEqual('Full VLE synchronization completed successfully', full_sync(paged=True))
+        self.assertEqual(6, session.return_value.get.call_count)
+        self.assertEqual(['001'], list(CourseKVStore.objects.values_list('vle_course_id', flat=True)))
+        self.assertEqual(6, CourseMember.objects.filter(vle_course_id='001').count())
+        self.assertEqual(6, CourseMember.objects.all().count())
+
+    @mock.patch('vle.moodle.requests.Session')
+    def test_paged_sync_error(self, session):
+        """
+        nothing is deleted if any page fails
+        """
+        def get(url, params, **kwargs):
+            if params['page'] == 2:
+                return mock.Mock(status_code=500, **{'json.return_value': {'errorMessage': 'Oops'}})
+            return self._get(url, params)
+        session.return_value.get.side_effect = get
+        self.assertEqual('Oops', full_sync(paged=True))
+        self.assertEqual(1, CourseKVStore.objects.filter(vle_course_id='999').count())
+        self.assertEqual(1, CourseMember.objects.filter(vle_course_id='999').count())
+
+
+class StagedSyncTestCase(TestCase):
+
+    def setUp(self):
+        self.users = {}
+        for first_name in [u'Arya', u'Bran', u'Sansa']:
+            self.users[first_name] = get_user_model().objects.create_user(username='%s.stark' % first_name.lower(), password='Wibble123!')
+
+        # seed the database
+        CourseKVStore.objects.create(vle_course_id='001', name='Needlework')
+        CourseKVStore.objects.create(vle_course_id='002', name='Swordplay')
+        GroupKVStore.objects.create(vle_course_id='001', vle_group_id='001a', name='Group A')
+        GroupKVStore.objects.create(vle_course_id='002', vle_group_id='002a', name='Group A')
+        CourseMember.objects.create(user=self.users['Arya'], vle_course_id='001')
+        CourseMember.objects.create(user=self.users['Sansa'], vle_course_id='001')
+        CourseMember.objects.create(user=self.users['Arya'], vle_course_id='002')
+        GroupMember.objects.create(user=self.users['Arya'], vle_course_id='001', vle_group_id='001a')
+        GroupMember.objects.create(user=self.users['Arya'], vle_course_id='002', vle_group_id='002a')
+
+    @mock.patch('vle.moodle.requests.Session.get')
+    def test_staged_sync(self, get):
+        get.return_value.status_code = 200
+        get.return_value.json.return_value = {
+            u'course_kv_store': [
+                {u'vle_course_id': '001', u'name': 'Advanced needlework'},
+                {u'vle_course_id': '003', u'name': 'Warging'},
+            ],
+            u'group_kv_store': [
+                {u'vle_course_id': '001', u'vle_group_id': '001a', u'name': 'Group A'},
+                {u'vle_course_id': '003', u'vle_group_id': '003a', u'name': 'Group A'},
+            ],
+            u'course_member': [
+                {u'username': 'sansa.stark', u'vle_course_id': '001', u'is_tutor': True},
+                {u'username': 'bran.stark', u'vle_course_id': '003', u'is_tutor': False},
+                {u'username': 'bran.stark', u'vle_course_id': '003', u'is_tutor': False},
+                {u'username': 'unknown.user', u'vle_course_id': '003', u'is_tutor': False},
+            ],
+            u'group_member': [
+                {u'username': 'bran.stark', u'vle_course_id': '003', u'vle_group_id': '003a'},
+            ],
+        }
+        self.assertEqual('Full VLE synchronization completed successfully', full_sync(staged=True))
+
+        # expectations
+        self.assertEqual(
+            [('001', 'Advanced needlework'), ('003', 'Warging')],
+            list(CourseKVStore.objects.order_by('vle_course_id').values_list('vle_course_id', 'name'))
+        )
+        self.assertEqual(
+            [('001', '001a'), ('003', '003a')],
+            list(GroupKVStore.objects.order_by('vle_course_id').values_list('vle_course_id', 'vle_group_id'))
+        )
+        self.assertEqual(
+            [('001', self.users['Sansa'].pk, True), ('003', self.users['Bran'].pk, False)],
+            list(CourseMember.objects.order_by('vle_course_id').values_list('vle_course_id', 'user', 'is_tutor'))
+        )
+        self.assertEqual(
+            [('003', '003a', self.users['Bran'].pk)],
+            list(GroupMember.objects.values_list('vle_course_id', 'vle_group_id', 'user'))
+        )
+
+        # the staging tables are emptied afterwards
+        for model in [StagedCourseKVStore, StagedGroupKVStore, StagedCourseMember, StagedGroupMember]:
+            self.assertEqual(0, model.objects.all().count())
+
+
+class SkipUnchangedSyncTestCase(TestCase):
+
+    def setUp(self):
+        self.users = {}
+        for first_name in [u'Arya', u'Bran', u'Sansa']:
+            self.users[first_name] = get_user_model().objects.create_user(username='%s.stark' % first_name.lower(), password='Wibble123!')
+        self.payload = {
+            u'course_kv_store': [
+                {u'vle_course_id': '001', u'name': 'Needlework'},
+                {u'vle_course_id': '002', u'name': 'Swordplay'},
+                {u'vle_course_id': '003', u'name': 'Warging'},
+            ],
+            u'group_kv_store': [
+                {u'vle_course_id': '001', u'vle_group_id': '001a', u'name': 'Group A'},
+            ],
+            u'course_member': [
+                {u'username': 'sansa.stark', u'vle_course_id': '001', u'is_tutor': False},
+                {u'username': 'arya.stark', u'vle_course_id': '002', u'is_tutor': False},
+                {u'username': 'bran.stark', u'vle_course_id': '003', u'is_tutor': False},
+            ],
+            u'group_member': [
+                {u'username': 'sansa.stark', u'vle_course_id': '001', u'vle_group_id': '001a'},
+            ],
+        }
+
+    def test_digests_are_stable(self):
+        digests = get_course_digests(self.payload)
+        self.assertEqual(['001', '002', '003'], sorted(digests.keys()))
+        for key in self.payload:
+            self.payload[key].reverse()
+        self.assertEqual(digests, get_course_digests(self.payload))
+        self.payload['course_member'][0]['is_tutor'] = True
+        self.assertNotEqual(digests, get_course_digests(self.payload))
+
+    @mock.patch('vle.moodle.requests.Session.get')
+    def test_computed_digests(self, get):
+        """
+        Moodle doesn't support digests, so returns the full payload and the digests are computed from it
+        """
+        get.return_value.status_code = 200
+        get.return_value.json.return_value = self.payload
+        full_sync(skip_unchanged=True)
+        self.assertEqual(3, CourseMember.objects.all().count())
+        self.assertEqual(get_course_digests(self.payload), dict(CourseKVStore.objects.values_list('vle_course_id', 'digest')))
+
+        # tamper with course 001 behind the sync's back, so that it can be seen not to be reconciled
+        CourseMember.objects.filter(vle_course_id='001').delete()
+
+        # change course 002 and remove course 003
+        self.payload['course_member'][1]['is_tutor'] = True
+        del self.payload['course_kv_store'][2]
+        del self.payload['course_member'][2]
+        full_sync(skip_unchanged=True)
+        self.assertEqual(0, CourseMember.objects.filter(vle_course_id='001').count())
+        self.assertEqual(1, CourseMember.objects.filter(vle_course_id='002', is_tutor=True).count())
+        self.assertEqual(['001', '002'], list(CourseKVStore.objects.order_by('vle_course_id').values_list('vle_course_id', flat=True)))
+        self.assertEqual(0, CourseMember.objects.filter(vle_course_id='003').count())
+
+    @mock.patch('vle.moodle.requests.Session.get')
+    def test_moodle_digests(self, get):
+        """
+        Moodle sends the digests first, and then the full data of changed courses only
+        """
+        CourseKVStore.objects.create(vle_course_id='001', name='Needlework', digest='abc')
+        CourseKVStore.objects.create(vle_course_id='004', name='Vanished', digest='def')
+        CourseMember.objects.create(user=self.users['Arya'], vle_course_id='004')
+        digests = mock.Mock(status_code=200, content=b'', **{'json.return_value': {'digests': {'001': 'abc', '002': 'ghi', '003': 'jkl'}}})
+        changed = mock.Mock(status_code=200, content=b'', **{'json.return_value': {
+            key: [item for item in items if item['vle_course_id'] != '001'] for key, items in self.payload.items()
+        }})
+        get.side_effect = [digests, changed]
+        full_sync(skip_unchanged=True)
+
+        self.assertEqual({'digests': 1}, get.call_args_list[0][1]['params'])
+        self.assertEqual({'courses': ['002', '003']}, get.call_args_list[1][1]['params'])
+        self.assertEqual(
+            [('001', 'abc'), ('002', 'ghi'), ('003', 'jkl')],
+            list(CourseKVStore.objects.order_by('vle_course_id').values_list('vle_course_id', 'digest'))
+        )
+        self.assertEqual(['002', '003'], list(CourseMember.objects.order_by('vle_course_id').values_list('vle_course_id', flat=True)))
+
+    @mock.patch('vle.moodle.requests.Session.get')
+    def test_unknown_members_are_tried_again(self, get):
+        self.payload['course_member'].append({u'username': 'rickon.stark', u'vle_course_id': '003', u'is_tutor': False})
+        get.return_value.status_code = 200
+        get.return_value.json.return_value = self.payload
+        full_sync(skip_unchanged=True)
+        self.assertEqual('', CourseKVStore.objects.get(vle_course_id='003').digest)
+
+        # Rickon turns up
+        rickon = get_user_model().objects.create_user(username='rickon.stark', password='Wibble123!')
+        full_sync(skip_unchanged=True)
+        self.assertEqual(1, CourseMember.objects.filter(user=rickon, vle_course_id='003').count())
+        self.assertEqual(get_course_digests(self.payload)['003'], CourseKVStore.objects.get(vle_course_id='003').digest)
+
+
+class DryRunTestCase(TestCase):
+
+    def setUp(self):
+        self.users = {}
+        for first_name in [u'Arya', u'Bran', u'Sansa']:
+            self.users[first_name] = get_user_model().objects.create_user(username='%s.stark' % first_name.lower(), password='Wibble123!')
+
+        # seed the database
+        CourseKVStore.objects.create(vle_course_id='001', name='Needlework')
+        CourseKVStore.objects.create(vle_course_id='002', name='Swordplay')
+        CourseMember.objects.create(user=self.users['Arya'], vle_course_id='001')
+        CourseMember.objects.create(user=self.users['Sansa'], vle_course_id='001')
+        self.payload = {
+            u'course_kv_store': [
+                {u'vle_course_id': '001', u'name': 'Advanced needlework'},
+                {u'vle_course_id': '003', u'name': 'Warging'},
+            ],
+            u'group_kv_store': [],
+            u'course_member': [
+                {u'username': 'sansa.stark', u'vle_course_id': '001', u'is_tutor': True},
+                {u'username': 'bran.stark', u'vle_course_id': '003', u'is_tutor': False},
+                {u'username': 'rickon.stark', u'vle_course_id': '003', u'is_tutor': False},
+            ],
+            u'group_member': [],
+            HIGH_WATER_MARK: 1000,
+        }
+
+    def _snapshot(self):
+        return (
+            list(CourseKVStore.objects.order_by('pk').values_list('vle_course_id', 'name')),
+            list(CourseMember.objects.order_by('pk').values_list('vle_course_id', 'user', 'is_tutor')),
+        )
+
+    @mock.patch('vle.moodle.requests.Session.get')
+    def test_dry_run(self, get):
+        get.return_value.status_code = 200
+        get.return_value.json.return_value = self.payload
+        before = self._snapshot()
+        report = SyncReport()
+        self.assertEqual('Full VLE synchronization dry run completed successfully', full_sync(dry_run=True, report=report))
+
+        # nothing was written
+        self.assertEqual(before, self._snapshot())
+        self.assertIsNone(SyncState.get_value(HIGH_WATER_MARK))
+
+        # but the diff was counted
+        self.assertEqual({'created': 1, 'updated': 1, 'deleted': 1, 'skipped': 0}, dict(report.counts['course_kv_store']))
+        self.assertEqual({'created': 1, 'updated': 1, 'deleted': 1, 'skipped': 0}, dict(report.counts['course_member']))
+        self.assertEqual({'rickon.stark'}, report.unknown_usernames)
+        self.assertTrue(report.queries['diff'] > 0)
+        self.assertEqual(0, report.queries['apply'])
+
+    @mock.patch('vle.moodle.requests.Session.get')
+    def test_report(self, get):
+        get.return_value.status_code = 200
+        get.return_value.json.return_value = self.payload
+        report = SyncReport()
+        full_sync(report=report, staged=True)
+        self.assertEqual({'created': 1, 'updated': 1, 'deleted': 1, 'skipped': 0}, dict(report.counts['course_member']))
+        self.assertTrue(report.queries['apply'] > 0)
+        self.assertEqual(list(report.timings.keys()), ['fetch', 'parse', 'diff', 'apply'])
+        self.assertTrue(all(t >= 0 for t in report.timings.values()))
+
+    @override_settings(DEBUG=True)
+    def test_recording(self):
+        """
+        queries are counted (under DEBUG too) without turning on the debug cursor or logging them
+        """
+        connection = connections['default']
+        connection.queries_log.clear()
+        report, nested = SyncReport(), SyncReport()
+        with report.recording(), report.phase('diff'):
+            self.assertFalse(connection.force_debug_cursor)
+            list(CourseKVStore.objects.all())
+            with nested.recording(), nested.phase('apply'):
+                CourseKVStore.objects.filter(vle_course_id='001').update(name='Needlework')
+            CourseKVStore.objects.count()
+        self.assertEqual((2, 0), (report.queries['diff'], report.queries['apply']))
+        self.assertEqual(1, nested.queries['apply'])
+        self.assertEqual(0, len(connection.queries))
+
+        # and afterwards, they're logged as usual
+        CourseKVStore.objects.count()
+        self.assertEqual(1, len(connection.queries))
+
+    @mock.patch('vle.moodle.requests.Session.get')
+    def test_management_command(self, get):
+        get.return_value.status_code = 200
+        get.return_value.json.return_value = self.payload
+        out = StringIO()
+        call_command('vle_sync', dry_run=True, stdout=out, stderr=StringIO())
+        lines = out.getvalue().splitlines()
+        self.assertEqual('Full VLE synchronization dry run completed successfully', lines[0])
+        self.assertIn('course_member: 1 to create, 1 to update, 1 to delete', lines)
+        self.assertIn('Unknown usernames: rickon.stark', lines)
+
+    def test_incompatible_modes(self):
+        """
+        modes that would ignore each other can't be combined, whether given or set
+        """
+        with self.assertRaisesRegexp(IncompatibleModes, 'course_ids with partitions'):
+            full_sync(course_ids=['001'], partitions=4)
+        with self.assertRaisesRegexp(IncompatibleModes, 'partitions with staged'):
+            with self.settings(VLE_SYNC_STAGED=True, VLE_SYNC_PARTITIONS=4):
+                full_sync()
+        with self.assertRaisesRegexp(CommandError, 'course_ids with partitions'):
+            call_command('vle_sync', workers=4, course_ids=['001'], stdout=StringIO(), stderr=StringIO())
+        self.assertFalse(SyncRun.objects.exists())
+
+    def test_get_modes(self):
+        with self.settings(VLE_SYNC_STAGED=True, VLE_SYNC_CONDITIONAL=True):
+            self.assertEqual(
+                {'course_ids': (), 'skip_unchanged': False, 'partitions': 1, 'resumable': False, 'staged': True,
+                 'stream': False, 'paged': False, 'conditional': True},
+                get_modes()
+            )
+            # a mode that's given leaves the settings it's incompatible with out, but not the others
+            modes = get_modes(partitions=4)
+            self.assertEqual((4, False, True), (modes['partitions'], modes['staged'], modes['conditional']))
+            modes = get_modes(course_ids=['001'])
+            self.assertEqual((['001'], False, False), (modes['course_ids'], modes['staged'], modes['conditional']))
+            modes = get_modes(partitions=1)
+            self.assertEqual((1, True), (modes['partitions'], modes['staged']))
+
+
+class _InProcessPool(object):
+    """
+    stands in for the pool, since worker processes wouldn't see the (in-memory) test database
+    """
+
+    def __init__(self, processes):
+        self.processes = processes
+
+    def imap_unordered(self, func, iterable):
+        return [func(args) for args in iterable]
+
+    def close(self):
+        pass
+
+    def join(self):
+        pass
+
+
+class PartitionedSyncTestCase(TestCase):
+
+    def setUp(self):
+        self.users = {}
+        for first_name in [u'Arya', u'Bran', u'Sansa']:
+            self.users[first_name] = get_user_model().objects.create_user(username='%s.stark' % first_name.lower(), password='Wibble123!')
+
+        # seed the database
+        for i in range(1, 6):
+            CourseKVStore.objects.create(vle_course_id='%03d' % i, name='Course %d' % i)
+            CourseMember.objects.create(user=self.users['Arya'], vle_course_id='%03d' % i)
+            GroupKVStore.objects.create(vle_course_id='%03d' % i, vle_group_id='g1', name='Group')
+            GroupMember.objects.create(user=self.users['Arya'], vle_course_id='%03d' % i, vle_group_id='g1')
+        self.payload = {
+            u'course_kv_store': [{u'vle_course_id': '%03d' % i, u'name': 'Course %d' % i} for i in range(1, 5)],
+            u'group_kv_store': [{u'vle_course_id': '%03d' % i, u'vle_group_id': 'g1', u'name': 'Group'} for i in range(1, 5)],
+            u'course_member': [
+                {u'username': 'arya.stark', u'vle_course_id': '001', u'is_tutor': True},
+                {u'username': 'arya.stark', u'vle_course_id': '002', u'is_tutor': False},
+                {u'username': 'bran.stark', u'vle_course_id': '003', u'is_tutor': False},
+                {u'username': 'sansa.stark', u'vle_course_id': '004', u'is_tutor': False},
+            ],
+            u'group_member': [
+                {u'username': 'arya.stark', u'vle_course_id': '001', u'vle_group_id': 'g1'},
+                {u'username': 'sansa.stark', u'vle_course_id': '002', u'vle_group_id': 'g1'},
+            ],
+            HIGH_WATER_MARK: 1000,
+        }
+
+    def test_get_partition(self):
+        partitions = [get_partition('%03d' % i, 3) for i in range(100)]
+        self.assertEqual({0, 1, 2}, set(partitions))
+        self.assertEqual(partitions, [get_partition('%03d' % i, 3) for i in range(100)])
+
+    @mock.patch('vle.sync._get_pool', _InProcessPool)
+    @mock.patch('vle.moodle.requests.Session.get')
+    def test_partitioned_sync(self, get):
+        """
+        the result is the same as an unpartitioned sync, including deleting everything in vanished course 005
+        """
+        get.return_value.status_code = 200
+        get.return_value.json.return_value = self.payload
+        report = SyncReport()
+        self.assertEqual('Full VLE synchronization completed successfully', full_sync(partitions=3, report=report))
+        self.assertEqual(
+            [('001', 'arya.stark', True), ('002', 'arya.stark', False), ('003', 'bran.stark', False), ('004', 'sansa.stark', False)],
+            list(CourseMember.objects.order_by('vle_course_id').values_list('vle_course_id', 'user__username', 'is_tutor'))
+        )
+        self.assertEqual(
+            [('001', 'arya.stark'), ('002', 'sansa.stark')],
+            list(GroupMember.objects.order_by('vle_course_id').values_list('vle_course_id', 'user__username'))
+        )
+        self.assertFalse(CourseKVStore.objects.filter(vle_course_id='005').exists())
+        self.assertEqual('1000', SyncState.get_value(HIGH_WATER_MARK))
+
+        # the workers' reports are merged into the parent's
+        self.assertEqual({'created': 2, 'updated': 1, 'deleted': 2, 'skipped': 1}, dict(report.counts['course_member']))
+        self.assertEqual({'created': 1, 'updated': 0, 'deleted': 3, 'skipped': 1}, dict(report.counts['group_member']))
+
+
+class PoolSyncTestCase(SimpleTestCase):
+    """
+    syncs with a real pool of worker processes, against a database in a file so that they can share it
+    """
+    allow_database_queries = True
+
+    def setUp(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        # the in-memory test database lives as long as its connection, so that's set aside rather than closed
+        old = connections['default']
+        new = old.__class__(dict(old.settings_dict, NAME=os.path.join(path, 'pool.sqlite3')), 'default')
+        connections['default'] = new
+        self.addCleanup(setattr, connections._connections, 'default', old)
+        self.addCleanup(new.close)
+        call_command('migrate', verbosity=0, interactive=False)
+        for first_name in [u'Arya', u'Bran', u'Sansa']:
+            get_user_model().objects.create_user(username='%s.stark' % first_name.lower(), password='Wibble123!')
+        CourseKVStore.objects.create(vle_course_id='005', name='Vanished')
+        CourseMember.objects.create(user=get_user_model().objects.get(username='arya.stark'), vle_course_id='005')
+
+    @mock.patch('vle.moodle.requests.Session.get')
+    def test_partitioned_sync(self, get):
+        get.return_value.status_code = 200
+        get.return_value.json.return_value = {
+            u'course_kv_store': [{u'vle_course_id': '%03d' % i, u'name': 'Course %d' % i} for i in range(1, 5)],
+            u'course_member': [
+                {u'username': 'arya.stark', u'vle_course_id': '001', u'is_tutor': True},
+                {u'username': 'bran.stark', u'vle_course_id': '002', u'is_tutor': False},
+                {u'username': 'sansa.stark', u'vle_course_id': '003', u'is_tutor': False},
+                {u'username': 'sansa.stark', u'vle_course_id': '004', u'is_tutor': False},
+            ],
+        }
+        report = SyncReport()
+        self.assertEqual('Full VLE synchronization completed successfully', full_sync(partitions=2, report=report))
+        self.assertEqual(
+            [('001', 'arya.stark', True), ('002', 'bran.stark', False), ('003', 'sansa.stark', False), ('004', 'sansa.stark', False)],
+            list(CourseMember.objects.order_by('vle_course_id').values_list('vle_course_id', 'user__username', 'is_tutor'))
+        )
+        self.assertFalse(CourseKVStore.objects.filter(vle_course_id='005').exists())
+        # the workers' reports are merged into the parent's (vanished course 005's membership went with it, beforehand)
+        self.assertEqual({'created': 4, 'updated': 0, 'deleted': 0, 'skipped': 0}, dict(report.counts['course_member']))
+
+
+@override_settings(VLE_SYNC_CHECKPOINTS=4)
+class ResumableSyncTestCase(TestCase):
+
+    def setUp(self):
+        for first_name in [u'Arya', u'Bran', u'Sansa']:
+            get_user_model().objects.create_user(username='%s.stark' % first_name.lower(), password='Wibble123!')
+        CourseKVStore.objects.create(vle_course_id='099', name='Vanished')
+        self.payload = {
+            u'course_kv_store': [{u'vle_course_id': '%03d' % i, u'name': 'Course %d' % i} for i in range(10)],
+            u'group_kv_store': [{u'vle_course_id': '%03d' % i, u'vle_group_id': 'g1', u'name': 'Group'} for i in range(10)],
+            u'course_member': [{u'username': 'arya.stark', u'vle_course_id': '%03d' % i, u'is_tutor': False} for i in range(10)],
+            u'group_member': [{u'username': 'bran.stark', u'vle_course_id': '%03d' % i, u'vle_group_id': 'g1'} for i in range(10)],
+            HIGH_WATER_MARK: 1000,
+        }
+
+    def _assert_synced(self):
+        self.assertEqual(10, CourseKVStore.objects.count())
+        self.assertFalse(CourseKVStore.objects.filter(vle_course_id='099').exists())
+        self.assertEqual(10, GroupKVStore.objects.count())
+        self.assertEqual(10, CourseMember.objects.count())
+        self.assertEqual(10, GroupMember.objects.count())
+
+    @mock.patch('vle.moodle.requests.Session.get')
+    def test_resumable_sync(self, get):
+        get.return_value.status_code = 200
+        get.return_value.json.return_value = self.payload
+        self.assertEqual('Full VLE synchronization completed successfully', full_sync(resumable=True))
+        self._assert_synced()
+        run = SyncRun.objects.get()
+        self.assertEqual(SyncRun.SUCCEEDED, run.status)
+        self.assertEqual('1000', run.snapshot)
+        self.assertEqual(16, run.total)
+        self.assertEqual(16, len(run.get_checkpoints()))
+
+    @mock.patch('vle.moodle.requests.Session.get')
+    def test_resume(self, get):
+        """
+        a rerun against the same snapshot doesn't redo the checkpoints the failed run reached
+        """
+        get.return_value.status_code = 200
+        get.return_value.json.return_value = self.payload
+        with mock.patch.object(_GroupMemberReconciler, 'sync', side_effect=DatabaseError('deadlock detected')):
+            with self.assertRaises(DatabaseError):
+                full_sync(resumable=True)
+        failed = SyncRun.objects.get()
+        self.assertEqual(SyncRun.FAILED, failed.status)
+        self.assertEqual('deadlock detected', failed.error)
+        self.assertEqual(12, len(failed.get_checkpoints()))
+        self.assertEqual(0, GroupMember.objects.count())
+
+        with mock.patch.object(_CourseMemberReconciler, 'sync') as sync:
+            self.assertEqual('Full VLE synchronization completed successfully', full_sync(resumable=True))
+        self.assertFalse(sync.called)
+        self._assert_synced()
+        run = SyncRun.objects.latest('pk')
+        self.assertEqual(SyncRun.SUCCEEDED, run.status)
+        self.assertEqual(failed, run.resumed_from)
+        self.assertEqual(16, len(run.get_checkpoints()))
+
+    @mock.patch('vle.moodle.requests.Session.get')
+    def test_resume_ignores_runs_without_lease(self, get):
+        """
+        runs that never held the lease (or started after the rerun) are neither resumed nor marked interrupted,
+        and a dry run doesn't count as a full run
+        """
+        get.return_value.status_code = 200
+        get.return_value.json.return_value = self.payload
+        with mock.patch.object(_GroupMemberReconciler, 'sync', side_effect=DatabaseError('deadlock detected')):
+            with self.assertRaises(DatabaseError):
+                full_sync(resumable=True)
+        failed = SyncRun.objects.get()
+        skipped = SyncRun.objects.create(kind=SyncRun.FULL)
+        dry_run = SyncRun.objects.create(kind=SyncRun.FULL, dry_run=True)
+        full_sync(resumable=True, dry_run=True, run=dry_run)
+        run = SyncRun.objects.create(kind=SyncRun.FULL)
+        later = SyncRun.objects.create(kind=SyncRun.FULL, snapshot='1000')
+
+        with mock.patch.object(_CourseMemberReconciler, 'sync') as sync:
+            self.assertEqual('Full VLE synchronization completed successfully', full_sync(resumable=True, run=run))
+        self.assertFalse(sync.called)
+        run.refresh_from_db()
+        self.assertEqual(failed, run.resumed_from)
+        for other in (skipped, later):
+            other.refresh_from_db()
+            self.assertEqual(SyncRun.RUNNING, other.status)
+            self.assertEqual('', other.error)
+
+    @mock.patch('vle.moodle.requests.Session.get')
+    def test_different_snapshot(self, get):
+        """
+        a rerun against a different snapshot starts from scratch
+        """
+        get.return_value.status_code = 200
+        get.return_value.json.return_value = self.payload
+        with mock.patch.object(_GroupMemberReconciler, 'sync', side_effect=DatabaseError('deadlock detected')):
+            with self.assertRaises(DatabaseError):
+                full_sync(resumable=True)
+        self.payload[HIGH_WATER_MARK] = 1001
+        with mock.patch.object(_CourseMemberReconciler, 'sync') as sync:
+            full_sync(resumable=True)
+        self.assertEqual(4, sync.call_count)
+        self.assertIsNone(SyncRun.objects.latest('pk').resumed_from)
+
+    def test_get_snapshot_id(self):
+        self.assertEqual('1000', get_snapshot_id(self.payload))
+        self.assertEqual('abc', get_snapshot_id(dict(self.payload, snapshot_id='abc')))
+        del self.payload[HIGH_WATER_MARK]
+        snapshot = get_snapshot_id(self.payload)
+        self.assertEqual(40, len(snapshot))
+        self.payload['course_member'].pop()
+        self.assertNotEqual(snapshot, get_snapshot_id(self.payload))
+
+
+class SyncRunTestCase(TestCase):
+
+    def setUp(self):
+        get_user_model().objects.create_user(username='arya.stark', password='Wibble123!')
+        CourseKVStore.objects.create(vle_course_id='001', name='Needlework')
+        self.payload = {
+            u'course_kv_store': [{u'vle_course_id': '001', u'name': 'Needlework'}, {u'vle_course_id': '002', u'name': 'Swordplay'}],
+            u'course_member': [{u'username': 'arya.stark', u'vle_course_id': '002', u'is_tutor': False}],
+            HIGH_WATER_MARK: 1000,
+        }
+
+    @mock.patch('vle.moodle.requests.Session.get')
+    def test_full_sync(self, get):
+        get.return_value.status_code = 200
+        get.return_value.json.return_value = self.payload
+        get.return_value.content = json.dumps(self.payload).encode('utf-8')
+        full_sync()
+        run = SyncRun.objects.get()
+        self.assertEqual((SyncRun.FULL, SyncRun.SUCCEEDED, ''), (run.kind, run.status, run.error))
+        self.assertTrue(run.duration >= 0)
+        self.assertEqual(len(get.return_value.content), run.payload_bytes)
+        self.assertEqual({'created': 1, 'updated': 0, 'deleted': 0, 'skipped': 1}, run.get_rows()['course_kv_store'])
+        self.assertEqual({'created': 1, 'updated': 0, 'deleted': 0, 'skipped': 0}, run.get_rows()['course_member'])
+        self.assertTrue(run.queries > 0)
+        self.assertTrue(run.peak_rss > 0)
+
+    @mock.patch('vle.moodle.requests.Session.get')
+    def test_delta_sync(self, get):
+        SyncState.set_value(HIGH_WATER_MARK, '999')
+        get.return_value.status_code = 200
+        get.return_value.json.return_value = self.payload
+        delta_sync()
+        self.assertEqual(SyncRun.DELTA, SyncRun.objects.get().kind)
+
+    @mock.patch('vle.moodle.requests.Session.get')
+    def test_error(self, get):
+        get.return_value.status_code = 500
+        get.return_value.json.return_value = {'errorMessage': 'Oops'}
+        full_sync()
+        run = SyncRun.objects.get()
+        self.assertEqual((SyncRun.FAILED, 'Oops'), (run.status, run.error))
+        self.assertIsNotNone(run.finished)
+
+    @mock.patch('vle.moodle.requests.Session.get')
+    def test_exception(self, get):
+        get.return_value.status_code = 200
+        get.return_value.json.return_value = self.payload
+        with mock.patch.object(_CourseMemberReconciler, 'feed', side_effect=DatabaseError('deadlock detected')):
+            with self.assertRaises(DatabaseError):
+                full_sync()
+        run = SyncRun.objects.get()
+        self.assertEqual((SyncRun.FAILED, 'deadlock detected'), (run.status, run.error))
+
+    @mock.patch('vle.moodle.requests.Session.get')
+    def test_dry_run(self, get):
+        get.return_value.status_code = 200
+        get.return_value.json.return_value = self.payload
+        full_sync(dry_run=True)
+        self.assertFalse(SyncRun.objects.exists())
+
+
+class SyncCommandTestCase(TestCase):
+
+    def setUp(self):
+        for first_name in [u'Arya', u'Bran']:
+            get_user_model().objects.create_user(username='%s.stark' % first_name.lower(), password='Wibble123!')
+        CourseKVStore.objects.create(vle_course_id='001', name='Needlework')
+        CourseKVStore.objects.create(vle_course_id='002', name='Swordplay')
+        self.payload = {
+            u'course_kv_store': [{u'vle_course_id': '%03d' % i, u'name': 'Course %d' % i} for i in range(1, 4)],
+            u'group_kv_store': [],
+            u'course_member': [
+                {u'username': 'arya.stark', u'vle_course_id': '001', u'is_tutor': False},
+                {u'username': 'bran.stark', u'vle_course_id': '003', u'is_tutor': False},
+            ],
+            u'group_member': [],
+        }
+        f = tempfile.NamedTemporaryFile(suffix='.json', delete=False)
+        f.write(json.dumps(self.payload).encode('utf-8'))
+        f.close()
+        self.source = f.name
+
+    def tearDown(self):
+        os.remove(self.source)
+
+    def test_source(self):
+        out, err = StringIO(), StringIO()
+        call_command('vle_sync', source=self.source, batch_size=1, stdout=out, stderr=err)
+        self.assertEqual('Full VLE synchronization completed successfully', out.getvalue().splitlines()[0])
+        self.assertEqual(['Course 1', 'Course 2', 'Course 3'], list(CourseKVStore.objects.order_by('vle_course_id').values_list('name', flat=True)))
+        self.assertEqual(2, CourseMember.objects.count())
+        self.assertRegexpMatches(err.getvalue(), r'^\d+ rows, \d+ rows/s, ETA \d+:\d\d:\d\d\n')
+
+    def test_only_courses(self):
+        """
+        002 isn't touched, and nor are other courses' members
+        """
+        out = StringIO()
+        call_command('vle_sync', source=self.source, course_ids=['001', '003'], verbosity=0, stdout=out)
+        self.assertEqual(
+            [('001', 'Course 1'), ('002', 'Swordplay'), ('003', 'Course 3')],
+            list(CourseKVStore.objects.order_by('vle_course_id').values_list('vle_course_id', 'name'))
+        )
+        self.assertIn('course_kv_store: 1 created, 1 updated, 0 deleted', out.getvalue().splitlines())
+
+    @mock.patch('vle.moodle.requests.Session.get')
+    def test_only_courses_request(self, get):
+        get.return_value.status_code = 200
+        get.return_value.json.return_value = self.payload
+        with override_settings(VLE_SYNC_COURSES_PER_REQUEST=1):
+            full_sync(course_ids=['002', '001'])
+        self.assertEqual([{'courses': ['001']}, {'courses': ['002']}], [c[1]['params'] for c in get.call_args_list])
+        self.assertEqual(['001', '002'], list(CourseKVStore.objects.order_by('vle_course_id').values_list('vle_course_id', flat=True)))
@@ -368,6 +368,7 @@ class AddCourseMembersTestCase(TestCase):
         # check the JSON
         data = json.loads(force_str(response.content))
         self.assertEqual(_('Course members added successfully!'), data.get('successMessage', ''))
+        self.assertEqual(['invalid_001', 'invalid_002', 'invalid_003'], data.get('unknownUsernames', []))
 
         # check membership
         self.assertEqual(1, CourseMember.objects.filter(vle_course_id='001', user=self.users['Cersei']).count())
@@ -0,0 +1,68 @@
+import heapq
+import sys
+
+from django.conf import settings
+
+try:
+    import resource
+except ImportError:  # e.g. on Windows
+    resource = None
+
+
+def get_batch_size():
+    return getattr(settings, 'VLE_SYNC_BATCH_SIZE', 500)
+
+
+def chunks(iterable, size):
+    """
+    yields successive lists of (at most) size items from the given iterable
+    """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def merge(iterables):
+    """
+    yields the sorted, deduplicated union of the given sorted iterables, by a k-way merge
+    """
+    last = None
+    for value in heapq.merge(*iterables):
+        if value != last:
+            yield value
+            last = value
+
+
+def setup_worker(databases):
+    """
+    sets up Django in a worker process (however it was started), connected to the given databases (a dict of alias
+    to settings dict, e.g. the test database) rather than those in settings
+    """
+    import django
+    from django.db import connections
+
+    django.setup()
+    for alias, settings_dict in databases.items():
+        # setting up may already have made (or even opened) the connection
+        connection = connections[alias]
+        connection.close()
+        connection.settings_dict.update(settings_dict)
+
+
+def get_peak_rss():
+    """
+    returns the peak resident set size, in kilobytes, of this process (or of its largest finished child process) so far,
+    or None if it can't be known on this platform
+    """
+    if resource is None:
+        return None
+    rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    if sys.platform == 'darwin':
+        # which reports it in bytes
+        rss //= 1024
+    return rss
@@ -1,30 +1,84 @@
 import json
+import logging
+import threading
+import time
 
 from django.conf import settings
-from django.contrib import messages
 from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth import get_user_model
 from django.core.urlresolvers import reverse
+from django.db import connection
 from django.http.response import HttpResponse, HttpResponseRedirect
-from django.utils.encoding import force_str
+from django.utils.encoding import force_str, force_text
 from django.utils.translation import gettext as _
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
 
-from .models import CourseKVStore, CourseMember, GroupKVStore, GroupMember
-from .decorators import basic_auth
-from .sync import full_sync
+from .models import CourseKVStore, CourseMember, GroupKVStore, GroupMember, SyncRun, purge_courses
+from .decorators import basic_auth, invalidates_recipients
+from .report import SyncReport
+from .resolvers import resolver
+from .sync import SKIP, full_sync
+from .utils import chunks, get_batch_size
+
+logger = logging.getLogger(__name__)
 
 
 @staff_member_required
 def full_sync_view(request):
-    messages.add_message(request, messages.INFO, full_sync())
-    return HttpResponseRedirect(reverse('admin:app_list', args=('vle',)))
+    """
+    starts a full sync on a background thread and redirects to its progress page
+    given ?dry_run=1, it's a dry run, and the page reports what would have been done once it has finished
+    """
+    run = SyncRun.objects.create(kind=SyncRun.FULL, dry_run=bool(request.GET.get('dry_run')))
+    thread = threading.Thread(target=_run_full_sync, args=(run,))
+    thread.daemon = True
+    thread.start()
+    return HttpResponseRedirect(reverse('admin:vle_syncrun_progress', args=(run.pk,)))
+
+
+def _run_full_sync(run):
+    """
+    runs a full sync recorded in the given SyncRun, saving its progress as it goes
+    if it raises (as it does before it starts if the configured modes are incompatible), the run fails with its message,
+    as nobody is waiting on the thread to see it
+    """
+    try:
+        try:
+            result = full_sync(run=run, dry_run=run.dry_run, on_busy=SKIP, report=SyncReport(progress=_SavedProgress(run)))
+        except Exception as e:
+            logger.exception('Full VLE synchronization %d failed', run.pk)
+            result = force_text(e) or repr(e)
+        run.refresh_from_db()
+        if run.status == SyncRun.RUNNING:
+            # another sync held the lease, or it raised before it started, so this one never finished
+            run.finish(error=result)
+    finally:
+        connection.close()
+
+
+class _SavedProgress(object):
+    """
+    saves a report's progress to the given SyncRun, at most once per interval
+    """
+
+    def __init__(self, run, interval=2.0):
+        self.run = run
+        self.interval = interval
+        self.last = 0
+
+    def __call__(self, report):
+        now = time.time()
+        if now - self.last < self.interval:
+            return
+        self.last = now
+        self.run.save_progress(report)
 
 
 @csrf_exempt  # has to be the first decorator, apparently, or it doesn't work
 @basic_auth(settings.VLE_SYNC_BASIC_AUTH)
 @require_http_methods(['POST'])
+@invalidates_recipients
 def create_course(request):
     """
     create a new CourseKVStore
@@ -53,6 +107,7 @@ def create_course(request):
 @csrf_exempt
 @basic_auth(settings.VLE_SYNC_BASIC_AUTH)
 @require_http_methods(['POST'])
+@invalidates_recipients
 def update_course(request):
     """
     update a CourseKVStore (and all related models matching its vle_course_id)
@@ -91,6 +146,7 @@ def update_course(request):
 @csrf_exempt
 @basic_auth(settings.VLE_SYNC_BASIC_AUTH)
 @require_http_methods(['POST'])
+@invalidates_recipients
 def delete_course(request):
     """
     delete an existing CourseKVStore (and all related models matching its vle_course_id)
@@ -108,11 +164,8 @@ def delete_course(request):
     if not CourseKVStore.objects.filter(vle_course_id=vle_course_id).exists():
         return _error400(_('Course with given vle_course_id does not exist'))
 
-    # delete course
-    CourseKVStore.objects.get(vle_course_id=vle_course_id).delete()
-    CourseMember.objects.filter(vle_course_id=vle_course_id).delete()
-    GroupKVStore.objects.filter(vle_course_id=vle_course_id).delete()
-    GroupMember.objects.filter(vle_course_id=vle_course_id).delete()
+    # delete course (and everything in it)
+    purge_courses([vle_course_id])
 
     # return JSON response
     return _success200(_('Course deleted successfully!'))
@@ -121,6 +174,7 @@ def delete_course(request):
 @csrf_exempt
 @basic_auth(settings.VLE_SYNC_BASIC_AUTH)
 @require_http_methods(['POST'])
+@invalidates_recipients
 def add_course_members(request):
     """
     add new CourseMembers
@@ -140,21 +194,19 @@ def add_course_members(request):
         return _error400(_('Course with given vle_course_id does not exist'))
 
     # make each user a member
-    for username in usernames:
-        try:
-            user = get_user_model().objects.get(username=username)
-            if not CourseMember.objects.filter(vle_course_id=vle_course_id, user=user).exists():
-                CourseMember.objects.create(vle_course_id=vle_course_id, user=user)
-        except get_user_model().DoesNotExist:
-            pass
+    user_ids, unknown = resolver.resolve(usernames)
+    for chunk in chunks(user_ids.values(), get_batch_size()):
+        existing = set(CourseMember.objects.filter(vle_course_id=vle_course_id, user__in=chunk).values_list('user', flat=True))
+        CourseMember.objects.bulk_create([CourseMember(vle_course_id=vle_course_id, user_id=user_id) for user_id in chunk if user_id not in existing])
 
     # return JSON response
-    return _success200(_('Course members added successfully!'))
+    return _success200(_('Course members added successfully!'), unknown)
 
 
 @csrf_exempt
 @basic_auth(settings.VLE_SYNC_BASIC_AUTH)
 @require_http_methods(['POST'])
+@invalidates_recipients
 def remove_course_members(request):
     """
     remove existing CourseMembers
@@ -174,23 +226,19 @@ def remove_course_members(request):
         return _error400(_('Course with given vle_course_id does not exist'))
 
     # remove each user as a member
-    for username in usernames:
-        try:
-            user = get_user_model().objects.get(username=username)
-            if CourseMember.objects.filter(vle_course_id=vle_course_id, user=user).exists():
-                CourseMember.objects.filter(vle_course_id=vle_course_id, user=user).delete()
-            if GroupMember.objects.filter(vle_course_id=vle_course_id, user=user).exists():
-                GroupMember.objects.filter(vle_course_id=vle_course_id, user=user).delete()
-        except get_user_model().DoesNotExist:
-            pass
+    user_ids, unknown = resolver.resolve(usernames)
+    for chunk in chunks(user_ids.values(), get_batch_size()):
+        CourseMember.objects.filter(vle_course_id=vle_course_id, user__in=chunk).delete()
+        GroupMember.objects.filter(vle_course_id=vle_course_id, user__in=chunk).delete()
 
     # return JSON response
-    return _success200(_('Course members removed successfully!'))
+    return _success200(_('Course members removed successfully!'), unknown)
 
 
 @csrf_exempt
 @basic_auth(settings.VLE_SYNC_BASIC_AUTH)
 @require_http_methods(['POST'])
+@invalidates_recipients
 def add_tutor(request):
     """
     make the given user a tutor of the given course
@@ -227,6 +275,7 @@ def add_tutor(request):
 @csrf_exempt
 @basic_auth(settings.VLE_SYNC_BASIC_AUTH)
 @require_http_methods(['POST'])
+@invalidates_recipients
 def remove_tutor(request):
     """
     remove the given user as a tutor of the given course
@@ -263,6 +312,7 @@ def remove_tutor(request):
 @csrf_exempt
 @basic_auth(settings.VLE_SYNC_BASIC_AUTH)
 @require_http_methods(['POST'])
+@invalidates_recipients
 def create_group(request):
     """
     create a new GroupKVStore
@@ -296,6 +346,7 @@ def create_group(request):
 @csrf_exempt
 @basic_auth(settings.VLE_SYNC_BASIC_AUTH)
 @require_http_methods(['POST'])
+@invalidates_recipients
 def update_group(request):
     """
     update a GroupKVStore (and related model GroupMember matching its vle_course_id and vle_group_id)
@@ -334,6 +385,7 @@ def update_group(request):
 @csrf_exempt
 @basic_auth(settings.VLE_SYNC_BASIC_AUTH)
 @require_http_methods(['POST'])
+@invalidates_recipients
 def delete_group(request):
     """
     delete an existing GroupKVStore (and GroupMember related model matching its vle_course_id and vle_group_id)
@@ -363,6 +415,7 @@ def delete_group(request):
 @csrf_exempt
 @basic_auth(settings.VLE_SYNC_BASIC_AUTH)
 @require_http_methods(['POST'])
+@invalidates_recipients
 def add_group_members(request):
     """
     add new GroupMembers
@@ -386,24 +439,24 @@ def add_group_members(request):
     if not GroupKVStore.objects.filter(vle_course_id=vle_course_id, vle_group_id=vle_group_id).exists():
         return _error400(_('Group with given vle_course_id and vle_group_id does not exist'))
 
-    # make each user a member
-    for username in usernames:
-        try:
-            user = get_user_model().objects.get(username=username)
-            course_member = CourseMember.objects.filter(vle_course_id=vle_course_id, user=user).exists()
-            group_member = GroupMember.objects.filter(vle_course_id=vle_course_id, vle_group_id=vle_group_id, user=user).exists()
-            if course_member and not group_member:
-                GroupMember.objects.create(vle_course_id=vle_course_id, vle_group_id=vle_group_id, user=user)
-        except get_user_model().DoesNotExist:
-            pass
+    # make each user (that is a course member) a member
+    user_ids, unknown = resolver.resolve(usernames)
+    for chunk in chunks(user_ids.values(), get_batch_size()):
+        course_members = set(CourseMember.objects.filter(vle_course_id=vle_course_id, user__in=chunk).values_list('user', flat=True))
+        group_members = set(GroupMember.objects.filter(vle_course_id=vle_course_id, vle_group_id=vle_group_id, user__in=chunk).values_list('user', flat=True))
+        GroupMember.objects.bulk_create([
+            GroupMember(vle_course_id=vle_course_id, vle_group_id=vle_group_id, user_id=user_id)
+            for user_id in course_members.difference(group_members)
+        ])
 
     # return JSON response
-    return _success200(_('Group members added successfully!'))
+    return _success200(_('Group members added successfully!'), unknown)
 
 
 @csrf_exempt
 @basic_auth(settings.VLE_SYNC_BASIC_AUTH)
 @require_http_methods(['POST'])
+@invalidates_recipients
 def remove_group_members(request):
     """
     remove existing GroupMembers
@@ -428,16 +481,12 @@ def remove_group_members(request):
         return _error400(_('Group with given vle_course_id and vle_group_id does not exist'))
 
     # remove each user as a member
-    for username in usernames:
-        try:
-            user = get_user_model().objects.get(username=username)
-            if GroupMember.objects.filter(vle_course_id=vle_course_id, vle_group_id=vle_group_id, user=user).exists():
-                GroupMember.objects.filter(vle_course_id=vle_course_id, vle_group_id=vle_group_id, user=user).delete()
-        except get_user_model().DoesNotExist:
-            pass
+    user_ids, unknown = resolver.resolve(usernames)
+    for chunk in chunks(user_ids.values(), get_batch_size()):
+        GroupMember.objects.filter(vle_course_id=vle_course_id, vle_group_id=vle_group_id, user__in=chunk).delete()
 
     # return JSON response
-    return _success200(_('Group members removed successfully!'))
+    return _success200(_('Group members removed successfully!'), unknown)
 
 
 def _error400(msg):
@@ -449,10 +498,13 @@ def _error400(msg):
     }), content_type='application/json', status=400)
 
 
-def _success200(msg):
+def _success200(msg, unknown_usernames=None):
     """
-    return an http 200 with a given message
+    return an http 200 with a given message (and any usernames that were given but don't exist)
     """
-    return HttpResponse(json.dumps({
+    d = {
         'successMessage': msg
-    }), content_type='application/json', status=200)
+    }
+    if unknown_usernames:
+        d['unknownUsernames'] = sorted(unknown_usernames)
+    return HttpResponse(json.dumps(d), content_type='application/json', status=200)